@@ -0,0 +1,64 @@
+"""
+Measure the time from launching the bot to its first getUpdates call, served
+by a fake Bot API on localhost, in three cases:
+- empty: new database, the registry is imported before polling starts
+- unchanged: the registry file was already imported and the import is skipped
+- changed: a new registry file is imported in the background
+
+    python benchmarks/bench_cold_start.py --stores 20000
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_bot_api import FakeBotAPI
+from synthetic_registry import generate
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bot.py')
+
+
+def time_to_first_update(api, env, timeout):
+    api.first_update_at = None
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, BOT_PATH], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while api.first_update_at is None:
+            if time.monotonic() - start > timeout:
+                raise RuntimeError(f"No getUpdates within {timeout}s")
+            time.sleep(0.01)
+        return api.first_update_at - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stores', type=int, default=20000)
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    api = FakeBotAPI().start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = os.path.join(tmp, 'registry.xlsx')
+        generate(file_path, args.stores, seed=1)
+        env = dict(os.environ,
+                   BOT_TOKEN='123:bench', TELEGRAM_API_URL=api.url,
+                   DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bot.db')}", FILE_PATH=file_path,
+                   REMOTE_FILE_URL=f'{api.url}/registry.xlsx', CHECK_INTERVAL='3600')
+
+        print(f"{'case':>10} {'seconds':>8}")
+        print(f"{'empty':>10} {time_to_first_update(api, env, args.timeout):>8.3f}")
+        print(f"{'unchanged':>10} {time_to_first_update(api, env, args.timeout):>8.3f}")
+        generate(file_path, args.stores, seed=2)
+        print(f"{'changed':>10} {time_to_first_update(api, env, args.timeout):>8.3f}")
+    api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Latency of the "near me" queries of GeoIndex over synthetic stores spread
+over a city, checked against a linear scan of all the stores.
+
+    python benchmarks/bench_geo_index.py --stores 100000 --queries 2000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from geo_index import GeoIndex, distance
+
+FakeStore = namedtuple('FakeStore', ['id', 'vote', 'latitude', 'longitude', 'criminal_category_id'])
+
+# Roma, circa 30 x 30 km
+SOUTH, NORTH, WEST, EAST = 41.75, 42.02, 12.30, 12.65
+
+
+def stores(count, seed):
+    rng = random.Random(seed)
+    return [FakeStore(i, round(rng.uniform(4, 10), 1), rng.uniform(SOUTH, NORTH), rng.uniform(WEST, EAST),
+                      rng.randint(1, 10)) for i in range(1, count + 1)]
+
+
+def scan_nearest(items, latitude, longitude, max_distance, k):
+    found = [(distance(latitude, longitude, s.latitude, s.longitude), s.id) for s in items]
+    return sorted(item for item in found if item[0] <= max_distance)[:k]
+
+
+def scan_best(items, latitude, longitude, radius, k):
+    found = [(-s.vote, distance(latitude, longitude, s.latitude, s.longitude), s.id) for s in items]
+    return sorted(item for item in found if item[1] <= radius)[:k]
+
+
+def timed(function, points):
+    latencies = []
+    for latitude, longitude in points:
+        start = time.perf_counter()
+        function(latitude, longitude)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return [latencies[int(p * (len(latencies) - 1))] * 1e6 for p in (0.5, 0.95, 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stores', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--radius', type=float, default=1000)
+    parser.add_argument('--max-distance', type=float, default=20000, help='Bound of the nearest queries')
+    parser.add_argument('--cell-size', type=float, default=500)
+    parser.add_argument('--check', type=int, default=50, help='Queries compared with a linear scan')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    items = stores(args.stores, args.seed)
+    start = time.perf_counter()
+    index = GeoIndex(items, cell_size=args.cell_size)
+    print(f"Index of {len(index)} stores built in {time.perf_counter() - start:.3f}s")
+
+    rng = random.Random(args.seed + 1)
+    points = [(rng.uniform(SOUTH, NORTH), rng.uniform(WEST, EAST)) for _ in range(args.queries)]
+
+    for latitude, longitude in points[:args.check]:
+        got = [(round(meters, 6), store.id) for meters, store in index.nearest(latitude, longitude, args.max_distance, args.k)]
+        expected = [(round(meters, 6), store_id) for meters, store_id in scan_nearest(items, latitude, longitude, args.max_distance, args.k)]
+        assert got == expected, f"nearest({latitude}, {longitude}) differs from the scan"
+        got = [store.id for _, store in index.best_within(latitude, longitude, args.radius, args.k)]
+        expected = [store_id for _, _, store_id in scan_best(items, latitude, longitude, args.radius, args.k)]
+        assert got == expected, f"best_within({latitude}, {longitude}) differs from the scan"
+    print(f"{args.check} queries match a linear scan")
+
+    category = 3
+    queries = [
+        ('nearest', lambda lat, lon: index.nearest(lat, lon, args.max_distance, args.k)),
+        ('nearest category', lambda lat, lon: index.nearest(lat, lon, args.max_distance, args.k, category_id=category)),
+        ('best_within', lambda lat, lon: index.best_within(lat, lon, args.radius, args.k)),
+        ('best_within category', lambda lat, lon: index.best_within(lat, lon, args.radius, args.k, category_id=category)),
+        ('linear scan', lambda lat, lon: scan_nearest(items, lat, lon, args.max_distance, args.k)),
+    ]
+    print(f"{'query':>22} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9}")
+    for name, function in queries:
+        sample = points if name != 'linear scan' else points[:20]
+        p50, p95, p99 = timed(function, sample)
+        print(f"{name:>22} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
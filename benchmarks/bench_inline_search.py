@@ -0,0 +1,99 @@
+"""
+Latency of the inline-mode lookups: PrefixIndex over store, neighborhood and
+city names, and the articles of InlineSearch with and without its cache.
+Queries are prefixes of real names, one to ten characters long, as typed
+one keystroke at a time. Results are checked against a linear scan.
+
+    python benchmarks/bench_inline_search.py --stores 100000 --queries 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from prefix_index import PrefixIndex, word_keys
+from inline_search import InlineSearch
+
+FakeStore = namedtuple('FakeStore', ['id', 'name', 'address', 'vote', 'maps_link', 'full_vote', 'comment', 'place'])
+
+WORDS = ['da', 'la', 'il', 'bar', 'forno', 'pizzeria', 'trattoria', 'gelateria', 'antico', 'vecchio', 'roma',
+         'mario', 'gino', 'carbonara', 'supplì', 'cornetto', 'piazza', 'borgo', 'sora', 'lella', 'zi',
+         'checco', 'er', 'carrettiere', 'osteria', 'pasticceria', 'dolce', 'vita', 'san', 'lorenzo']
+
+
+def stores(count, seed):
+    rng = random.Random(seed)
+    items = []
+    for i in range(1, count + 1):
+        name = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title() + f' {rng.randint(1, 999)}'
+        place = (f'Quartiere {rng.randint(1, 500)}', f'Citta {rng.randint(1, 20)}')
+        items.append(FakeStore(i, name, f'Via {i}', round(rng.uniform(4, 10), 1), f'https://maps.app.goo.gl/s{i}',
+                               False, None, place))
+    items.sort(key=lambda store: (-store.vote, store.id))
+    return items
+
+
+def names(store):
+    return (store.name,) + store.place
+
+
+def scan(items, query, k):
+    prefix = ''.join(word_keys(query)[:1])
+    return [store.id for store in items
+            if any(key.startswith(prefix) for name in names(store) for key in word_keys(name))][:k]
+
+
+def timed(function, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        function(query)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return [latencies[int(p * (len(latencies) - 1))] * 1e6 for p in (0.5, 0.95, 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stores', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=5000)
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--check', type=int, default=30, help='Queries compared with a linear scan')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    items = stores(args.stores, args.seed)
+    start = time.perf_counter()
+    index = PrefixIndex(items, names, k=args.k)
+    print(f"Index of {len(index)} stores built in {time.perf_counter() - start:.3f}s")
+
+    rng = random.Random(args.seed + 1)
+    queries = []
+    for _ in range(args.queries):
+        name = rng.choice(names(rng.choice(items)))
+        words = name.split()
+        queries.append(' '.join(words[rng.randrange(len(words)):])[:rng.randint(1, 10)])
+
+    for query in queries[:args.check]:
+        assert [store.id for store in index.search(query)] == scan(items, query, args.k), f"'{query}' differs from the scan"
+    print(f"{args.check} queries match a linear scan")
+
+    search = InlineSearch(max_results=args.k, cache_size=100000, ttl=3600)
+    describe = lambda store: ', '.join(store.place) + f' - voto {store.vote}'
+    lookups = [
+        ('PrefixIndex.search', lambda query: index.search(query)),
+        ('articles, cold cache', lambda query: (search.invalidate(), search.results(query, index.search, describe))),
+        ('articles, warm cache', lambda query: search.results(query, index.search, describe)),
+    ]
+    print(f"{'lookup':>22} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9}")
+    for name, function in lookups:
+        p50, p95, p99 = timed(function, queries)
+        print(f"{name:>22} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Latency of the "did you mean" suggestions: NameIndex over city or neighborhood
+names, queried with the names as typed by a user (case, accents, punctuation
+and one typo each), against a pair-by-pair scan of the same names.
+
+    python benchmarks/bench_name_index.py --names 5000 --queries 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from name_index import NameIndex, normalize_name, trigrams
+
+Place = namedtuple('Place', ['id', 'name'])
+
+WORDS = ['san', 'santa', 'pier', "d'arena", 'borgo', 'porta', 'tor', 'bella', 'monaca', 'casal', 'bertone',
+         'città', 'studi', 'trastevere', 'testaccio', 'monti', 'prati', 'parioli', 'pignattara', 'lorenzo',
+         'giovanni', 'marco', 'nuovo', 'vecchio', 'alto', 'basso', 'colle', 'valle', 'ponte', 'mare']
+
+
+def places(count, seed):
+    rng = random.Random(seed)
+    return [Place(i, ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title() + f' {i}')
+            for i in range(1, count + 1)]
+
+
+def typed(name, rng):
+    """The name with one letter dropped, doubled or swapped, in random case"""
+    letters = list(name.upper() if rng.random() < 0.3 else name.lower())
+    i = rng.randrange(len(letters) - 1)
+    edit = rng.choice(['drop', 'double', 'swap'])
+    if edit == 'drop':
+        del letters[i]
+    elif edit == 'double':
+        letters.insert(i, letters[i])
+    else:
+        letters[i], letters[i + 1] = letters[i + 1], letters[i]
+    return ''.join(letters)
+
+
+def scan(items, query, k, min_score=0.3):
+    """The NameIndex ranking, computed pair by pair"""
+    normalized = normalize_name(query)
+    for item in items:
+        if normalize_name(item.name) == normalized:
+            return [item.id]
+    grams = trigrams(normalized)
+    scored = []
+    for item in items:
+        other = trigrams(normalize_name(item.name))
+        score = len(grams & other) / len(grams | other)
+        if score >= min_score:
+            scored.append((-score, item.id))
+    return [item_id for _, item_id in sorted(scored)[:k]]
+
+
+def timed(function, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        function(query)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return [latencies[int(p * (len(latencies) - 1))] * 1e6 for p in (0.5, 0.95, 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--names', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=5000)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--check', type=int, default=30, help='Queries compared with a pair-by-pair scan')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    items = places(args.names, args.seed)
+    start = time.perf_counter()
+    index = NameIndex(items)
+    print(f"Index of {len(index)} names built in {time.perf_counter() - start:.3f}s")
+
+    rng = random.Random(args.seed + 1)
+    queries = [typed(rng.choice(items).name, rng) for _ in range(args.queries)]
+    for query in queries[:args.check]:
+        assert [place.id for place, _ in index.search(query, args.k)] == scan(items, query, args.k), \
+            f"'{query}' differs from the scan"
+    print(f"{args.check} queries match a pair-by-pair scan")
+
+    lookups = [
+        ('NameIndex.search', lambda query: index.search(query, args.k)),
+        ('scan', lambda query: scan(items, query, args.k)),
+    ]
+    print(f"{'lookup':>18} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9}")
+    for name, function in lookups:
+        # La scansione è lenta: bastano meno query
+        sample = queries if function is lookups[0][1] else queries[:200]
+        p50, p95, p99 = timed(function, sample)
+        print(f"{name:>18} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Notification round after an import: the query joining the new, re-voted and
+moved stores with the subscriptions, and the fan-out of one message per chat
+through the OutboundDispatcher to a fake Bot API. Checks that every
+subscriber of a changed (neighborhood, category) gets exactly one message.
+
+    python benchmarks/bench_notifications.py --stores 100000 --subscribers 50000 --changed 500
+    python benchmarks/bench_notifications.py --global-rate 30 --chat-rate 1 --notify-rate 20 --subscribers 500
+
+DATABASE_URL must point to a scratch database: the registry tables are dropped.
+Default: a temporary SQLite file.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from bot_db_entities import Base, Store, Subscription
+from sqlalchemy import create_engine, select, insert, update
+from telebot import TeleBot, apihelper
+from schema_migrations import migrate
+from synthetic_tables import seed, CITIES, NEIGHBORHOODS_PER_CITY, CATEGORIES
+from fake_bot_api import FakeBotAPI
+from outbound_dispatcher import OutboundDispatcher
+from notifications import Notifier, mark_notified
+
+
+def subscribe(engine, subscribers, per_chat, rng):
+    now = datetime.now()
+    rows = {}
+    for chat_id in range(1, subscribers + 1):
+        for _ in range(per_chat):
+            key = (chat_id, rng.randint(1, CITIES * NEIGHBORHOODS_PER_CITY), rng.randint(1, CATEGORIES))
+            rows[key] = {'chat_id': key[0], 'neighborhood_id': key[1], 'criminal_category_id': key[2], 'created_at': now}
+    with engine.begin() as connection:
+        for start in range(0, len(rows), 10000):
+            connection.execute(insert(Subscription), list(rows.values())[start:start + 10000])
+    return set(rows)
+
+
+def change(engine, stores, changed, rng):
+    """Re-vote a third of the changed stores, move a third and add the rest; return their (neighborhood, category)"""
+    now = datetime.now()
+    existing = rng.sample(range(1, stores + 1), changed // 3 * 2)
+    revoted, moved = existing[:changed // 3], existing[changed // 3:]
+    with engine.begin() as connection:
+        connection.execute(update(Store).where(Store.id.in_(revoted)).values(vote=Store.vote + 0.5))
+        for store_id in moved:
+            connection.execute(update(Store).where(Store.id == store_id).values(
+                neighborhood_id=rng.randint(1, CITIES * NEIGHBORHOODS_PER_CITY), criminal_category_id=rng.randint(1, CATEGORIES)
+            ))
+        connection.execute(insert(Store), [
+            {'id': stores + i, 'name': f'Nuovo {i}', 'address': f'Via {i}', 'vote': 8.0, 'maps_link': None,
+             'full_vote': False, 'comment': None, 'created_at': now,
+             'criminal_category_id': rng.randint(1, CATEGORIES), 'neighborhood_id': rng.randint(1, CITIES * NEIGHBORHOODS_PER_CITY)}
+            for i in range(1, changed - len(existing) + 1)
+        ])
+        return set(connection.execute(select(Store.neighborhood_id, Store.criminal_category_id).where(
+            Store.id.in_(existing) | (Store.id > stores)
+        )).all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stores', type=int, default=100000)
+    parser.add_argument('--subscribers', type=int, default=50000)
+    parser.add_argument('--per-chat', type=int, default=3, help='Subscriptions of each chat')
+    parser.add_argument('--changed', type=int, default=500, help='Stores added or re-voted by the import')
+    parser.add_argument('--global-rate', type=float, default=None, help='Messages/s of the fake API, default no limit')
+    parser.add_argument('--chat-rate', type=float, default=None)
+    parser.add_argument('--notify-rate', type=float, default=5000)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(os.getenv('DATABASE_URL') or f"sqlite:///{os.path.join(tmp, 'notify.db')}")
+        Base.metadata.drop_all(engine)
+        migrate(engine)
+        seed(engine, args.stores)
+        rng = random.Random(args.seed)
+        subscriptions = subscribe(engine, args.subscribers, args.per_chat, rng)
+        with engine.begin() as connection:
+            mark_notified(connection)
+        groups = change(engine, args.stores, args.changed, rng)
+        expected = {chat_id for chat_id, neighborhood_id, category_id in subscriptions if (neighborhood_id, category_id) in groups}
+
+        api = FakeBotAPI(global_rate=args.global_rate, chat_rate=args.chat_rate).start()
+        apihelper.API_URL = api.url + '/bot{0}/{1}'
+        outbox = OutboundDispatcher(TeleBot('123:bench', threaded=False), workers=args.workers,
+                                    global_rate=args.global_rate or 1e6, chat_rate=args.chat_rate or 1e6)
+        outbox.start()
+        notifier = Notifier(engine, outbox, threading.Lock(), rate=args.notify_rate, max_pending=args.workers * 4)
+
+        collect = notifier.collect
+        timings = {}
+
+        def timed_collect():
+            started = time.perf_counter()
+            changes = collect()
+            timings['collect'] = time.perf_counter() - started
+            return changes
+
+        notifier.collect = timed_collect
+        # Like after an import: the round runs in the notifier thread
+        notifier.start()
+        start = time.perf_counter()
+        notifier.schedule()
+        scheduled = time.perf_counter() - start
+        notifier.wait_idle()
+        handed = time.perf_counter() - start
+        while outbox.pending:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        notifier.stop()
+        outbox.stop(timeout=0)
+        api.stop()
+        assert not collect(), "a second round found the same changes again"
+
+        chats = [chat_id for _, _, chat_id, _ in api.sent]
+        print(f"{args.stores} stores, {len(subscriptions)} subscriptions of {args.subscribers} chats, {len(groups)} changed groups")
+        print(f"collect (match + mark): {timings['collect']:.3f}s for {len(expected)} chats")
+        print(f"import thread blocked for {scheduled * 1e6:.0f}us; messages handed to the outbox in {handed:.2f}s, "
+              f"sent in {elapsed:.2f}s ({len(chats) / elapsed:.0f} msg/s)")
+        print(f"{len(chats)} messages to {len(set(chats))} chats, {api.rate_limited} answered 429")
+        assert len(chats) == len(set(chats)), "some chat got more than one message"
+        assert set(chats) == expected, f"{len(set(chats))} chats notified, {len(expected)} expected"
+
+
+if __name__ == '__main__':
+    main()
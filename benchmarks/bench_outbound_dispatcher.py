@@ -0,0 +1,97 @@
+"""
+Send a burst of messages to many chats through a fake Bot API enforcing
+Telegram-like limits (30 messages/s overall, 1/s per chat) and injecting
+random 429 and 502 answers. Compares handlers calling send_message directly
+from a thread pool with the OutboundDispatcher.
+
+    python benchmarks/bench_outbound_dispatcher.py --messages 600 --chats 200
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from telebot import TeleBot, apihelper
+from fake_bot_api import FakeBotAPI
+from outbound_dispatcher import OutboundDispatcher
+
+
+def burst(messages, chats):
+    """(chat_id, text) pairs, several messages per chat in a row"""
+    return [(1000 + i % chats, f'messaggio {i}') for i in range(messages)]
+
+
+def run_direct(bot, items, threads):
+    failures = 0
+
+    def send(item):
+        try:
+            bot.send_message(*item)
+            return 0
+        except Exception:
+            return 1
+
+    with ThreadPoolExecutor(threads) as pool:
+        failures = sum(pool.map(send, items))
+    return failures
+
+
+def run_dispatcher(bot, items, workers, timeout):
+    dispatcher = OutboundDispatcher(bot, workers=workers)
+    dispatcher.start()
+    for chat_id, text in items:
+        dispatcher.send_message(chat_id, text)
+    deadline = time.monotonic() + timeout
+    while dispatcher.pending and time.monotonic() < deadline:
+        time.sleep(0.05)
+    left = dispatcher.pending
+    dispatcher.stop(timeout=0)
+    return left
+
+
+def in_order(api, items):
+    """True if every chat received its messages in the order they were sent"""
+    expected = {}
+    for chat_id, text in items:
+        expected.setdefault(chat_id, []).append(text)
+    received = {}
+    for _, _, chat_id, text in api.sent:
+        received.setdefault(chat_id, []).append(text)
+    return received == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=600)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--error-rate', type=float, default=0.02)
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+    items = burst(args.messages, args.chats)
+    # The retries are the point of the benchmark: do not log each of them
+    logging.disable(logging.ERROR)
+
+    print(f"{'mode':>10} {'seconds':>8} {'delivered':>9} {'lost':>6} {'429s':>6} {'msg/s':>7} {'ordered':>8}")
+    for mode in ('direct', 'dispatcher'):
+        api = FakeBotAPI(global_rate=30, chat_rate=1, error_rate=args.error_rate).start()
+        apihelper.API_URL = api.url + '/bot{0}/{1}'
+        bot = TeleBot('123:bench', threaded=False)
+        start = time.monotonic()
+        if mode == 'direct':
+            lost = run_direct(bot, items, args.threads)
+        else:
+            lost = run_dispatcher(bot, items, args.threads, args.timeout)
+        elapsed = time.monotonic() - start
+        delivered = len(api.sent)
+        print(f"{mode:>10} {elapsed:>8.2f} {delivered:>9} {lost:>6} {api.rate_limited:>6} "
+              f"{delivered / elapsed:>7.1f} {'yes' if in_order(api, items) else 'no':>8}")
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare the streaming RegistryReader with the former pandas path
+(pd.ExcelFile + one read_excel per sheet + iterrows) on synthetic
+workbooks, reporting wall time and peak traced memory.
+
+    python benchmarks/bench_registry_reader.py --sizes 1000 10000 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from registry_reader import RegistryReader
+from synthetic_registry import generate
+import pandas as pd
+
+
+def read_with_pandas(path):
+    xls = pd.ExcelFile(path, engine='openpyxl')
+    count = 0
+    for sheet in ('category', 'city', 'neighborhood', 'store'):
+        for _, row in pd.read_excel(xls, sheet).iterrows():
+            count += 1
+    return count
+
+
+def read_with_registry_reader(path):
+    count = 0
+    for _ in RegistryReader(path).iter_records():
+        count += 1
+    return count
+
+
+def measure(func, path):
+    """Time a run untraced, then repeat it under tracemalloc for the peak memory"""
+    start = time.perf_counter()
+    rows = func(path)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    print(f"{'stores':>8} {'reader':>16} {'rows':>8} {'seconds':>9} {'peak MiB':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = generate(os.path.join(tmp, f'registry-{size}.xlsx'), stores=size)
+            for name, func in (('pandas', read_with_pandas), ('RegistryReader', read_with_registry_reader)):
+                rows, elapsed, peak = measure(func, path)
+                print(f"{size:>8} {name:>16} {rows:>8} {elapsed:>9.3f} {peak / 2 ** 20:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
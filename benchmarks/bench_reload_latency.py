@@ -0,0 +1,102 @@
+"""
+Measure the latency seen by database readers while a registry import runs,
+comparing the incremental import with the staged import (IMPORT_MODE=staged).
+Readers query the stores straight from the database (CATALOG_ENABLED=false),
+as the bot does before the catalog is loaded.
+
+    python benchmarks/bench_reload_latency.py --stores 50000 --readers 4
+
+DATABASE_URL selects the database (default: a temporary SQLite file per mode).
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synthetic_registry import generate
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def read_loop(dao, neighborhoods, categories, samples, stop_event):
+    rng = random.Random(threading.get_ident())
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        dao.get_stores(rng.randint(1, neighborhoods), rng.randint(1, categories))
+        samples.append(time.perf_counter() - start)
+
+
+def measure(dao, readers, neighborhoods, action):
+    """Run the readers during action() and return their latencies"""
+    samples = []
+    stop_event = threading.Event()
+    threads = [threading.Thread(target=read_loop, args=(dao, neighborhoods, 10, samples, stop_event))
+               for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    action()
+    elapsed = time.perf_counter() - start
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    return samples, elapsed
+
+
+def run_mode(mode, database_url, first, second, args):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['IMPORT_MODE'] = mode
+    os.environ['CATALOG_ENABLED'] = 'false'
+    from database import Database
+    from dao import DAO
+    from database_updater import DatabaseUpdater
+
+    database = Database()
+    dao = DAO(database)
+    updater = DatabaseUpdater(database)
+    updater.file_path = first
+    updater.update_from_excel()
+    neighborhoods = args.cities * args.neighborhoods_per_city
+
+    def import_second():
+        updater.file_path = second
+        updater.update_from_excel()
+
+    for phase, action in (('idle', lambda: time.sleep(args.idle_seconds)), ('import', import_second)):
+        samples, elapsed = measure(dao, args.readers, neighborhoods, action)
+        print(f"{mode:>12} {phase:>8} {elapsed:>8.2f} {len(samples):>8} "
+              f"{statistics.median(samples) * 1000:>8.2f} {percentile(samples, 0.99) * 1000:>8.2f} "
+              f"{max(samples) * 1000:>8.2f}")
+    database.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stores', type=int, default=20000)
+    parser.add_argument('--cities', type=int, default=20)
+    parser.add_argument('--neighborhoods-per-city', type=int, default=25)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--idle-seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    print(f"{'mode':>12} {'phase':>8} {'seconds':>8} {'reads':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        # Two seeds, so that the second import changes most of the stores
+        first = generate(os.path.join(tmp, 'first.xlsx'), args.stores, args.cities, args.neighborhoods_per_city, seed=1)
+        second = generate(os.path.join(tmp, 'second.xlsx'), args.stores, args.cities, args.neighborhoods_per_city, seed=2)
+        for mode in ('incremental', 'staged'):
+            database_url = os.getenv('DATABASE_URL') or f"sqlite:///{os.path.join(tmp, mode + '.db')}"
+            run_mode(mode, database_url, first, second, args)
+
+
+if __name__ == '__main__':
+    main()
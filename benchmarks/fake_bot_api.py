@@ -0,0 +1,235 @@
+"""
+Local stand-in for the Telegram Bot API, for benchmarks and load tests.
+
+It answers getMe, serves queued updates to getUpdates (long polling),
+records every sendMessage, editMessageText and answerCallbackQuery, and
+enforces Telegram-like rate limits with 429 responses carrying retry_after.
+GET requests outside /bot<token>/ serve the files registered with
+serve_file, or answer 304 as an unchanged remote registry.
+
+    api = FakeBotAPI(global_rate=30, chat_rate=1).start()
+    apihelper.API_URL = api.url + '/bot{0}/{1}'
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+import json
+import os
+import random
+import threading
+import time
+
+
+class _Bucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class FakeBotAPI:
+    SENDING_METHODS = {'sendMessage', 'editMessageText'}
+
+    def __init__(self, global_rate=None, chat_rate=None, chat_burst=3, error_rate=0.0, latency=0.0, seed=0):
+        """
+        Args:
+            global_rate: Messages per second over all chats before answering 429, None for no limit
+            chat_rate: Messages per second of a chat before answering 429, None for no limit
+            error_rate: Fraction of the sending calls answered with a random 429 or 502
+            latency: Seconds added to every sending call
+        """
+        self.global_bucket = _Bucket(global_rate, global_rate) if global_rate else None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.error_rate = error_rate
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.chat_buckets = {}
+        self.sent = []
+        self.callback_answers = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.first_update_at = None
+        self.files_served = 0
+        # Called with (chat_id, method, text) after every recorded message
+        self.on_send = None
+        self._files = {}
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+        self._updates_ready = threading.Condition(self.lock)
+        self._httpd = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._httpd.server_port}'
+
+    def serve_file(self, path, url_path='/registry.xlsx'):
+        """Serve a local file at url_path, with an ETag changing whenever the file is replaced"""
+        self._files[url_path] = path
+
+    def _file(self, url_path, etag):
+        """Return (status, headers, body) of a GET outside the Bot API"""
+        path = self._files.get(url_path)
+        if path is None:
+            return 304, {}, b''
+        stat = os.stat(path)
+        current = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        if etag == current:
+            return 304, {}, b''
+        with open(path, 'rb') as f:
+            body = f.read()
+        with self.lock:
+            self.files_served += 1
+        return 200, {'ETag': current, 'Content-Type': 'application/octet-stream'}, body
+
+    def push_update(self, update):
+        """Queue an update for getUpdates, assigning its update_id"""
+        with self.lock:
+            self._update_id += 1
+            update = dict(update, update_id=self._update_id)
+            self._updates.append(update)
+            self._updates_ready.notify_all()
+        return self._update_id
+
+    def push_message(self, chat_id, text):
+        with self.lock:
+            self._message_id += 1
+            message_id = self._message_id
+        message = {'message_id': message_id, 'date': int(time.time()), 'text': text,
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self.push_update({'message': message})
+
+    def push_callback(self, chat_id, data, message_id=1):
+        return self.push_update({'callback_query': {
+            'id': f'{chat_id}-{time.monotonic_ns()}', 'chat_instance': str(chat_id), 'data': data,
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+            'message': {'message_id': message_id, 'date': int(time.time()), 'text': '',
+                        'chat': {'id': chat_id, 'type': 'private'}},
+        }})
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        timeout = min(float(params.get('timeout', 0)), 1.0)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            if self.first_update_at is None:
+                self.first_update_at = time.monotonic()
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_ready.wait(deadline - time.monotonic())
+            return list(self._updates[:int(params.get('limit', 100))])
+
+    def _limit(self, chat_id):
+        """Return retry_after if the call exceeds a limit or hits an injected error, else None"""
+        now = time.monotonic()
+        with self.lock:
+            if self.error_rate and self.rng.random() < self.error_rate:
+                self.errors += 1
+                return 1 if self.rng.random() < 0.5 else 'error'
+            if self.global_bucket is not None:
+                wait = self.global_bucket.take(now)
+                if wait:
+                    self.rate_limited += 1
+                    return max(1, round(wait))
+            if self.chat_rate:
+                bucket = self.chat_buckets.setdefault(chat_id, _Bucket(self.chat_rate, self.chat_burst))
+                wait = bucket.take(now)
+                if wait:
+                    self.rate_limited += 1
+                    return max(1, round(wait))
+        return None
+
+    def _send(self, method, params):
+        chat_id = int(params.get('chat_id', 0))
+        if self.latency:
+            time.sleep(self.latency)
+        limited = self._limit(chat_id)
+        if limited == 'error':
+            return 502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+        if limited is not None:
+            return 429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {limited}',
+                         'parameters': {'retry_after': limited}}
+        with self.lock:
+            self._message_id += 1
+            message_id = self._message_id
+            self.sent.append((time.monotonic(), method, chat_id, params.get('text', '')))
+        if self.on_send is not None:
+            self.on_send(chat_id, method, params.get('text', ''))
+        return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()),
+                                            'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}}
+
+    def handle(self, method, params):
+        """Return (status, JSON body) of a Bot API call"""
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}}
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if method in self.SENDING_METHODS:
+            return self._send(method, params)
+        if method == 'answerCallbackQuery':
+            with self.lock:
+                self.callback_answers += 1
+        return 200, {'ok': True, 'result': True}
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _dispatch(self):
+                parts = urlsplit(self.path)
+                if not parts.path.startswith('/bot'):
+                    status, headers, body = api._file(parts.path, self.headers.get('If-None-Match'))
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                params = dict(parse_qsl(parts.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode('utf-8')
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body))
+                status, payload = api.handle(parts.path.rsplit('/', 1)[-1], params)
+                data = json.dumps(payload).encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The bot went away during a long poll
+                    pass
+
+            do_GET = _dispatch
+            do_POST = _dispatch
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,292 @@
+"""
+Load test of the whole bot: the bot runs as a subprocess polling a fake Bot
+API on localhost, with a synthetic registry in SQLite (or DATABASE_URL),
+while thousands of simulated users go through
+/start -> /categorie -> category -> /citta -> city -> /quartiere -> neighborhood -> /risultati.
+Each step waits for the reply of the bot before sending the next one.
+Every --import-interval seconds the remote registry is replaced, so the bot
+downloads and imports it while serving the users.
+
+The report is JSON with the commit, the parameters, the throughput and the
+latency percentiles per step. The same --seed replays the same users, so
+reports of different commits can be compared:
+
+    python benchmarks/load_test.py --users 5000 --concurrency 500 --output before.json
+    python benchmarks/load_test.py --users 5000 --concurrency 500 --compare before.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from fake_bot_api import FakeBotAPI
+from synthetic_registry import generate, city_name, neighborhood_name, CATEGORIES
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BOT_PATH = os.path.join(ROOT, 'src', 'bot.py')
+
+STEPS = ['start', 'categorie', 'category', 'citta', 'city', 'quartiere', 'neighborhood', 'risultati']
+# Risposte del bot che indicano un passaggio fallito
+ERROR_MARKERS = ('Errore', 'Dati inconsistenti', 'Si è verificato un errore', 'Nessun', 'Non è stato trovato', 'Riprova')
+
+
+class User:
+    __slots__ = ('chat_id', 'category_id', 'city', 'neighborhood', 'step', 'sent_at')
+
+    def __init__(self, chat_id, rng, cities, neighborhoods_per_city):
+        self.chat_id = chat_id
+        self.category_id = rng.randint(1, len(CATEGORIES))
+        city_id = rng.randint(1, cities)
+        self.city = city_name(city_id)
+        self.neighborhood = neighborhood_name((city_id - 1) * neighborhoods_per_city + rng.randint(1, neighborhoods_per_city))
+        self.step = 0
+        self.sent_at = None
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def rank(p):
+        return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 2)
+    return {'count': len(values), 'p50_ms': rank(0.50), 'p95_ms': rank(0.95), 'p99_ms': rank(0.99),
+            'max_ms': round(values[-1] * 1000, 2)}
+
+
+class LoadTest:
+    """Simulated users, advanced by the replies recorded by the fake Bot API"""
+    def __init__(self, api, users, concurrency, cities, neighborhoods_per_city, step_timeout, seed):
+        self.api = api
+        self.concurrency = concurrency
+        self.step_timeout = step_timeout
+        rng = random.Random(seed)
+        self.waiting = [User(100000 + i, rng, cities, neighborhoods_per_city) for i in range(users)]
+        self.waiting.reverse()
+        self.active = {}
+        self.latencies = {step: [] for step in STEPS}
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.unexpected = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        api.on_send = self.on_send
+
+    def start(self):
+        for _ in range(self.concurrency):
+            self._next_user()
+
+    def _next_user(self):
+        with self.lock:
+            if not self.waiting:
+                if not self.active:
+                    self.finished.set()
+                return
+            user = self.waiting.pop()
+            self.active[user.chat_id] = user
+        self._send(user)
+
+    def _send(self, user):
+        step = STEPS[user.step]
+        user.sent_at = time.monotonic()
+        if step == 'category':
+            self.api.push_callback(user.chat_id, str(user.category_id))
+        elif step == 'city':
+            self.api.push_message(user.chat_id, user.city)
+        elif step == 'neighborhood':
+            self.api.push_message(user.chat_id, user.neighborhood)
+        else:
+            self.api.push_message(user.chat_id, '/' + step)
+
+    def on_send(self, chat_id, method, text):
+        now = time.monotonic()
+        with self.lock:
+            user = self.active.get(chat_id)
+            if user is None or user.sent_at is None:
+                self.unexpected += 1
+                return
+            self.latencies[STEPS[user.step]].append(now - user.sent_at)
+            user.sent_at = None
+            failed = any(marker in text for marker in ERROR_MARKERS)
+            user.step += 1
+            done = failed or user.step == len(STEPS)
+            if done:
+                del self.active[chat_id]
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+        if done:
+            self._next_user()
+        else:
+            self._send(user)
+
+    def expire(self):
+        """Give up on the users waiting for a reply for longer than step_timeout"""
+        deadline = time.monotonic() - self.step_timeout
+        with self.lock:
+            expired = [user for user in self.active.values() if user.sent_at is not None and user.sent_at < deadline]
+            for user in expired:
+                del self.active[user.chat_id]
+                self.timed_out += 1
+        for _ in expired:
+            self._next_user()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def scrape(port, prefix):
+    """Samples of the bot metrics starting with prefix, {} if the bot does not answer"""
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+            lines = response.read().decode('utf-8').splitlines()
+    except OSError:
+        return {}
+    samples = {}
+    for line in lines:
+        if line.startswith(prefix):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except OSError:
+        return None
+
+
+def replace_registry(path, args, seed):
+    """Write a new registry next to path and move it in place, so it is never served half written"""
+    temp_path = path + '.new.xlsx'
+    generate(temp_path, args.stores, cities=args.cities, neighborhoods_per_city=args.neighborhoods, seed=seed)
+    os.replace(temp_path, path)
+
+
+def run(args, tmp):
+    limits = {'global_rate': 30, 'chat_rate': 1} if args.telegram_limits else {}
+    api = FakeBotAPI(latency=args.api_latency, **limits).start()
+    remote_path = os.path.join(tmp, 'remote.xlsx')
+    file_path = os.path.join(tmp, 'registry.xlsx')
+    replace_registry(remote_path, args, seed=args.seed)
+    shutil.copy(remote_path, file_path)
+    api.serve_file(remote_path)
+
+    metrics_port = free_port()
+    env = dict(os.environ,
+               BOT_TOKEN='123:load', TELEGRAM_API_URL=api.url, BOT_RUNTIME=args.runtime, BOT_MODE='polling',
+               DATABASE_URL=os.getenv('DATABASE_URL') or f"sqlite:///{os.path.join(tmp, 'bot.db')}",
+               FILE_PATH=file_path, REMOTE_FILE_URL=f'{api.url}/registry.xlsx',
+               CHECK_INTERVAL='1', MAX_CHECK_INTERVAL='2', METRICS_PORT=str(metrics_port))
+    if not args.telegram_limits:
+        # Si misura il bot, non i limiti di Telegram
+        env.update(OUTBOX_GLOBAL_RATE='1000000', OUTBOX_CHAT_RATE='1000000')
+
+    log = open(args.bot_log, 'w')
+    process = subprocess.Popen([sys.executable, BOT_PATH], env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + args.startup_timeout
+        while api.first_update_at is None:
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"The bot did not start, see {args.bot_log}")
+            time.sleep(0.05)
+
+        test = LoadTest(api, args.users, args.concurrency, args.cities, args.neighborhoods, args.step_timeout, args.seed)
+        start = time.monotonic()
+        next_import = start + args.import_interval if args.import_interval else None
+        registries = 0
+        test.start()
+        while not test.finished.wait(0.2):
+            test.expire()
+            if next_import is not None and time.monotonic() >= next_import:
+                registries += 1
+                replace_registry(remote_path, args, seed=args.seed + registries)
+                next_import = time.monotonic() + args.import_interval
+        elapsed = time.monotonic() - start
+
+        all_latencies = [value for values in test.latencies.values() for value in values]
+        return {
+            'revision': git_revision(),
+            'parameters': {name: value for name, value in vars(args).items() if name not in ('output', 'compare', 'bot_log')},
+            'seconds': round(elapsed, 3),
+            'users': {'completed': test.completed, 'failed': test.failed, 'timed_out': test.timed_out},
+            'throughput': {
+                'updates_per_second': round(len(all_latencies) / elapsed, 1),
+                'users_per_second': round(test.completed / elapsed, 1),
+            },
+            'latency': percentiles(all_latencies),
+            'steps': {step: percentiles(values) for step, values in test.latencies.items()},
+            'imports': {'registries_published': registries, 'downloads': api.files_served,
+                        'bot_imports': scrape(metrics_port, 'bot_imports_total')},
+            'unexpected_replies': test.unexpected,
+        }
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+        api.stop()
+
+
+def compare(report, baseline):
+    """Print the change of throughput and percentiles against a previous report"""
+    def change(old, new):
+        return f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+
+    print(f"{'':>14} {baseline['revision'] or '?':>12} {report['revision'] or '?':>12} {'change':>8}")
+    old, new = baseline['throughput']['updates_per_second'], report['throughput']['updates_per_second']
+    print(f"{'updates/s':>14} {old:>12} {new:>12} {change(old, new):>8}")
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        old, new = baseline['latency'].get(key, 0), report['latency'].get(key, 0)
+        print(f"{key:>14} {old:>12} {new:>12} {change(old, new):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000, help='Simulated users, each going through all the steps once')
+    parser.add_argument('--concurrency', type=int, default=200, help='Users in the middle of a conversation at any time')
+    parser.add_argument('--stores', type=int, default=20000)
+    parser.add_argument('--cities', type=int, default=20)
+    parser.add_argument('--neighborhoods', type=int, default=25, help='Neighborhoods per city')
+    parser.add_argument('--runtime', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--import-interval', type=float, default=10, help='Seconds between registry changes, 0 for none')
+    parser.add_argument('--telegram-limits', action='store_true', help='Enforce 30 messages/s overall and 1/s per chat')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='Seconds added to every message sent')
+    parser.add_argument('--step-timeout', type=float, default=30)
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--bot-log', default=os.devnull, help='File receiving the output of the bot')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    parser.add_argument('--compare', help='Previous JSON report to compare with')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        report = run(args, tmp)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Synthetic registry generator in the registry-fec-bot.xlsx format.
+
+    python benchmarks/synthetic_registry.py registry-10k.xlsx --stores 10000
+"""
+import argparse
+import random
+import openpyxl
+
+CATEGORIES = ['Gelaterie', 'Forni', 'Rosticcerie', 'Panini', 'Pizza a taglio',
+              'Pizza tonda', 'Pasticceria', 'Tramezzini', 'Piadine', 'Fritti']
+STORE_HEADER = ['id', 'name', 'address', 'vote', 'link', 'latitude', 'longitude', 'full_vote',
+                'comment', 'criminal_category_id', 'neighborhood_id']
+
+
+def _letters(number):
+    # Il bot accetta solo lettere nei nomi digitati: 12 -> 'bc'
+    return ''.join(chr(ord('a') + int(digit)) for digit in str(number))
+
+
+def city_name(city_id):
+    return f'citta {_letters(city_id)}'
+
+
+def neighborhood_name(neighborhood_id):
+    return f'quartiere {_letters(neighborhood_id)}'
+
+
+def generate(path, stores=1000, cities=20, neighborhoods_per_city=25, seed=42):
+    """Write a registry workbook with the given number of stores"""
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+
+    sheet = workbook.create_sheet('category')
+    sheet.append(['id', 'title'])
+    for i, title in enumerate(CATEGORIES, start=1):
+        sheet.append([i, title.lower()])
+
+    sheet = workbook.create_sheet('city')
+    sheet.append(['id', 'name'])
+    for city_id in range(1, cities + 1):
+        sheet.append([city_id, city_name(city_id)])
+
+    sheet = workbook.create_sheet('neighborhood')
+    sheet.append(['id', 'name', 'city_id'])
+    neighborhood_count = cities * neighborhoods_per_city
+    for neighborhood_id in range(1, neighborhood_count + 1):
+        city_id = (neighborhood_id - 1) // neighborhoods_per_city + 1
+        sheet.append([neighborhood_id, neighborhood_name(neighborhood_id), city_id])
+
+    sheet = workbook.create_sheet('store')
+    sheet.append(STORE_HEADER)
+    for store_id in range(1, stores + 1):
+        sheet.append([
+            store_id,
+            f'Locale {store_id}',
+            f'Via {rng.randint(1, 500)} numero {rng.randint(1, 200)}',
+            round(rng.uniform(4, 10), 1),
+            f'https://maps.app.goo.gl/s{store_id:07d}',
+            round(41.80 + rng.uniform(0, 0.2), 6),
+            round(12.40 + rng.uniform(0, 0.2), 6),
+            rng.random() < 0.2,
+            'un posto criminale' if rng.random() < 0.3 else None,
+            rng.randint(1, len(CATEGORIES)),
+            rng.randint(1, neighborhood_count),
+        ])
+
+    workbook.save(path)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--stores', type=int, default=1000)
+    parser.add_argument('--cities', type=int, default=20)
+    parser.add_argument('--neighborhoods-per-city', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    generate(args.path, args.stores, args.cities, args.neighborhoods_per_city, args.seed)
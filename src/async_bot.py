@@ -0,0 +1,181 @@
+from telebot.async_telebot import AsyncTeleBot
+from telebot import TeleBot
+from telebot import asyncio_helper
+from telebot.asyncio_handler_backends import BaseMiddleware
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+from bot import BOT, MetricsMiddleware, BOT_ERRORS, WELCOME_TEXT, CATEGORIES_TEXT, LEADERBOARD_TEXT
+import result_renderer
+from outbound_dispatcher import OutboundMiddleware
+
+
+class AsyncMetricsMiddleware(BaseMiddleware):
+    """MetricsMiddleware for AsyncTeleBot, which awaits the middleware hooks"""
+    def __init__(self, slow_seconds):
+        super().__init__()
+        self.metrics = MetricsMiddleware(slow_seconds)
+        self.update_types = self.metrics.update_types
+
+    async def pre_process(self, update, data):
+        self.metrics.pre_process(update, data)
+
+    async def post_process(self, update, data, exception):
+        self.metrics.post_process(update, data, exception)
+
+
+class AsyncOutboundMiddleware(BaseMiddleware):
+    """OutboundMiddleware for AsyncTeleBot: the update key lives in the context of the task handling it"""
+    def __init__(self, dispatcher):
+        super().__init__()
+        self.outbound = OutboundMiddleware(dispatcher)
+        self.update_types = self.outbound.update_types
+
+    async def pre_process(self, update, data):
+        self.outbound.pre_process(update, data)
+
+    async def post_process(self, update, data, exception):
+        self.outbound.post_process(update, data, exception)
+
+
+class AsyncBOT(BOT):
+    """
+    Same conversation as BOT, served by AsyncTeleBot. The commands and
+    buttons that only render a view are coroutines: the view is built on a
+    bounded thread pool, since the catalog may be disabled and the session
+    store may be remote, and the reply is queued from the event loop. The
+    other handlers (typed names, suggestions, /risultati, subscriptions,
+    locations) interleave several session store and database calls with
+    their replies, so the BOT ones run whole on the same pool.
+    """
+    def __init__(self, token):
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('DB_EXECUTOR_WORKERS', '8')),
+            thread_name_prefix='db'
+        )
+        super().__init__(token)
+
+    def create_bot(self, token):
+        api_url = os.getenv('TELEGRAM_API_URL')
+        if api_url:
+            asyncio_helper.API_URL = api_url.rstrip('/') + '/bot{0}/{1}'
+        return AsyncTeleBot(token)
+
+    def create_outbox(self):
+        # I worker della coda usano un client sincrono: gli handler accodano e non attendono l'API
+        outbox = self.create_dispatcher(TeleBot(self.bot.token, threaded=False))
+        self.bot.setup_middleware(AsyncOutboundMiddleware(outbox))
+        return outbox
+
+    def create_metrics_middleware(self, slow_seconds):
+        return AsyncMetricsMiddleware(slow_seconds)
+
+    async def run_db(self, func, *args):
+        loop = asyncio.get_running_loop()
+        # run_in_executor non copia il contesto: senza, la chiave dell'update non arriva alla coda
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, func, *args))
+
+    async def has_pending_step(self, message):
+        return await self.run_db(super().has_pending_step, message)
+
+    def register_handlers(self):
+        # Gli handler rimasti sincroni girano sul pool del database: il loop non si blocca mai
+        for kind, filters, handler in self.handlers():
+            if not asyncio.iscoroutinefunction(handler):
+                handler = self.in_executor(handler)
+            getattr(self.bot, kind)(**filters)(handler)
+
+    def in_executor(self, handler):
+        async def run(update):
+            await self.run_db(handler, update)
+        return run
+
+    async def on_start(self, message):
+        await self.run_db(self.set_user_data, message.chat.id)
+        self.outbox.reply_to(message, WELCOME_TEXT)
+
+    async def on_categories(self, message):
+        self.outbox.send_message(message.chat.id, CATEGORIES_TEXT, reply_markup=await self.run_db(self.categories_markup))
+
+    async def on_leaderboard_command(self, message):
+        self.outbox.send_message(message.chat.id, LEADERBOARD_TEXT, reply_markup=await self.run_db(self.leaderboard_categories_markup))
+
+    async def on_category(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            msg, markup = await self.run_db(self.select_category, chat_id, call.data)
+            self.outbox.send_message(chat_id, msg, reply_markup=markup)
+        except ValueError as ve:
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /categorie")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /start')
+
+    async def on_navigation(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            self.show_view(call, await self.run_db(self.navigation_view, call.data))
+        except ValueError as ve:
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /categorie")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /start')
+
+    async def on_leaderboard(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            self.show_view(call, await self.run_db(self.leaderboard_view, call.data))
+        except ValueError as ve:
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /classifica")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /classifica')
+
+    async def on_result_page(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            result = await self.run_db(self.result_page, *result_renderer.decode_page(call.data))
+            if result is None:
+                self.outbox.send_message(chat_id, 'Non ci sono risultati per la tua ricerca... riprova ricominciando da /start')
+                return
+            self.outbox.edit_message_text(result[0], chat_id, call.message.message_id, parse_mode="Markdown", reply_markup=result[1])
+        except ValueError as ve:
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /start")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /start')
+
+    async def on_inline_query(self, inline_query):
+        try:
+            results = await self.run_db(self.inline_search.results, inline_query.query, self.db_dao.search_stores, self.describe_store)
+            self.outbox.answer_inline_query(inline_query.id, results, cache_time=self.inline_cache_time)
+        except Exception as e:
+            BOT_ERRORS.inc()
+            logging.error(f"Error answering inline query '{inline_query.query}': {e}")
+
+    def run(self):
+        self.start_services()
+        try:
+            if self.mode == 'webhook':
+                asyncio.run(self.run_webhook())
+            else:
+                asyncio.run(self.bot.polling())
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def run_webhook(self):
+        loop = asyncio.get_running_loop()
+
+        def dispatch(updates):
+            asyncio.run_coroutine_threadsafe(self.bot.process_new_updates(updates), loop).result()
+
+        server = self.create_webhook_server(dispatch)
+        server.start()
+        webhook_url = os.getenv('WEBHOOK_URL')
+        if webhook_url:
+            await self.bot.set_webhook(url=webhook_url, secret_token=os.getenv('WEBHOOK_SECRET'))
+        await asyncio.Event().wait()
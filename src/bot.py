@@ -1,173 +1,767 @@
-from telebot import types, TeleBot
+import time
+# Inizio dell'avvio, per misurare anche il tempo degli import
+STARTED_AT = time.perf_counter()
+from telebot import types, TeleBot, apihelper
+from telebot.handler_backends import BaseMiddleware
 import os
 from dao import DAO
-from cachetools import TTLCache
+from database import Database
+from session_store import create_session_store
 from database_updater import DatabaseUpdater
 import traceback
 import logging
 from input_validator import InputValidator
 from remote_file_updater import RemoteFileUpdater
+from webhook_server import WebhookServer
+import navigation
+import leaderboard
+import notifications
+from notifications import Notifier
+import result_renderer
+from result_renderer import ResultRenderer
+from inline_search import InlineSearch
+from metrics import REGISTRY, MetricsServer, SamplingProfiler
+from outbound_dispatcher import OutboundDispatcher, OutboundMiddleware
+import threading
 
 CATEGORY_ID = 'category_id'
 CITY_ID = 'city_id'
 NEIGHBORHOOD_ID = 'neighborhood_id'
+STEP = 'step'
+
+STEP_CITY = 'city'
+STEP_NEIGHBORHOOD = 'neighborhood'
+
+# Prefissi del callback_data dei suggerimenti
+CITY_CALLBACK = 'city'
+NEIGHBORHOOD_CALLBACK = 'nbh'
+
+WELCOME_TEXT = "Benvenuto nel bot per la guida dei posti provati da Franchino Er Criminale. \nQuesto bot ti guiderà nella ricerca dei locali attravero tre fasi: categorie, citta, quartiere. Clicca su /categorie per iniziare, oppure inviami la tua posizione per trovare i locali migliori vicino a te"
+CATEGORIES_TEXT = 'Scegli la categoria criminale di interesse:'
+LEADERBOARD_TEXT = 'Scegli la categoria della classifica:'
+
+COMMANDS = {'/start', '/categorie', '/citta', '/quartiere', '/risultati', '/classifica', '/iscriviti', '/disiscriviti'}
+CALLBACK_LABELS = {
+    CITY_CALLBACK: 'callback:city',
+    NEIGHBORHOOD_CALLBACK: 'callback:nbh',
+    navigation.NAVIGATION_PREFIX: 'callback:nav',
+    result_renderer.RESULT_PAGE_PREFIX: 'callback:page',
+    leaderboard.LEADERBOARD_PREFIX: 'callback:rank',
+    notifications.SUBSCRIBE_PREFIX: 'callback:sub',
+    notifications.UNSUBSCRIBE_PREFIX: 'callback:unsub',
+}
+
+HANDLER_SECONDS = REGISTRY.histogram('bot_handler_seconds', 'Time to handle an update, by command or callback', ['handler'])
+HANDLER_ERRORS = REGISTRY.counter('bot_handler_errors_total', 'Updates whose handler raised, by command or callback', ['handler'])
+BOT_ERRORS = REGISTRY.counter('bot_errors_total', 'Errors reported to the users')
 
 logging.basicConfig(level=logging.INFO)
 
+
+def handler_label(update):
+    """Metric label of an update from a fixed set: the command, the callback kind or 'text'"""
+    if isinstance(update, types.InlineQuery):
+        return 'inline'
+    if isinstance(update, types.CallbackQuery):
+        return CALLBACK_LABELS.get((update.data or '').split(':', 1)[0], 'callback:category')
+    if update.content_type == 'location':
+        return 'location'
+    text = update.text or ''
+    if text.startswith('/'):
+        command = text.split()[0].split('@')[0]
+        return command if command in COMMANDS else 'other'
+    return 'text'
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Times every update and logs the ones slower than slow_seconds"""
+    def __init__(self, slow_seconds):
+        super().__init__()
+        self.update_types = ['message', 'callback_query', 'inline_query']
+        self.slow_seconds = slow_seconds
+
+    def pre_process(self, update, data):
+        data['started_at'] = time.perf_counter()
+
+    def post_process(self, update, data, exception):
+        elapsed = time.perf_counter() - data['started_at']
+        label = handler_label(update)
+        HANDLER_SECONDS.observe(elapsed, handler=label)
+        if exception is not None:
+            HANDLER_ERRORS.inc(handler=label)
+        if elapsed >= self.slow_seconds:
+            # I messaggi dei canali non hanno un mittente
+            sender = getattr(update, 'from_user', None)
+            if sender is not None:
+                source = sender.id
+            else:
+                message = getattr(update, 'message', update)
+                source = getattr(getattr(message, 'chat', None), 'id', None)
+            logging.warning(f"Slow update: {label} from {source} handled in {elapsed:.3f}s")
+
+
 class BOT:
     def __init__(self, token):
-        self.bot = TeleBot(token)
-        self.user_data = TTLCache(maxsize=1024, ttl=60)
-        self.db_dao = DAO()
-        self.db_updater = DatabaseUpdater()
+        self.startup_phases = []
+        self._phase_end = STARTED_AT
+        self.startup_phase('imports')
+        # 'polling' (default) oppure 'webhook'
+        self.mode = os.getenv('BOT_MODE', 'polling')
+        self.bot = self.create_bot(token)
+        self.bot.setup_middleware(self.create_metrics_middleware(float(os.getenv('SLOW_UPDATE_SECONDS', '1'))))
+        # Le risposte passano da una coda con i limiti di Telegram: gli handler non attendono l'API
+        self.outbox = self.create_outbox()
+        # Profilatore a campionamento, attivo con PROFILER_INTERVAL > 0 (secondi)
+        profiler_interval = float(os.getenv('PROFILER_INTERVAL', '0'))
+        self.profiler = SamplingProfiler(profiler_interval) if profiler_interval > 0 else None
+        self.startup_phase('bot')
+        # Un solo insieme di pool per DAO, import e sessioni
+        self.database = Database()
+        self.db_dao = DAO(self.database)
+        self.startup_phase('schema')
+        self.user_data = create_session_store(self.db_dao.engine)
+        self.startup_phase('sessions')
+        self.db_updater = DatabaseUpdater(self.database)
+        self.db_updater.add_reload_listener(self.db_dao.refresh_catalog)
+        self.result_renderer = ResultRenderer(int(os.getenv('RESULT_CACHE_SIZE', '1024')))
+        self.db_updater.add_reload_listener(self.result_renderer.invalidate)
+        # Posizione condivisa: i migliori entro NEARBY_RADIUS metri, altrimenti i più vicini entro NEARBY_MAX_DISTANCE
+        self.nearby_radius = float(os.getenv('NEARBY_RADIUS', '1000'))
+        self.nearby_max_distance = float(os.getenv('NEARBY_MAX_DISTANCE', '20000'))
+        self.nearby_results = int(os.getenv('NEARBY_RESULTS', '10'))
+        # Modalità inline: risposte in cache per INLINE_CACHE_TTL secondi qui e INLINE_CACHE_TIME su Telegram
+        self.inline_search = InlineSearch(int(os.getenv('INLINE_RESULTS', '20')), ttl=int(os.getenv('INLINE_CACHE_TTL', '60')))
+        self.db_updater.add_reload_listener(self.inline_search.invalidate)
+        self.inline_cache_time = int(os.getenv('INLINE_CACHE_TIME', '300'))
+        # Avvisi agli iscritti dopo ogni import, al massimo NOTIFY_RATE messaggi al secondo,
+        # sulla stessa coda e con gli stessi limiti di Telegram delle risposte
+        self.max_subscriptions = int(os.getenv('MAX_SUBSCRIPTIONS', '20'))
+        self.notifier = Notifier(
+            self.database.engine, self.outbox, self.db_updater.import_lock,
+            rate=float(os.getenv('NOTIFY_RATE', '20')),
+            max_pending=int(os.getenv('NOTIFY_MAX_PENDING', '60'))
+        )
+        self.db_updater.add_reload_listener(self.notifier.schedule)
         self.remote_file_updater = RemoteFileUpdater()
         self.register_handlers()
+        self.startup_phase('handlers')
+
+    def startup_phase(self, name):
+        """Record the time spent since the previous startup phase"""
+        now = time.perf_counter()
+        self.startup_phases.append((name, now - self._phase_end))
+        self._phase_end = now
+
+    def start_services(self):
+        """Import the registry if needed and start checking the remote file"""
+        self.notifier.start()
+        # Con dati già presenti l'import gira in background e il bot risponde subito
+        self.db_updater.import_on_startup()
+        self.startup_phase('import')
+        self.remote_file_updater.start_periodic_check(callback=self.db_updater.update_from_excel)
+        if self.profiler is not None:
+            self.profiler.start()
+        # Con il webhook le metriche sono servite dallo stesso server
+        metrics_port = os.getenv('METRICS_PORT')
+        if self.mode != 'webhook' and metrics_port:
+            MetricsServer(self.metrics_routes(), port=int(metrics_port)).start()
+        phases = ', '.join(f"{name} {seconds:.3f}s" for name, seconds in self.startup_phases)
+        logging.info(f"Startup completed in {self._phase_end - STARTED_AT:.3f}s: {phases}")
         
+    def create_bot(self, token):
+        # In webhook mode the handlers already run on the WebhookServer workers
+        return TeleBot(token, threaded=self.mode != 'webhook', use_class_middlewares=True)
+
+    @staticmethod
+    def create_dispatcher(bot):
+        dispatcher = OutboundDispatcher(
+            bot,
+            workers=int(os.getenv('OUTBOX_WORKERS', '4')),
+            global_rate=float(os.getenv('OUTBOX_GLOBAL_RATE', '30')),
+            chat_rate=float(os.getenv('OUTBOX_CHAT_RATE', '1')),
+            max_pending=int(os.getenv('OUTBOX_MAX_PENDING', '10000'))
+        )
+        dispatcher.start()
+        return dispatcher
+
+    def create_outbox(self):
+        outbox = self.create_dispatcher(self.bot)
+        self.bot.setup_middleware(OutboundMiddleware(outbox))
+        return outbox
+
+    def create_metrics_middleware(self, slow_seconds):
+        return MetricsMiddleware(slow_seconds)
+
+    def metrics_routes(self):
+        routes = {'/metrics': REGISTRY.handler}
+        if self.profiler is not None:
+            routes['/debug/profile'] = self.profiler.handler
+        return routes
+
+    def create_webhook_server(self, dispatch):
+        server = WebhookServer(
+            dispatch,
+            secret_token=os.getenv('WEBHOOK_SECRET'),
+            port=int(os.getenv('WEBHOOK_PORT', '80')),
+            path=os.getenv('WEBHOOK_PATH', '/webhook'),
+            queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000')),
+            workers=int(os.getenv('WEBHOOK_WORKERS', '8')),
+            enqueue_timeout=float(os.getenv('WEBHOOK_QUEUE_TIMEOUT', '0'))
+        )
+        for path, handler in self.metrics_routes().items():
+            server.add_route(path, handler)
+        REGISTRY.gauge('bot_webhook_queue_depth', 'Updates waiting for a webhook worker', server.queue_depth)
+        return server
+
     def handle_error(self, chat_id, error, message):
+        BOT_ERRORS.inc()
         traceback.print_exc()
         logging.error(f"Error: {error}")
-        self.bot.send_message(chat_id, message)    
+        self.outbox.send_message(chat_id, message)    
         
     def set_user_data(self, chat_id):
-        self.user_data[chat_id] = {CATEGORY_ID: None, CITY_ID: None, NEIGHBORHOOD_ID: None}    
+        self.user_data[chat_id] = {CATEGORY_ID: None, CITY_ID: None, NEIGHBORHOOD_ID: None, STEP: None}    
+
+    def update_user_data(self, chat_id, data_id, value):
+        # Lo stato può vivere fuori dal processo: va letto, modificato e salvato di nuovo
+        state = self.user_data[chat_id]
+        state[data_id] = value
+        self.user_data[chat_id] = state
 
     def set_user_category(self, chat_id, category_id):
-        self.user_data[chat_id][CATEGORY_ID] = category_id 
+        self.update_user_data(chat_id, CATEGORY_ID, category_id)
     
     def set_user_city(self, chat_id, city_id):
-        self.user_data[chat_id][CITY_ID] = city_id         
+        self.update_user_data(chat_id, CITY_ID, city_id)
     
     def set_user_neighborhood(self, chat_id, neighborhood_id):
-        self.user_data[chat_id][NEIGHBORHOOD_ID] = neighborhood_id
+        self.update_user_data(chat_id, NEIGHBORHOOD_ID, neighborhood_id)
+
+    def set_user_step(self, chat_id, step):
+        self.update_user_data(chat_id, STEP, step)
+
+    def get_user_step(self, chat_id):
+        state = self.user_data.get(chat_id)
+        return state[STEP] if state else None
+
+    def pop_user_step(self, chat_id):
+        step = self.get_user_step(chat_id)
+        if step is not None:
+            self.set_user_step(chat_id, None)
+        return step
     
     def get_user_data(self, chat_id, data_id):
         return self.user_data[chat_id][data_id]        
+
+    @staticmethod
+    def category_label(category):
+        return category.title.capitalize()
+
+    def categories_markup(self):
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        markup.add(*[types.InlineKeyboardButton(self.category_label(category), callback_data=str(category.id))
+                     for category in self.db_dao.get_categories()])
+        return markup
+
+    def paged_markup(self, items, page, item_callback, page_callback, back_callback):
+        items, page, has_prev, has_next = navigation.paginate(items, page)
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        markup.add(*[types.InlineKeyboardButton(item.name, callback_data=item_callback(item)) for item in items])
+        controls = []
+        if has_prev:
+            controls.append(types.InlineKeyboardButton('«', callback_data=page_callback(page - 1)))
+        controls.append(types.InlineKeyboardButton('Indietro', callback_data=back_callback))
+        if has_next:
+            controls.append(types.InlineKeyboardButton('»', callback_data=page_callback(page + 1)))
+        markup.row(*controls)
+        return markup
+
+    def cities_markup(self, tree, category_id, page):
+        return self.paged_markup(
+            tree.cities(category_id), page,
+            lambda city: navigation.encode(navigation.NEIGHBORHOODS, category_id, city.id, 0),
+            lambda p: navigation.encode(navigation.CITIES, category_id, p),
+            navigation.encode(navigation.CATEGORIES)
+        )
+
+    def neighborhoods_markup(self, tree, category_id, city_id, page):
+        return self.paged_markup(
+            tree.neighborhoods(category_id, city_id), page,
+            lambda neighborhood: navigation.encode(navigation.RESULTS, category_id, neighborhood.id),
+            lambda p: navigation.encode(navigation.NEIGHBORHOODS, category_id, city_id, p),
+            navigation.encode(navigation.CITIES, category_id, 0)
+        )
+
+    def select_category(self, chat_id, data):
+        """Store the category chosen with a button and return the reply (text, markup)"""
+        categories = {category.id: category for category in self.db_dao.get_categories()}
+        category_id = InputValidator.validate_category_id(data, categories)
+        if chat_id not in self.user_data:
+            self.set_user_data(chat_id)
+        self.set_user_category(chat_id, category_id)
+        msg = f'Hai selezionato {self.category_label(categories[category_id])}'
+        tree = self.db_dao.get_navigation()
+        if tree is not None and tree.cities(category_id):
+            return msg + '. Scegli la città qui sotto oppure clicca su /citta', self.cities_markup(tree, category_id, 0)
+        return msg + '. Ora clicca su /citta', None
+
+    def navigation_view(self, data):
+        """Return (text, markup, is_result) for a navigation callback, raising ValueError if invalid"""
+        tree = self.db_dao.get_navigation()
+        if tree is None:
+            raise ValueError("Navigazione non disponibile")
+        kind, args = tree.resolve(data)
+        if kind == navigation.CATEGORIES:
+            return CATEGORIES_TEXT, self.categories_markup(), False
+        if kind == navigation.CITIES:
+            category_id, page = args
+            return 'Scegli la città:', self.cities_markup(tree, category_id, page), False
+        if kind == navigation.NEIGHBORHOODS:
+            category_id, city_id, page = args
+            return 'Scegli il quartiere:', self.neighborhoods_markup(tree, category_id, city_id, page), False
+        if kind == navigation.RESULTS:
+            category_id, neighborhood_id = args
+            result = self.result_page(neighborhood_id, category_id)
+            if result is None:
+                return 'Non ci sono risultati per la tua ricerca... riprova ricominciando da /start', None, True
+            return result[0], result[1], True
+        raise ValueError("Comando di navigazione non valido")
+
+    def show_view(self, call, view):
+        """Send a (text, markup, is_result) view: results as a new message, menus in place of the pressed one"""
+        text, markup, is_result = view
+        chat_id = call.message.chat.id
+        if is_result:
+            self.outbox.send_message(chat_id, text, parse_mode="Markdown", reply_markup=markup)
+        else:
+            self.outbox.edit_message_text(text, chat_id, call.message.message_id, reply_markup=markup)
+
+    def leaderboard_categories_markup(self):
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        markup.add(*[types.InlineKeyboardButton(self.category_label(category),
+                                                callback_data=leaderboard.encode(leaderboard.CITIES, category.id, 0))
+                     for category in self.db_dao.get_categories()])
+        return markup
+
+    def render_leaderboard(self, category_id, city_id):
+        """Text of the ranking of a category in a city, followed by the statistics of its neighborhoods"""
+        stores = self.db_dao.get_ranking(city_id, category_id)
+        if not stores:
+            return None
+        category = next((c for c in self.db_dao.get_categories() if c.id == category_id), None)
+        city = self.db_dao.get_city(city_id)
+        label = self.category_label(category) if category else 'dei locali'
+        title = f"*Classifica {result_renderer.escape_markdown(label)} a {result_renderer.escape_markdown(city.name)}*\n\n"
+        blocks = []
+        for position, store in enumerate(stores, 1):
+            neighborhood = self.db_dao.get_neighborhood(store.neighborhood_id)
+            place = f" ({result_renderer.escape_markdown(neighborhood.name)})" if neighborhood else ''
+            blocks.append(f"{position}. {result_renderer.escape_markdown(result_renderer.shorten(store.name, result_renderer.MAX_NAME_LENGTH))}{place} - voto {store.vote}{' pieno' if store.full_vote else ''}\n")
+        blocks.append("\n*Quartieri*\n")
+        for stats in self.db_dao.get_neighborhood_stats(city_id, category_id):
+            neighborhood = self.db_dao.get_neighborhood(stats.neighborhood_id)
+            if neighborhood is None:
+                continue
+            blocks.append(f"{result_renderer.escape_markdown(neighborhood.name)}: media {stats.average_vote:.1f} su {stats.store_count} "
+                          f"{'locale' if stats.store_count == 1 else 'locali'}, {stats.full_vote_share:.0%} con voto pieno\n")
+        return title + self.result_renderer.split(blocks)[0]
+
+    def leaderboard_view(self, data):
+        """Return (text, markup, is_result) for a leaderboard callback, raising ValueError if invalid"""
+        kind, args = leaderboard.decode(data)
+        if kind == leaderboard.CATEGORIES:
+            return LEADERBOARD_TEXT, self.leaderboard_categories_markup(), False
+        if kind == leaderboard.CITIES:
+            category_id, page = args
+            markup = self.paged_markup(
+                self.db_dao.get_ranked_cities(category_id), page,
+                lambda city: leaderboard.encode(leaderboard.RANKING, category_id, city.id),
+                lambda p: leaderboard.encode(leaderboard.CITIES, category_id, p),
+                leaderboard.encode(leaderboard.CATEGORIES)
+            )
+            return 'Scegli la città della classifica:', markup, False
+        if kind == leaderboard.RANKING:
+            category_id, city_id = args
+            text = self.render_leaderboard(category_id, city_id)
+            if text is None:
+                return 'Non ci sono ancora locali in classifica... riprova più tardi da /classifica', None, True
+            return text, None, True
+        raise ValueError("Classifica non valida")
+
+    def subscription_label(self, neighborhood_id, category_id):
+        """'Pizzerie a Trastevere (Roma)', None if the neighborhood or the category no longer exist"""
+        neighborhood = self.db_dao.get_neighborhood(neighborhood_id)
+        category = next((c for c in self.db_dao.get_categories() if c.id == category_id), None)
+        if neighborhood is None or category is None:
+            return None
+        city = self.db_dao.get_city(neighborhood.city_id)
+        return f"{self.category_label(category)} a {neighborhood.name}" + (f" ({city.name})" if city else '')
+
+    def subscribe(self, chat_id, neighborhood_id, category_id):
+        """Subscribe a chat and return the reply, raising ValueError if the neighborhood or category do not exist"""
+        label = self.subscription_label(neighborhood_id, category_id)
+        if label is None:
+            raise ValueError("Quartiere o categoria non trovati")
+        if not self.db_dao.subscribe(chat_id, neighborhood_id, category_id, self.max_subscriptions):
+            return f"Hai già {self.max_subscriptions} iscrizioni: togline una con /disiscriviti"
+        return f"Ti avviserò quando arrivano nuovi locali o cambiano i voti: {label}"
+
+    def subscriptions_view(self, chat_id):
+        """Return (text, markup) listing the subscriptions of a chat, each with a button removing it"""
+        buttons = []
+        for subscription in self.db_dao.get_subscriptions(chat_id):
+            label = self.subscription_label(subscription.neighborhood_id, subscription.criminal_category_id)
+            data = notifications.encode(notifications.UNSUBSCRIBE_PREFIX, subscription.neighborhood_id,
+                                        subscription.criminal_category_id)
+            buttons.append(types.InlineKeyboardButton(f"Annulla: {label or 'quartiere non più presente'}", callback_data=data))
+        if not buttons:
+            return 'Non hai iscrizioni. Per riceverne una, usa il pulsante sotto i risultati di una ricerca', None
+        markup = types.InlineKeyboardMarkup(row_width=1)
+        markup.add(*buttons)
+        return 'Scegli gli avvisi che non vuoi più ricevere:', markup
+
+    def suggestions_markup(self, prefix, items):
+        markup = types.InlineKeyboardMarkup(row_width=1)
+        markup.add(*[types.InlineKeyboardButton(item.name, callback_data=f'{prefix}:{item.id}') for item in items])
+        return markup
+
+    def result_page(self, neighborhood_id, category_id, page=0):
+        """Return (text, markup) of a page of results, or None if there are no stores"""
+        pages = self.result_renderer.pages(neighborhood_id, category_id, self.db_dao.get_stores)
+        if not pages:
+            return None
+        page = min(max(page, 0), len(pages) - 1)
+        msg_result = pages[page]
+        markup = None
+        if len(pages) > 1:
+            msg_result += f"Pagina {page + 1} di {len(pages)}\n"
+            buttons = []
+            if page > 0:
+                buttons.append(types.InlineKeyboardButton('« Pagina precedente', callback_data=result_renderer.encode_page(neighborhood_id, category_id, page - 1)))
+            if page < len(pages) - 1:
+                buttons.append(types.InlineKeyboardButton('Pagina successiva »', callback_data=result_renderer.encode_page(neighborhood_id, category_id, page + 1)))
+            markup = types.InlineKeyboardMarkup()
+            markup.row(*buttons)
+        if page == len(pages) - 1:
+            msg_result += "Se vuoi fare un'altra ricerca, ricomincia da /start"
+        if markup is None:
+            markup = types.InlineKeyboardMarkup()
+        markup.row(types.InlineKeyboardButton('Avvisami dei nuovi locali', callback_data=notifications.encode(
+            notifications.SUBSCRIBE_PREFIX, neighborhood_id, category_id)))
+        return msg_result, markup
             
+    def nearby_view(self, chat_id, latitude, longitude):
+        """Return the reply to a shared location, None if there are no stores nearby"""
+        try:
+            category_id = self.get_user_data(chat_id, CATEGORY_ID)
+        except KeyError:
+            category_id = None
+        found = self.db_dao.best_stores_near(latitude, longitude, self.nearby_radius, self.nearby_results, category_id)
+        if found:
+            header = f"I locali migliori entro {result_renderer.format_distance(self.nearby_radius)} da te:\n\n"
+        else:
+            found = self.db_dao.nearest_stores(latitude, longitude, self.nearby_max_distance, self.nearby_results, category_id)
+            if not found:
+                return None
+            header = f"Nessun locale entro {result_renderer.format_distance(self.nearby_radius)}, ecco i più vicini:\n\n"
+        blocks = [f"*A {result_renderer.format_distance(meters)}*: " + self.result_renderer.render_store(store) for meters, store in found]
+        return header + self.result_renderer.split(blocks)[0] + "Se vuoi fare un'altra ricerca, ricomincia da /start"
+
+    def describe_store(self, store):
+        """Description line of a store in the inline results: where it is and its vote"""
+        neighborhood = self.db_dao.get_neighborhood(store.neighborhood_id)
+        city = self.db_dao.get_city(neighborhood.city_id) if neighborhood else None
+        place = ', '.join(item.name for item in (neighborhood, city) if item is not None)
+        return f"{place} - voto {store.vote}" if place else f"Voto {store.vote}"
+
+    def handlers(self):
+        """(registration method, filters, handler) of every update the bot answers, in matching order"""
+        def callback_prefix(*prefixes):
+            prefixes = tuple(prefix + ':' for prefix in prefixes)
+            return lambda call: call.data.startswith(prefixes)
+
+        return [
+            # Registered first: a pending step takes the text that follows, like a next step handler
+            ('message_handler', {'func': self.has_pending_step}, self.on_pending_step),
+            ('message_handler', {'commands': ['start']}, self.on_start),
+            ('message_handler', {'commands': ['categorie']}, self.on_categories),
+            ('callback_query_handler', {'func': callback_prefix(CITY_CALLBACK, NEIGHBORHOOD_CALLBACK)}, self.on_suggestion),
+            ('callback_query_handler', {'func': callback_prefix(navigation.NAVIGATION_PREFIX)}, self.on_navigation),
+            ('callback_query_handler', {'func': callback_prefix(result_renderer.RESULT_PAGE_PREFIX)}, self.on_result_page),
+            ('callback_query_handler', {'func': callback_prefix(leaderboard.LEADERBOARD_PREFIX)}, self.on_leaderboard),
+            ('callback_query_handler', {'func': callback_prefix(notifications.SUBSCRIBE_PREFIX)}, self.on_subscribe),
+            ('callback_query_handler', {'func': callback_prefix(notifications.UNSUBSCRIBE_PREFIX)}, self.on_unsubscribe),
+            ('callback_query_handler', {'func': lambda call: True}, self.on_category),
+            ('message_handler', {'commands': ['classifica']}, self.on_leaderboard_command),
+            ('message_handler', {'commands': ['iscriviti']}, self.on_subscribe_command),
+            ('message_handler', {'commands': ['disiscriviti']}, self.on_unsubscribe_command),
+            ('message_handler', {'commands': ['citta']}, self.on_city_command),
+            ('message_handler', {'commands': ['quartiere']}, self.on_neighborhood_command),
+            ('message_handler', {'commands': ['risultati']}, self.on_results_command),
+            ('message_handler', {'content_types': ['location']}, self.on_location),
+            ('inline_handler', {'func': lambda query: True}, self.on_inline_query),
+        ]
+
     def register_handlers(self):
-        @self.bot.message_handler(commands=['start'])
-        def send_welcome(message):
-            self.set_user_data(message.chat.id)
-            self.bot.reply_to(message, "Benvenuto nel bot per la guida dei posti provati da Franchino Er Criminale. \nQuesto bot ti guiderà nella ricerca dei locali attravero tre fasi: categorie, citta, quartiere. Clicca su /categorie per iniziare")
-
-        @self.bot.message_handler(commands=['categorie'])
-        def categories_command(message):
-            markup = types.InlineKeyboardMarkup(row_width=2)
-            button1 = types.InlineKeyboardButton('Gelaterie', callback_data='1')
-            button2 = types.InlineKeyboardButton('Forni', callback_data='2')
-            button3 = types.InlineKeyboardButton('Rosticcerie', callback_data='3')
-            button4 = types.InlineKeyboardButton('Panini', callback_data='4')
-            button5 = types.InlineKeyboardButton('Pizza a taglio', callback_data='5')
-            button6 = types.InlineKeyboardButton('Pizza tonda', callback_data='6')
-            button7 = types.InlineKeyboardButton('Pasticceria', callback_data='7')
-            button8 = types.InlineKeyboardButton('Tramezzini', callback_data='8')
-            button9 = types.InlineKeyboardButton('Piadine', callback_data='9')
-            button10 = types.InlineKeyboardButton('Fritti', callback_data='10')
-            markup.add(button1, button2, button3, button4, button5, button6, button7, button8, button9, button10)
-            self.bot.send_message(message.chat.id, 'Scegli la categoria criminale di interesse:', reply_markup=markup)  
-
-        @self.bot.callback_query_handler(func=lambda call: True)
-        def callback_query(call):
-            try:
-                category_id = InputValidator.validate_category_id(call.data)
-                
-                category_messages = {
-                    1: 'Gelaterie', 2: 'Forni', 3: 'Rosticcerie', 4: 'Panini', 5: 'Pizza a taglio',
-                    6: 'Pizza tonda', 7: 'Pasticceria', 8: 'Tramezzini', 9: 'Piadine', 10: 'Fritti'
-                }
-                
-                msg = f'Hai selezionato {category_messages[category_id]}'
-                self.set_user_category(call.message.chat.id, category_id)
-                self.bot.send_message(call.message.chat.id, msg + '. Ora clicca su /citta')    
-                
-            except ValueError as ve:
-                self.bot.send_message(call.message.chat.id, f"Errore: {str(ve)}. Riprova /categorie")    
-
-
-        @self.bot.message_handler(commands=['citta'])
-        def city_command(message):
-            sent_msg = self.bot.send_message(message.chat.id, "Inserisci la città di interesse:")
-            self.bot.register_next_step_handler(sent_msg, city_handler)
-
-        def city_handler(message):
-            try:
-                city = InputValidator.validate_name(message.text)
-                foundCity = self.db_dao.find_city(city)
-                if foundCity is not None:
-                    self.set_user_city(message.chat.id, foundCity.id)
-                    self.bot.send_message(message.chat.id, f"Hai inserito: {city}. Ora clicca /quartiere")
+        for kind, filters, handler in self.handlers():
+            getattr(self.bot, kind)(**filters)(handler)
+
+    def has_pending_step(self, message):
+        if (message.text or '').startswith('/'):
+            # Un comando annulla il passo in attesa e arriva al suo handler
+            self.pop_user_step(message.chat.id)
+            return False
+        return self.get_user_step(message.chat.id) is not None
+
+    def on_pending_step(self, message):
+        step = self.pop_user_step(message.chat.id)
+        if step == STEP_CITY:
+            self.on_city(message)
+        elif step == STEP_NEIGHBORHOOD:
+            self.on_neighborhood(message)
+
+    def on_start(self, message):
+        self.set_user_data(message.chat.id)
+        self.outbox.reply_to(message, WELCOME_TEXT)
+
+    def on_categories(self, message):
+        self.outbox.send_message(message.chat.id, CATEGORIES_TEXT, reply_markup=self.categories_markup())
+
+    def on_suggestion(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            prefix, item_id = call.data.split(':', 1)
+            if prefix == CITY_CALLBACK:
+                city = self.db_dao.get_city(int(item_id))
+                self.set_user_city(chat_id, city.id)
+                self.outbox.send_message(chat_id, f"Hai inserito: {city.name}. Ora clicca /quartiere")
+            else:
+                neighborhood = self.db_dao.get_neighborhood(int(item_id))
+                self.set_user_neighborhood(chat_id, neighborhood.id)
+                self.outbox.send_message(chat_id, f"Hai inserito: {neighborhood.name}.\nOra clicca /risultati per avere la lista dei locali relativi alle tue scelte, ordinati per voto")
+        except KeyError as ke:
+            self.handle_error(chat_id, ke, 'Dati inconsistenti, forse è passato troppo tempo o hai saltato un passaggio... riprova ricominciando da /start')
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /start')
+
+    def on_navigation(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            self.show_view(call, self.navigation_view(call.data))
+        except ValueError as ve:
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /categorie")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /start')
+
+    def on_result_page(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            result = self.result_page(*result_renderer.decode_page(call.data))
+            if result is None:
+                self.outbox.send_message(chat_id, 'Non ci sono risultati per la tua ricerca... riprova ricominciando da /start')
+                return
+            self.outbox.edit_message_text(result[0], chat_id, call.message.message_id, parse_mode="Markdown", reply_markup=result[1])
+        except ValueError as ve:
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /start")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /start')
+
+    def on_leaderboard(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            self.show_view(call, self.leaderboard_view(call.data))
+        except ValueError as ve:
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /classifica")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /classifica')
+
+    def on_subscribe(self, call):
+        chat_id = call.message.chat.id
+        try:
+            text = self.subscribe(chat_id, *notifications.decode(call.data))
+            # Telegram accetta al massimo 200 caratteri
+            self.outbox.answer_callback_query(call.id, text[:200], show_alert=True)
+        except ValueError as ve:
+            self.outbox.answer_callback_query(call.id)
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /start")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /start')
+
+    def on_unsubscribe(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            self.db_dao.unsubscribe(chat_id, *notifications.decode(call.data))
+            text, markup = self.subscriptions_view(chat_id)
+            self.outbox.edit_message_text(text, chat_id, call.message.message_id, reply_markup=markup)
+        except ValueError as ve:
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /disiscriviti")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /disiscriviti')
+
+    def on_category(self, call):
+        chat_id = call.message.chat.id
+        try:
+            self.outbox.answer_callback_query(call.id)
+            msg, markup = self.select_category(chat_id, call.data)
+            self.outbox.send_message(chat_id, msg, reply_markup=markup)
+        except ValueError as ve:
+            self.outbox.send_message(chat_id, f"Errore: {str(ve)}. Riprova /categorie")
+        except Exception as e:
+            self.handle_error(chat_id, e, 'Si è verificato un errore... riprova /start')
+
+    def on_leaderboard_command(self, message):
+        self.outbox.send_message(message.chat.id, LEADERBOARD_TEXT, reply_markup=self.leaderboard_categories_markup())
+
+    def on_subscribe_command(self, message):
+        try:
+            category_id = self.get_user_data(message.chat.id, CATEGORY_ID)
+            neighborhood_id = self.get_user_data(message.chat.id, NEIGHBORHOOD_ID)
+        except KeyError:
+            category_id = neighborhood_id = None
+        if category_id is None or neighborhood_id is None:
+            self.outbox.send_message(message.chat.id, 'Scegli prima categoria, città e quartiere da /start, poi clicca /iscriviti')
+            return
+        try:
+            self.outbox.send_message(message.chat.id, self.subscribe(message.chat.id, neighborhood_id, category_id))
+        except ValueError as ve:
+            self.outbox.send_message(message.chat.id, f"Errore: {str(ve)}. Riprova /start")
+        except Exception as e:
+            self.handle_error(message.chat.id, e, 'Si è verificato un errore... riprova /start')
+
+    def on_unsubscribe_command(self, message):
+        try:
+            text, markup = self.subscriptions_view(message.chat.id)
+            self.outbox.send_message(message.chat.id, text, reply_markup=markup)
+        except Exception as e:
+            self.handle_error(message.chat.id, e, 'Si è verificato un errore... riprova /disiscriviti')
+
+    def on_city_command(self, message):
+        try:
+            self.set_user_step(message.chat.id, STEP_CITY)
+        except KeyError:
+            self.outbox.send_message(message.chat.id, 'Dati inconsistenti, forse è passato troppo tempo o hai saltato un passaggio... riprova ricominciando da /start')
+            return
+        self.outbox.send_message(message.chat.id, "Inserisci la città di interesse:")
+
+    def on_city(self, message):
+        try:
+            city = InputValidator.validate_name(message.text)
+            foundCity = self.db_dao.find_city(city)
+            if foundCity is not None:
+                self.set_user_city(message.chat.id, foundCity.id)
+                self.outbox.send_message(message.chat.id, f"Hai inserito: {city}. Ora clicca /quartiere")
+            else:
+                suggestions = self.db_dao.suggest_cities(city)
+                if suggestions:
+                    self.outbox.send_message(message.chat.id, 'Nessuna città trovata con questo nome, forse intendevi:', reply_markup=self.suggestions_markup(CITY_CALLBACK, suggestions))
                 else:
-                    self.bot.send_message(message.chat.id, 'Nessuna città presente... riprova /citta') 
-            except ValueError as ve:
-                self.handle_error(message.chat.id, ve, str(ve)+' Riprova da /citta')        
-            except KeyError as ke:
-                self.handle_error(message.chat.id, ke, 'Dati inconsistenti, forse è passato troppo tempo o hai saltato un passaggio... riprova ricominciando da /start')
-                self.user_data.pop(message.chat.id)
-            except Exception as e:
-                self.handle_error(message.chat.id, e, 'Si è verificato un errore... riprova /start') 
-                self.user_data.pop(message.chat.id)
-
-        @self.bot.message_handler(commands=['quartiere'])
-        def neighborhood_command(message):
-            sent_msg = self.bot.send_message(message.chat.id, "Inserisci il quartiere di interesse")
-            self.bot.register_next_step_handler(sent_msg, neighborhood_handler)
-
-        def neighborhood_handler(message):
-            try:
-                neighborhood = InputValidator.validate_name(message.text)
-                city_id = self.get_user_data(message.chat.id, CITY_ID)
-                foundNeighborhood = self.db_dao.find_neighborhood(neighborhood, city_id)
-                if foundNeighborhood is not None:
-                    self.set_user_neighborhood(message.chat.id, foundNeighborhood.id)
-                    self.bot.send_message(message.chat.id, f"Hai inserito: {neighborhood}.\nOra clicca /risultati per avere la lista dei locali relativi alle tue scelte, ordinati per voto")  
+                    self.outbox.send_message(message.chat.id, 'Nessuna città presente... riprova /citta')
+        except ValueError as ve:
+            self.handle_error(message.chat.id, ve, str(ve)+' Riprova da /citta')
+        except KeyError as ke:
+            self.handle_error(message.chat.id, ke, 'Dati inconsistenti, forse è passato troppo tempo o hai saltato un passaggio... riprova ricominciando da /start')
+            self.user_data.pop(message.chat.id, None)
+        except Exception as e:
+            self.handle_error(message.chat.id, e, 'Si è verificato un errore... riprova /start')
+            self.user_data.pop(message.chat.id, None)
+
+    def on_neighborhood_command(self, message):
+        try:
+            self.set_user_step(message.chat.id, STEP_NEIGHBORHOOD)
+        except KeyError:
+            self.outbox.send_message(message.chat.id, 'Dati inconsistenti, forse è passato troppo tempo o hai saltato un passaggio... riprova ricominciando da /start')
+            return
+        self.outbox.send_message(message.chat.id, "Inserisci il quartiere di interesse")
+
+    def on_neighborhood(self, message):
+        try:
+            neighborhood = InputValidator.validate_name(message.text)
+            city_id = self.get_user_data(message.chat.id, CITY_ID)
+            foundNeighborhood = self.db_dao.find_neighborhood(neighborhood, city_id)
+            if foundNeighborhood is not None:
+                self.set_user_neighborhood(message.chat.id, foundNeighborhood.id)
+                self.outbox.send_message(message.chat.id, f"Hai inserito: {neighborhood}.\nOra clicca /risultati per avere la lista dei locali relativi alle tue scelte, ordinati per voto")
+            else:
+                suggestions = self.db_dao.suggest_neighborhoods(neighborhood, city_id)
+                if suggestions:
+                    self.outbox.send_message(message.chat.id, 'Nessun quartiere trovato con questo nome, forse intendevi:', reply_markup=self.suggestions_markup(NEIGHBORHOOD_CALLBACK, suggestions))
                 else:
-                    self.bot.send_message(message.chat.id, 'Non è stato trovato alcun quartiere... \nriprova /quartiere')   
-            except ValueError as ve:
-                self.handle_error(message.chat.id, ve, str(ve)+' Riprova da /quartiere')      
-                self.bot.register_next_step_handler('Riprovare', neighborhood_handler)    
-            except KeyError as ke:
-                self.handle_error(message.chat.id, ke, 'Dati inconsistenti, forse è passato troppo tempo o hai saltato un passaggio... riprova ricominciando da /start')
-                self.user_data.pop(message.chat.id)
-            except Exception as e:
-                self.handle_error(message.chat.id, e, 'Si è verificato un errore... riprova /start')   
-                self.user_data.pop(message.chat.id)
-
-        @self.bot.message_handler(commands=['risultati'])
-        def result_command(message):
-            cat_id = None
-            nei_id = None
-            msg_result = ''
-            stores = []
-            try:
-                cat_id = self.get_user_data(message.chat.id, CATEGORY_ID)
-                nei_id = self.get_user_data(message.chat.id, NEIGHBORHOOD_ID)
-            except Exception as e:
-                self.bot.send_message(message.chat.id, 'Dati inconsistenti, forse è passato troppo tempo o hai saltato un passaggio... riprova ricominciando da /start')
-                return
-            stores = self.db_dao.get_stores(nei_id, cat_id)
-            if len(stores) == 0:
-                del self.user_data[message.chat.id]
-                self.bot.send_message(message.chat.id, 'Non ci sono risultati per la tua ricerca... riprova ricominciando da /start')
+                    self.outbox.send_message(message.chat.id, 'Non è stato trovato alcun quartiere... \nriprova /quartiere')
+        except ValueError as ve:
+            self.handle_error(message.chat.id, ve, str(ve)+' Riprova da /quartiere')
+        except KeyError as ke:
+            self.handle_error(message.chat.id, ke, 'Dati inconsistenti, forse è passato troppo tempo o hai saltato un passaggio... riprova ricominciando da /start')
+            self.user_data.pop(message.chat.id, None)
+        except Exception as e:
+            self.handle_error(message.chat.id, e, 'Si è verificato un errore... riprova /start')
+            self.user_data.pop(message.chat.id, None)
+
+    def on_results_command(self, message):
+        try:
+            cat_id = self.get_user_data(message.chat.id, CATEGORY_ID)
+            nei_id = self.get_user_data(message.chat.id, NEIGHBORHOOD_ID)
+        except Exception:
+            self.outbox.send_message(message.chat.id, 'Dati inconsistenti, forse è passato troppo tempo o hai saltato un passaggio... riprova ricominciando da /start')
+            return
+        result = self.result_page(nei_id, cat_id)
+        self.user_data.pop(message.chat.id, None)
+        if result is None:
+            self.outbox.send_message(message.chat.id, 'Non ci sono risultati per la tua ricerca... riprova ricominciando da /start')
+            return
+        msg_result, markup = result
+        self.outbox.send_message(message.chat.id, msg_result, parse_mode="Markdown", reply_markup=markup)
+
+    def on_location(self, message):
+        try:
+            msg = self.nearby_view(message.chat.id, message.location.latitude, message.location.longitude)
+            if msg is None:
+                self.outbox.send_message(message.chat.id, 'Non ci sono locali vicino a te... prova la ricerca per città da /start')
                 return
-            for store in stores:
-                msg_result += f"{store.name}\nin {store.address} con voto: {store.vote}{' pieno' if store.full_vote else ''}\n"
-                if store.comment and store.comment.strip() and store.comment != 'NaN':
-                    msg_result += f"Commento: {store.comment}\n"
-                if store.maps_link and store.maps_link.strip():
-                    msg_result += f"[Apri in Google Maps]({store.maps_link})\n"
-                msg_result += "\n\n"
-            msg_result += "Se vuoi fare un'altra ricerca, ricomincia da /start"    
-            self.user_data.pop(message.chat.id)
-            self.bot.send_message(message.chat.id, msg_result, parse_mode="Markdown")
+            self.outbox.send_message(message.chat.id, msg, parse_mode="Markdown", disable_web_page_preview=True)
+        except Exception as e:
+            self.handle_error(message.chat.id, e, 'Si è verificato un errore... riprova /start')
+
+    def on_inline_query(self, inline_query):
+        try:
+            results = self.inline_search.results(inline_query.query, self.db_dao.search_stores, self.describe_store)
+            # Corsia propria fuori dai limiti dei messaggi, ma con i retry della coda
+            self.outbox.answer_inline_query(inline_query.id, results, cache_time=self.inline_cache_time)
+        except Exception as e:
+            BOT_ERRORS.inc()
+            logging.error(f"Error answering inline query '{inline_query.query}': {e}")
 
     def run(self):
-        self.db_updater.pre_populateDB()
-        self.remote_file_updater.start_periodic_check(callback=self.db_updater.update_from_excel)
-        self.bot.polling()
+        self.start_services()
+        if self.mode == 'webhook':
+            self.run_webhook()
+        else:
+            self.bot.polling()
+
+    def run_webhook(self):
+        server = self.create_webhook_server(self.bot.process_new_updates)
+        server.start()
+        webhook_url = os.getenv('WEBHOOK_URL')
+        if webhook_url:
+            self.bot.set_webhook(url=webhook_url, secret_token=os.getenv('WEBHOOK_SECRET'))
+        threading.Event().wait()
 
 if __name__ == '__main__':
     token = os.getenv('BOT_TOKEN')
+    api_url = os.getenv('TELEGRAM_API_URL')
+    if api_url:
+        # Permette di puntare il bot a un server Bot API locale o finto
+        apihelper.API_URL = api_url.rstrip('/') + '/bot{0}/{1}'
     if token:
-        bot_instance = BOT(token)
+        if os.getenv('BOT_RUNTIME', 'sync') == 'async':
+            from async_bot import AsyncBOT
+            bot_instance = AsyncBOT(token)
+        else:
+            bot_instance = BOT(token)
         bot_instance.run()
     else:
         print("BOT_TOKEN environment variable not set.")
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, Boolean, Text, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, DateTime, Float, Boolean, Text, ForeignKey, Index, func
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -33,6 +33,8 @@ class Store(Base):
     address = Column(String, nullable=False)
     vote = Column(Float, nullable=False)
     maps_link = Column(String, nullable=True)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
     full_vote = Column(Boolean, nullable=True)
     comment = Column(Text, nullable=True)
     created_at = Column(DateTime, nullable=False)
@@ -40,4 +42,75 @@ class Store(Base):
     criminal_category_id = Column(Integer, ForeignKey('criminal_category.id'), nullable=False)
     neighborhood_id = Column(Integer, ForeignKey('neighborhood.id'), nullable=False)
 
+# Indici delle query del DAO, creati sui database esistenti da schema_migrations
+Index('ix_store_neighborhood_category_vote', Store.neighborhood_id, Store.criminal_category_id, Store.vote.desc())
+Index('ix_city_lower_name', func.lower(City.name))
+Index('ix_neighborhood_city_lower_name', Neighborhood.city_id, func.lower(Neighborhood.name))
 
+class CityRanking(Base):
+    __tablename__ = 'city_ranking'
+    city_id = Column(Integer, primary_key=True, autoincrement=False)
+    criminal_category_id = Column(Integer, primary_key=True, autoincrement=False)
+    position = Column(Integer, primary_key=True, autoincrement=False)
+    store_id = Column(Integer, nullable=False)
+    vote = Column(Float, nullable=False)
+
+class NeighborhoodStats(Base):
+    __tablename__ = 'neighborhood_stats'
+    neighborhood_id = Column(Integer, primary_key=True, autoincrement=False)
+    criminal_category_id = Column(Integer, primary_key=True, autoincrement=False)
+    city_id = Column(Integer, nullable=False)
+    store_count = Column(Integer, nullable=False)
+    average_vote = Column(Float, nullable=False)
+    full_vote_share = Column(Float, nullable=False)
+
+# Le classifiche si leggono per città e categoria
+Index('ix_neighborhood_stats_city_category', NeighborhoodStats.city_id, NeighborhoodStats.criminal_category_id)
+
+class Subscription(Base):
+    __tablename__ = 'subscription'
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    neighborhood_id = Column(Integer, primary_key=True, autoincrement=False)
+    criminal_category_id = Column(Integer, primary_key=True, autoincrement=False)
+    created_at = Column(DateTime, nullable=False)
+
+# Gli avvisi cercano gli iscritti per quartiere e categoria dei locali cambiati
+Index('ix_subscription_neighborhood_category', Subscription.neighborhood_id, Subscription.criminal_category_id)
+
+class NotifiedStore(Base):
+    __tablename__ = 'notified_store'
+    store_id = Column(Integer, primary_key=True, autoincrement=False)
+    vote = Column(Float, nullable=False)
+    neighborhood_id = Column(Integer)
+    criminal_category_id = Column(Integer)
+
+class ImportRowHash(Base):
+    __tablename__ = 'import_row_hash'
+    sheet = Column(String, primary_key=True)
+    row_id = Column(Integer, primary_key=True)
+    row_hash = Column(String(32), nullable=False)
+
+class ConversationState(Base):
+    __tablename__ = 'conversation_state'
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    state = Column(String, nullable=False)
+    expires_at = Column(Float, nullable=False, index=True)
+
+class RegistryVersion(Base):
+    __tablename__ = 'registry_version'
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    store_count = Column(Integer, nullable=False)
+    active = Column(Boolean, nullable=False, default=False)
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime, nullable=False)
+
+class RegistryImport(Base):
+    __tablename__ = 'registry_import'
+    id = Column(Integer, primary_key=True)
+    file_hash = Column(String(32), nullable=False)
+    imported_at = Column(DateTime, nullable=False)
@@ -0,0 +1,155 @@
+from bot_db_entities import City, Neighborhood, CriminalCategory, Store, CityRanking, NeighborhoodStats
+from name_index import NameIndex
+from geo_index import GeoIndex
+from prefix_index import PrefixIndex
+from navigation import NavigationTree
+from leaderboard import Leaderboard
+from metrics import REGISTRY
+from collections import defaultdict
+import threading
+import logging
+import time
+
+REBUILD_SECONDS = REGISTRY.histogram('bot_catalog_rebuild_seconds', 'Time to rebuild the in-memory catalog')
+
+
+class CatalogSnapshot:
+    """Immutable view of the registry, indexed for the bot lookups"""
+    __slots__ = ('categories', 'cities', 'neighborhoods', 'stores', 'cities_by_id', 'neighborhoods_by_id',
+                 'city_names', 'neighborhood_names', 'navigation', 'geo', 'store_names', 'leaderboard',
+                 'built_at')
+
+    def __init__(self, categories, cities, neighborhoods, stores, cities_by_id, neighborhoods_by_id,
+                 rankings=(), stats=()):
+        self.categories = categories
+        self.cities = cities
+        self.neighborhoods = neighborhoods
+        self.stores = stores
+        self.cities_by_id = cities_by_id
+        self.neighborhoods_by_id = neighborhoods_by_id
+        self.city_names = NameIndex(cities_by_id.values())
+        by_city = defaultdict(list)
+        for neighborhood in neighborhoods_by_id.values():
+            by_city[neighborhood.city_id].append(neighborhood)
+        self.neighborhood_names = {city_id: NameIndex(items) for city_id, items in by_city.items()}
+        self.navigation = NavigationTree(categories, cities_by_id, neighborhoods_by_id, stores.keys())
+        self.geo = GeoIndex(store for group in stores.values() for store in group)
+        self.store_names = PrefixIndex(
+            sorted((store for group in stores.values() for store in group), key=lambda store: (-store.vote, store.id)),
+            self._place_names
+        )
+        self.leaderboard = Leaderboard(
+            rankings, stats, {store.id: store for group in stores.values() for store in group}, cities_by_id
+        )
+        self.built_at = time.time()
+
+    def _place_names(self, store):
+        """Names a store is found by: its own, its neighborhood's and its city's"""
+        neighborhood = self.neighborhoods_by_id.get(store.neighborhood_id)
+        city = self.cities_by_id.get(neighborhood.city_id) if neighborhood else None
+        return store.name, neighborhood.name if neighborhood else None, city.name if city else None
+
+
+class Catalog:
+    """
+    In-process copy of the registry tables. Every rebuild produces a new
+    snapshot which replaces the previous one with a single reference swap,
+    so readers never see a half-built index and never need a lock.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger('Catalog')
+        self._snapshot = None
+        self._rebuild_lock = threading.Lock()
+
+    @staticmethod
+    def fold(name: str) -> str:
+        return name.strip().casefold()
+
+    @property
+    def loaded(self) -> bool:
+        return self._snapshot is not None
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def rebuild(self, session):
+        """Load all the registry tables with one query each and swap the snapshot"""
+        with self._rebuild_lock:
+            start = time.perf_counter()
+            categories = {c.id: c for c in session.query(CriminalCategory).order_by(CriminalCategory.id).all()}
+
+            cities = {}
+            cities_by_id = {}
+            for city in session.query(City).order_by(City.id).all():
+                cities.setdefault(self.fold(city.name), city)
+                cities_by_id[city.id] = city
+
+            neighborhoods = {}
+            neighborhoods_by_id = {}
+            for neighborhood in session.query(Neighborhood).order_by(Neighborhood.id).all():
+                neighborhoods.setdefault((neighborhood.city_id, self.fold(neighborhood.name)), neighborhood)
+                neighborhoods_by_id[neighborhood.id] = neighborhood
+
+            grouped = defaultdict(list)
+            for store in session.query(Store).order_by(Store.vote.desc(), Store.id).all():
+                grouped[(store.neighborhood_id, store.criminal_category_id)].append(store)
+            stores = {key: tuple(group) for key, group in grouped.items()}
+
+            rankings = session.query(CityRanking).all()
+            stats = session.query(NeighborhoodStats).all()
+
+            self._snapshot = CatalogSnapshot(categories, cities, neighborhoods, stores, cities_by_id, neighborhoods_by_id,
+                                             rankings, stats)
+            REBUILD_SECONDS.observe(time.perf_counter() - start)
+            self.logger.info(
+                f"Catalog rebuilt in {time.perf_counter() - start:.3f}s: "
+                f"{len(cities)} cities, {len(neighborhoods)} neighborhoods, {len(stores)} store groups, "
+                f"{len(self._snapshot.geo)} located stores"
+            )
+
+    def find_city(self, city_name: str):
+        return self._snapshot.cities.get(self.fold(city_name))
+
+    def find_neighborhood(self, neighborhood_name: str, city_id: int):
+        return self._snapshot.neighborhoods.get((city_id, self.fold(neighborhood_name)))
+
+    def get_stores(self, neighborhood_id: int, category_id: int):
+        return self._snapshot.stores.get((neighborhood_id, category_id), ())
+
+    def get_categories(self):
+        return self._snapshot.navigation.categories
+
+    def get_navigation(self):
+        return self._snapshot.navigation
+
+    def get_city(self, city_id: int):
+        return self._snapshot.cities_by_id.get(city_id)
+
+    def get_neighborhood(self, neighborhood_id: int):
+        return self._snapshot.neighborhoods_by_id.get(neighborhood_id)
+
+    def suggest_cities(self, city_name: str, k=5):
+        return [city for city, _ in self._snapshot.city_names.search(city_name, k)]
+
+    def suggest_neighborhoods(self, neighborhood_name: str, city_id: int, k=5):
+        index = self._snapshot.neighborhood_names.get(city_id)
+        return [neighborhood for neighborhood, _ in index.search(neighborhood_name, k)] if index else []
+
+    def best_stores_near(self, latitude: float, longitude: float, radius: float, k=10, category_id=None):
+        return self._snapshot.geo.best_within(latitude, longitude, radius, k, category_id)
+
+    def nearest_stores(self, latitude: float, longitude: float, max_distance: float, k=10, category_id=None):
+        return self._snapshot.geo.nearest(latitude, longitude, max_distance, k, category_id)
+
+    def search_stores(self, query: str, k=20):
+        return self._snapshot.store_names.search(query, k)
+
+    def get_ranked_cities(self, category_id: int):
+        return self._snapshot.leaderboard.cities(category_id)
+
+    def get_ranking(self, city_id: int, category_id: int):
+        return self._snapshot.leaderboard.ranking(city_id, category_id)
+
+    def get_neighborhood_stats(self, city_id: int, category_id: int):
+        return self._snapshot.leaderboard.neighborhood_stats(city_id, category_id)
@@ -1,26 +1,66 @@
-from bot_db_entities import Base, City, Neighborhood, Store
-from sqlalchemy import func, create_engine
-from sqlalchemy.orm import sessionmaker
+from bot_db_entities import City, Neighborhood, CriminalCategory, Store, CityRanking, NeighborhoodStats, Subscription
+from sqlalchemy import func, select, delete, bindparam, text
+from datetime import datetime
 from contextlib import contextmanager # Importato per la gestione del contesto
+from catalog import Catalog
+from geo_index import GeoIndex, METERS_PER_DEGREE
+from database import Database
+from schema_migrations import migrate
+import math
 import os
 import logging # Importato per il logging degli errori
 
+# Query fisse del DAO, costruite una volta sola: SQLAlchemy riusa la loro forma compilata
+FIND_CITY = select(City).where(func.lower(City.name) == func.lower(bindparam('name'))).limit(1)
+FIND_NEIGHBORHOOD = select(Neighborhood).where(
+    func.lower(Neighborhood.name) == func.lower(bindparam('name')),
+    Neighborhood.city_id == bindparam('city_id')
+).limit(1)
+GET_STORES = select(Store).where(
+    Store.neighborhood_id == bindparam('neighborhood_id'),
+    Store.criminal_category_id == bindparam('category_id')
+).order_by(Store.vote.desc(), Store.id)
+GET_CATEGORIES = select(CriminalCategory).order_by(CriminalCategory.id)
+SEARCH_STORES = select(Store).where(
+    func.lower(Store.name).like(bindparam('pattern'), escape='\\')
+).order_by(Store.vote.desc(), Store.id).limit(bindparam('k'))
+GET_STORES_IN_BOX = select(Store).where(
+    Store.latitude.between(bindparam('south'), bindparam('north')),
+    Store.longitude.between(bindparam('west'), bindparam('east'))
+)
+GET_RANKED_CITIES = select(City).where(
+    City.id.in_(select(CityRanking.city_id).where(CityRanking.criminal_category_id == bindparam('category_id')))
+).order_by(City.name)
+GET_RANKING = select(Store).join(CityRanking, CityRanking.store_id == Store.id).where(
+    CityRanking.city_id == bindparam('city_id'),
+    CityRanking.criminal_category_id == bindparam('category_id')
+).order_by(CityRanking.position)
+GET_NEIGHBORHOOD_STATS = select(NeighborhoodStats).where(
+    NeighborhoodStats.city_id == bindparam('city_id'),
+    NeighborhoodStats.criminal_category_id == bindparam('category_id')
+).order_by(NeighborhoodStats.average_vote.desc(), NeighborhoodStats.neighborhood_id)
+GET_SUBSCRIPTIONS = select(Subscription).where(Subscription.chat_id == bindparam('chat_id')).order_by(Subscription.created_at)
+
 class DAO:
-    def __init__(self):
-        DATABASE_URL = os.getenv('DATABASE_URL')
-        self.engine = create_engine(
-            DATABASE_URL,
-            pool_size=5,           
-            max_overflow=30,        
-            pool_recycle=3600,      
-            pool_pre_ping=True      
-        )
-        Base.metadata.create_all(self.engine) 
-        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+    def __init__(self, database=None):
+        # Connessioni condivise con DatabaseUpdater e con le sessioni
+        self.database = database or Database()
+        self.engine = self.database.engine
+        # Crea le tabelle mancanti e applica le migrazioni dello schema
+        migrate(self.engine)
+        self.Session = self.database.ReadSession
+        # Catalogo in memoria, disattivabile con CATALOG_ENABLED=false
+        self.catalog = Catalog() if os.getenv('CATALOG_ENABLED', 'true').lower() == 'true' else None
+        # Ricerca approssimata su Postgres quando il catalogo non è attivo
+        self.pg_trgm = self.engine.dialect.name == 'postgresql' and os.getenv('PG_TRGM_ENABLED', 'false').lower() == 'true'
+        if self.pg_trgm:
+            with self.engine.begin() as connection:
+                connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
 
     @contextmanager 
-    def get_session(self):
-        session = self.Session() 
+    def get_session(self, primary=False):
+        """Session on the read replica, or on the primary if asked or if there is no replica"""
+        session = self.database.Session() if primary else self.Session()
         try:
             yield session 
             session.commit() 
@@ -31,25 +71,167 @@ class DAO:
         finally:
             session.close()
 
+    def refresh_catalog(self):
+        """Rebuild the in-memory catalog from the database"""
+        if self.catalog is None:
+            return
+        # Dal primario: una replica in ritardo ricostruirebbe il catalogo con i dati vecchi
+        with self.get_session(primary=True) as session:
+            self.catalog.rebuild(session)
+
+    def _catalog_ready(self) -> bool:
+        if self.catalog is None:
+            return False
+        if not self.catalog.loaded:
+            try:
+                self.refresh_catalog()
+            except Exception as e:
+                logging.error(f"Impossibile caricare il catalogo: {e}")
+                return False
+        return True
+
     def find_city(self, city_name: str):
+        if self._catalog_ready():
+            return self.catalog.find_city(city_name)
         with self.get_session() as session:
-            return session.query(City).filter(
-                func.lower(City.name) == func.lower(city_name.strip())
-            ).first()
+            return session.scalars(FIND_CITY, {'name': city_name.strip()}).first()
 
     def find_neighborhood(self, neighborhood_name: str, city_id: int):
+        if self._catalog_ready():
+            return self.catalog.find_neighborhood(neighborhood_name, city_id)
         with self.get_session() as session:
-            return session.query(Neighborhood).filter(
-                func.lower(Neighborhood.name) == func.lower(neighborhood_name.strip()),
-                Neighborhood.city_id == city_id
-            ).first()
+            return session.scalars(FIND_NEIGHBORHOOD, {'name': neighborhood_name.strip(), 'city_id': city_id}).first()
 
     def get_stores(self, neighborhood_id: int, category_id: int):
+        if self._catalog_ready():
+            return self.catalog.get_stores(neighborhood_id, category_id)
+        with self.get_session() as session:
+            return session.scalars(GET_STORES, {'neighborhood_id': neighborhood_id, 'category_id': category_id}).all()
+
+    def get_categories(self):
+        if self._catalog_ready():
+            return self.catalog.get_categories()
+        with self.get_session() as session:
+            return session.scalars(GET_CATEGORIES).all()
+
+    def get_navigation(self):
+        """The navigation tree of the catalog, or None when the catalog is disabled"""
+        if self._catalog_ready():
+            return self.catalog.get_navigation()
+        return None
+
+    def get_city(self, city_id: int):
+        if self._catalog_ready():
+            return self.catalog.get_city(city_id)
+        with self.get_session() as session:
+            return session.get(City, city_id)
+
+    def get_neighborhood(self, neighborhood_id: int):
+        if self._catalog_ready():
+            return self.catalog.get_neighborhood(neighborhood_id)
+        with self.get_session() as session:
+            return session.get(Neighborhood, neighborhood_id)
+
+    def suggest_cities(self, city_name: str, k=5):
+        """Cities with a name similar to the given one, best first"""
+        if self._catalog_ready():
+            return self.catalog.suggest_cities(city_name, k)
+        if not self.pg_trgm:
+            return []
+        with self.get_session() as session:
+            return session.query(City).filter(
+                City.name.op('%')(city_name.strip())
+            ).order_by(func.similarity(City.name, city_name.strip()).desc()).limit(k).all()
+
+    def suggest_neighborhoods(self, neighborhood_name: str, city_id: int, k=5):
+        """Neighborhoods of a city with a name similar to the given one, best first"""
+        if self._catalog_ready():
+            return self.catalog.suggest_neighborhoods(neighborhood_name, city_id, k)
+        if not self.pg_trgm:
+            return []
         with self.get_session() as session:
-            return session.query(Store).filter_by(
-                neighborhood_id=neighborhood_id,
-                criminal_category_id=category_id
-            ).order_by(Store.vote.desc()).all()
+            return session.query(Neighborhood).filter(
+                Neighborhood.city_id == city_id,
+                Neighborhood.name.op('%')(neighborhood_name.strip())
+            ).order_by(func.similarity(Neighborhood.name, neighborhood_name.strip()).desc()).limit(k).all()
+
+    def search_stores(self, query: str, k=20):
+        """Stores with a name, neighborhood or city with a word starting with the query, best voted first"""
+        if self._catalog_ready():
+            return self.catalog.search_stores(query, k)
+        # Senza catalogo: solo il nome del locale, dall'inizio
+        with self.get_session() as session:
+            prefix = query.strip().lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            return session.scalars(SEARCH_STORES, {'pattern': prefix + '%', 'k': k}).all()
+
+    def _geo_index_around(self, latitude: float, longitude: float, radius: float):
+        """GeoIndex of the stores in the box around a point, for the lookups without the catalog"""
+        delta = radius / METERS_PER_DEGREE
+        delta_longitude = delta / max(math.cos(math.radians(min(abs(latitude) + delta, 89.0))), 1e-6)
+        with self.get_session() as session:
+            return GeoIndex(session.scalars(GET_STORES_IN_BOX, {
+                'south': latitude - delta, 'north': latitude + delta,
+                'west': longitude - delta_longitude, 'east': longitude + delta_longitude,
+            }).all())
+
+    def best_stores_near(self, latitude: float, longitude: float, radius: float, k=10, category_id=None):
+        """[(meters, store)] of the k best voted stores within radius meters"""
+        if self._catalog_ready():
+            return self.catalog.best_stores_near(latitude, longitude, radius, k, category_id)
+        return self._geo_index_around(latitude, longitude, radius).best_within(latitude, longitude, radius, k, category_id)
+
+    def nearest_stores(self, latitude: float, longitude: float, max_distance: float, k=10, category_id=None):
+        """[(meters, store)] of the k stores closest to a point within max_distance meters, closest first"""
+        if self._catalog_ready():
+            return self.catalog.nearest_stores(latitude, longitude, max_distance, k, category_id)
+        return self._geo_index_around(latitude, longitude, max_distance).nearest(latitude, longitude, max_distance, k, category_id)
+
+    def get_ranked_cities(self, category_id: int):
+        """Cities with a ranking for a category, by name"""
+        if self._catalog_ready():
+            return self.catalog.get_ranked_cities(category_id)
+        with self.get_session() as session:
+            return session.scalars(GET_RANKED_CITIES, {'category_id': category_id}).all()
+
+    def get_ranking(self, city_id: int, category_id: int):
+        """Best voted stores of a category in a city, as computed by the last import"""
+        if self._catalog_ready():
+            return self.catalog.get_ranking(city_id, category_id)
+        with self.get_session() as session:
+            return session.scalars(GET_RANKING, {'city_id': city_id, 'category_id': category_id}).all()
+
+    def get_neighborhood_stats(self, city_id: int, category_id: int):
+        """NeighborhoodStats of the neighborhoods of a city for a category, best average first"""
+        if self._catalog_ready():
+            return self.catalog.get_neighborhood_stats(city_id, category_id)
+        with self.get_session() as session:
+            return session.scalars(GET_NEIGHBORHOOD_STATS, {'city_id': city_id, 'category_id': category_id}).all()
+
+    def subscribe(self, chat_id: int, neighborhood_id: int, category_id: int, limit: int):
+        """Subscribe a chat to the new stores of a neighborhood and category; False if it already has limit subscriptions"""
+        with self.get_session(primary=True) as session:
+            if session.get(Subscription, (chat_id, neighborhood_id, category_id)) is not None:
+                return True
+            count = session.scalar(select(func.count()).select_from(Subscription).where(Subscription.chat_id == chat_id))
+            if count >= limit:
+                return False
+            session.add(Subscription(chat_id=chat_id, neighborhood_id=neighborhood_id,
+                                     criminal_category_id=category_id, created_at=datetime.now()))
+            return True
+
+    def unsubscribe(self, chat_id: int, neighborhood_id: int, category_id: int):
+        with self.get_session(primary=True) as session:
+            session.execute(delete(Subscription).where(
+                Subscription.chat_id == chat_id,
+                Subscription.neighborhood_id == neighborhood_id,
+                Subscription.criminal_category_id == category_id
+            ))
+
+    def get_subscriptions(self, chat_id: int):
+        """Subscriptions of a chat, oldest first"""
+        # Dal primario: la lista segue subito un'iscrizione
+        with self.get_session(primary=True) as session:
+            return session.scalars(GET_SUBSCRIPTIONS, {'chat_id': chat_id}).all()
 
     def close_engine(self):
-        self.engine.dispose() 
\ No newline at end of file
+        self.database.dispose() 
\ No newline at end of file
@@ -0,0 +1,164 @@
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, NullPool
+from contextlib import contextmanager
+from metrics import REGISTRY
+import logging
+import os
+import time
+
+QUERY_SECONDS = REGISTRY.histogram('bot_db_query_seconds', 'Database statement execution time', ['statement'])
+POOL_WAIT_SECONDS = REGISTRY.histogram('bot_db_pool_wait_seconds', 'Time to get a connection from the pool')
+STATEMENT_KINDS = {'select', 'insert', 'update', 'delete'}
+
+# Keys of the Postgres advisory locks serializing work across the replicas of one database:
+# the schema migrations, the notification rounds, and the imports and rollbacks of the registry
+MIGRATION_LOCK_KEY = 7217341
+NOTIFY_LOCK_KEY = 7217342
+IMPORT_LOCK_KEY = 7217343
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool measuring how long each checkout takes, waiting for a free connection included"""
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started = connection.info.get('query_started_at')
+    if not started:
+        return
+    kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+    QUERY_SECONDS.observe(time.perf_counter() - started.pop(), statement=kind if kind in STATEMENT_KINDS else 'other')
+
+
+def _handle_error(context):
+    # Una query fallita non arriva ad after_cursor_execute: il suo inizio va tolto qui
+    if context.connection is None:
+        return
+    started = context.connection.info.get('query_started_at')
+    if started:
+        started.pop()
+
+
+def advisory_lock(connection, key):
+    """
+    Take a Postgres advisory lock held until the end of the current transaction.
+    Returns:
+        False on the other dialects, where the caller must serialize by other means
+    """
+    if connection.dialect.name != 'postgresql':
+        return False
+    connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': key})
+    return True
+
+
+class Database:
+    """
+    Engines shared by the DAO, the importer and the session store of a
+    replica. Writes, imports and everything that must see them go to the
+    primary; the bot lookups may go to a read replica. Both pools together
+    never open more than pool_budget connections, plus one outside the
+    pools while a long advisory lock is held.
+    """
+    def __init__(self, url=None, read_url=None, pool_budget=None):
+        """
+        Args:
+            url: Primary database, DATABASE_URL by default
+            read_url: Optional read replica, DATABASE_READ_URL by default
+            pool_budget: Maximum connections of this process, DB_POOL_BUDGET by default
+        """
+        self.logger = logging.getLogger('Database')
+        url = url or os.getenv('DATABASE_URL')
+        read_url = read_url or os.getenv('DATABASE_READ_URL')
+        self.pool_budget = pool_budget or int(os.getenv('DB_POOL_BUDGET', '20'))
+        # Con una replica il primario serve solo import, sessioni e rebuild del catalogo
+        primary_size = max(2, self.pool_budget // 4) if read_url else self.pool_budget
+        self.engine = self._create_engine(url, primary_size)
+        self.read_engine = self._create_engine(read_url, self.pool_budget - primary_size) if read_url else self.engine
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.ReadSession = sessionmaker(bind=self.read_engine, expire_on_commit=False)
+        # Un lock tenuto per tutto un import non sottrae una connessione del pool a sessioni e iscrizioni
+        self.lock_engine = create_engine(url, poolclass=NullPool) if make_url(url).get_backend_name() == 'postgresql' else None
+        REGISTRY.gauge('bot_db_pool_connections', 'Connections per pool and state', self._pool_gauge, ['pool', 'state'])
+
+    @staticmethod
+    def _create_engine(url, pool_size):
+        # The compiled statement cache keeps its default size: the bot runs a few dozen distinct statements
+        options = {}
+        if make_url(url).get_backend_name() != 'sqlite':
+            # Fixed-size pools: a replica never exceeds its share of max_connections
+            options.update(
+                poolclass=TimedQueuePool,
+                pool_size=max(1, pool_size),
+                max_overflow=0,
+                pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', '10')),
+                pool_recycle=3600,
+                pool_pre_ping=True,
+            )
+        engine = create_engine(url, **options)
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+        return engine
+
+    @contextmanager
+    def held_advisory_lock(self, key):
+        """
+        Hold a Postgres advisory lock for the whole block, in a transaction on
+        a connection of its own outside the pools, so that the work done
+        under the lock can still use the whole primary pool.
+        Yields:
+            False on the other dialects, where the caller must serialize by other means
+        """
+        if self.lock_engine is None:
+            yield False
+            return
+        with self.lock_engine.connect() as connection, connection.begin():
+            yield advisory_lock(connection, key)
+
+    @property
+    def has_replica(self) -> bool:
+        return self.read_engine is not self.engine
+
+    @staticmethod
+    def _pool_stats(engine):
+        pool = engine.pool
+        if not hasattr(pool, 'checkedout'):
+            return {}
+        size = pool.size()
+        checked_out = pool.checkedout()
+        return {
+            'size': size,
+            'checked_out': checked_out,
+            'idle': pool.checkedin(),
+            'overflow': max(0, pool.overflow()),
+            'saturation': round(checked_out / size, 3) if size else 0.0,
+        }
+
+    def pool_stats(self):
+        """Connections in use per pool, 'saturation' close to 1 means requests wait for a connection"""
+        stats = {'primary': self._pool_stats(self.engine)}
+        if self.has_replica:
+            stats['replica'] = self._pool_stats(self.read_engine)
+        return stats
+
+    def _pool_gauge(self):
+        return {(pool, state): value for pool, stats in self.pool_stats().items()
+                for state, value in stats.items() if state in ('checked_out', 'idle', 'overflow')}
+
+    def dispose(self):
+        self.engine.dispose()
+        if self.lock_engine is not None:
+            self.lock_engine.dispose()
+        if self.has_replica:
+            self.read_engine.dispose()
@@ -1,144 +1,421 @@
-from sqlalchemy import create_engine, MetaData, and_
-from bot_db_entities import Base, City, Neighborhood, CriminalCategory, Store
+from sqlalchemy import select, insert, delete
+from bot_db_entities import City, Neighborhood, CriminalCategory, Store, ImportRowHash, RegistryImport
 from datetime import datetime
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import exists
-import pandas as pd
+from database import Database, IMPORT_LOCK_KEY
+from contextlib import contextmanager
 import logging
 from input_validator import InputValidator
+from registry_reader import RegistryReader
+from staged_import import StagedImporter, REFERENCES, IMPORT_TABLE_SECONDS, IMPORT_ROWS, refuse_orphans
+from metrics import REGISTRY
+import leaderboard
 import os
+import time
+import hashlib
+import threading
+
+IMPORT_SECONDS = REGISTRY.histogram('bot_import_seconds', 'Duration of the phases of a registry import', ['phase'])
+IMPORTS = REGISTRY.counter('bot_imports_total', 'Registry imports by result', ['result'])
 
 
 class DatabaseUpdater:
-    def __init__(self):
+    SHEET_NAMES = {
+        CriminalCategory: 'category',
+        City: 'city',
+        Neighborhood: 'neighborhood',
+        Store: 'store',
+    }
+    # Columns rewritten when a row already exists, keyed by model
+    UPDATE_COLUMNS = {
+        CriminalCategory: ['title'],
+        City: ['name'],
+        Neighborhood: ['name', 'city_id'],
+        Store: ['name', 'address', 'vote', 'maps_link', 'latitude', 'longitude', 'full_vote', 'comment',
+                'updated_at', 'criminal_category_id', 'neighborhood_id'],
+    }
+    # Columns a row cannot be imported without, keyed by model
+    REQUIRED_COLUMNS = {
+        CriminalCategory: ['title'],
+        City: ['name'],
+        Neighborhood: ['name', 'city_id'],
+        Store: ['name', 'address', 'vote', 'criminal_category_id', 'neighborhood_id'],
+    }
+
+    def __init__(self, database=None):
         self.logger = logging.getLogger('DatabaseUpdater')
-        DATABASE_URL = os.getenv('DATABASE_URL')
-        self.engine = create_engine(DATABASE_URL)
-        self.metadata = MetaData()
-        self.metadata.reflect(bind=self.engine)
-        Base.metadata.create_all(self.engine, checkfirst=True)
-        self.DBSession = sessionmaker(bind=self.engine)
-        self.session = self.DBSession()
+        # Gli import scrivono sempre sul primario; lo schema è creato e migrato dal DAO
+        self.database = database or Database()
+        self.engine = self.database.engine
+        self.DBSession = self.database.Session
         self.file_path = os.getenv('FILE_PATH')
+        self.batch_size = int(os.getenv('UPSERT_BATCH_SIZE', '1000'))
+        self.leaderboard_size = leaderboard.configured_size()
+        self.reload_listeners = []
+        # Hash of the registry the listeners of this process last loaded: with several
+        # replicas on one database, the file may have been imported by another one
+        self.loaded_hash = None
+        # Tenuto dagli import e dai rollback di questo processo: chi lo prende non vede mai un import a metà
+        self.import_lock = threading.Lock()
+        # 'incremental' writes the changed rows in place, 'staged' publishes through staging tables
+        self.import_mode = os.getenv('IMPORT_MODE', 'incremental')
+        self.staged_importer = None
+        if self.import_mode == 'staged':
+            self.staged_importer = StagedImporter(
+                self.engine, self.UPDATE_COLUMNS, self.batch_size,
+                int(os.getenv('REGISTRY_VERSIONS_KEPT', '3'))
+            )
+
+    def add_reload_listener(self, listener):
+        """Register a callable invoked after every committed import"""
+        self.reload_listeners.append(listener)
+
+    def _notify_reload_listeners(self):
+        for listener in self.reload_listeners:
+            try:
+                listener()
+            except Exception as e:
+                self.logger.error(f"Error notifying reload listener: {e}")
+
+    def _row_problem(self, model, record):
+        """Why a registry row cannot be imported, None if it can"""
+        missing = [column for column in self.REQUIRED_COLUMNS[model] if getattr(record, column) is None]
+        if missing:
+            return f"missing {', '.join(missing)}"
+        if model is Store and not (record.maps_link and InputValidator.contains_google_maps_url(record.maps_link)):
+            return 'no valid Google Maps link'
+        return None
+
+    def _load_records(self):
+        """
+        Read every sheet of the Excel file into plain dicts keyed by model.
+        A row that cannot be imported is logged and skipped, one at a time.
+        Returns:
+            The rows to import and the ids of the skipped rows, both keyed by
+            model: the live copy of a skipped row is kept as it is
+        """
+        reader = RegistryReader(self.file_path)
+        records = reader.read()
+        rows, skipped = {}, {}
+        for model, sheet in self.SHEET_NAMES.items():
+            valid = {}
+            invalid = set(reader.unreadable_ids[sheet])
+            problems = {}
+            for record in records[sheet]:
+                problem = 'missing id' if record.id is None else self._row_problem(model, record)
+                if problem:
+                    problems.setdefault(problem, []).append(record.id)
+                    # L'ultima modifica di un id è sbagliata: resta la copia nel database
+                    valid.pop(record.id, None)
+                    invalid.add(record.id)
+                    continue
+                # Later duplicates of an id win, as the last edit in the sheet
+                valid[record.id] = record._asdict()
+                invalid.discard(record.id)
+            invalid.discard(None)
+            for problem, ids in problems.items():
+                self.logger.warning(f"{model.__tablename__}: {len(ids)} rows skipped, {problem}: {ids[:20]}")
+            IMPORT_ROWS.inc(len(invalid), table=model.__tablename__, action='skipped')
+            rows[model] = list(valid.values())
+            skipped[model] = invalid
+        return rows, skipped
+
+    def _insert_statement(self, model):
+        """Return a dialect-native INSERT supporting ON CONFLICT, if available"""
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            return None
+        return insert(model.__table__)
+
+    def _upsert(self, session, model, rows, existing_ids):
+        """Insert or update rows in batches, one statement per batch"""
+        update_columns = self.UPDATE_COLUMNS[model]
+        stmt = self._insert_statement(model)
+        if stmt is not None:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['id'],
+                set_={column: stmt.excluded[column] for column in update_columns}
+            )
+            for i in range(0, len(rows), self.batch_size):
+                session.execute(stmt, rows[i:i + self.batch_size])
+            return
+
+        # Generic fallback for dialects without ON CONFLICT
+        new_rows = [row for row in rows if row['id'] not in existing_ids]
+        old_rows = [{key: row[key] for key in ['id'] + update_columns} for row in rows if row['id'] in existing_ids]
+        for i in range(0, len(new_rows), self.batch_size):
+            session.bulk_insert_mappings(model, new_rows[i:i + self.batch_size])
+        for i in range(0, len(old_rows), self.batch_size):
+            session.bulk_update_mappings(model, old_rows[i:i + self.batch_size])
+
+    def _row_hash(self, model, row):
+        """Content hash of the imported columns of a row"""
+        values = [row['id']] + [row[column] for column in self.UPDATE_COLUMNS[model] if column != 'updated_at']
+        return hashlib.blake2b(repr(values).encode('utf-8'), digest_size=16).hexdigest()
+
+    def _diff_table(self, session, model, rows, skipped_ids=frozenset()):
+        """
+        Compare a sheet with the stored row hashes and return the rows to
+        write, the ids to delete and the hashes to persist. The skipped rows
+        of the sheet are not deleted.
+        """
+        sheet = self.SHEET_NAMES[model]
+        existing_ids = set(session.scalars(select(model.id)))
+        stored_hashes = dict(session.execute(
+            select(ImportRowHash.row_id, ImportRowHash.row_hash).where(ImportRowHash.sheet == sheet)
+        ).all())
+
+        changed = []
+        hashes = {}
+        for row in rows:
+            row_hash = self._row_hash(model, row)
+            if row['id'] in existing_ids and stored_hashes.get(row['id']) == row_hash:
+                continue
+            changed.append(row)
+            hashes[row['id']] = row_hash
+
+        deleted_ids = existing_ids - {row['id'] for row in rows} - skipped_ids
+        return changed, deleted_ids, existing_ids, hashes
+
+    def _save_hashes(self, session, model, hashes, deleted_ids):
+        """Replace the stored hashes of the changed rows and drop the deleted ones"""
+        sheet = self.SHEET_NAMES[model]
+        stale_ids = list(hashes.keys() | deleted_ids)
+        for i in range(0, len(stale_ids), self.batch_size):
+            session.execute(delete(ImportRowHash).where(
+                ImportRowHash.sheet == sheet,
+                ImportRowHash.row_id.in_(stale_ids[i:i + self.batch_size])
+            ))
+        rows = [{'sheet': sheet, 'row_id': row_id, 'row_hash': row_hash} for row_id, row_hash in hashes.items()]
+        for i in range(0, len(rows), self.batch_size):
+            session.execute(insert(ImportRowHash), rows[i:i + self.batch_size])
+
+    def _delete_rows(self, session, model, deleted_ids):
+        deleted_ids = list(deleted_ids)
+        for i in range(0, len(deleted_ids), self.batch_size):
+            session.execute(delete(model).where(model.id.in_(deleted_ids[i:i + self.batch_size])))
+
+    def _refuse_orphans(self, model, changed, hashes, known_ids):
+        """
+        Drop the changed rows whose parent is neither in the registry nor in
+        the database: their live copy, if any, is left as it is.
+        Returns:
+            The ids of the refused rows
+        """
+        refused_ids = refuse_orphans(model, changed, known_ids, self.logger)
+        # Senza hash la riga viene riproposta al prossimo import
+        for row_id in refused_ids:
+            hashes.pop(row_id, None)
+        return refused_ids
+
+    def _referenced_ids(self, session, model, ids):
+        """Ids among the given ones still referenced by a live row"""
+        ids = list(ids)
+        referenced = set()
+        for child, column, parent in REFERENCES:
+            if parent is not model:
+                continue
+            foreign_key = child.__table__.c[column]
+            for i in range(0, len(ids), self.batch_size):
+                referenced.update(session.scalars(
+                    select(foreign_key).where(foreign_key.in_(ids[i:i + self.batch_size])).distinct()
+                ))
+        return referenced
+
+    def _apply_incremental(self, records, skipped=None):
+        """
+        Write the changed rows straight to the live tables in one transaction.
+        Args:
+            skipped: Ids of the rows left out of the records, keyed by model: their live copy is kept
+        """
+        skipped = skipped or {}
+        now = datetime.now()
+        with self.DBSession() as session, session.begin():
+            # Parents are written first and deleted last so that foreign keys always resolve
+            models = (CriminalCategory, City, Neighborhood, Store)
+            diffs = {}
+            known_ids = {}
+            for model in models:
+                table_start = time.perf_counter()
+                changed, deleted_ids, existing_ids, hashes = self._diff_table(
+                    session, model, records[model], skipped.get(model, set())
+                )
+                refused_ids = self._refuse_orphans(model, changed, hashes, known_ids)
+                # Le righe nuove rifiutate non esistono: i loro figli vanno rifiutati a loro volta
+                known_ids[model] = existing_ids | ({row['id'] for row in records[model]} - refused_ids)
+                inserted = 0
+                for row in changed:
+                    row['created_at'] = now
+                    if model is Store:
+                        row['updated_at'] = now
+                    if row['id'] not in existing_ids:
+                        inserted += 1
+                if changed:
+                    self._upsert(session, model, changed, existing_ids)
+                self._save_hashes(session, model, hashes, deleted_ids)
+                diffs[model] = deleted_ids
+                elapsed = time.perf_counter() - table_start
+                IMPORT_TABLE_SECONDS.observe(elapsed, table=model.__tablename__, phase='write')
+                IMPORT_ROWS.inc(inserted, table=model.__tablename__, action='inserted')
+                IMPORT_ROWS.inc(len(changed) - inserted, table=model.__tablename__, action='updated')
+                self.logger.info(
+                    f"{model.__tablename__}: {inserted} inserted, {len(changed) - inserted} updated, "
+                    f"{len(records[model]) - len(changed)} unchanged in {elapsed:.3f}s"
+                )
+
+            for model in reversed(models):
+                # A row removed from the registry but still referenced would fail the foreign key
+                kept = self._referenced_ids(session, model, diffs[model]) if diffs[model] else set()
+                if kept:
+                    diffs[model] -= kept
+                    IMPORT_ROWS.inc(len(kept), table=model.__tablename__, action='kept')
+                    self.logger.warning(
+                        f"{model.__tablename__}: {len(kept)} rows removed from the registry kept, "
+                        f"still referenced: {sorted(kept)}"
+                    )
+                if diffs[model]:
+                    with IMPORT_TABLE_SECONDS.time(table=model.__tablename__, phase='delete'):
+                        self._delete_rows(session, model, diffs[model])
+                    IMPORT_ROWS.inc(len(diffs[model]), table=model.__tablename__, action='deleted')
+                    self.logger.info(f"{model.__tablename__}: {len(diffs[model])} deleted")
 
-    def update_from_excel(self):
-        """Update the database from the Excel file"""
+    def _refresh_leaderboards(self):
+        """Recompute the rankings and the neighborhood statistics of the published registry"""
+        with IMPORT_SECONDS.time(phase='aggregate'), self.engine.begin() as connection:
+            leaderboard.refresh(connection, self.leaderboard_size)
+
+    def _file_hash(self):
+        """Content hash of the Excel file, read in chunks"""
+        file_hash = hashlib.blake2b(digest_size=16)
+        with open(self.file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def imported_hash(self):
+        """Hash of the last imported file, None if nothing was ever imported"""
+        with self.DBSession() as session:
+            return session.scalar(select(RegistryImport.file_hash).order_by(RegistryImport.id.desc()).limit(1))
+
+    def _record_import(self, file_hash):
+        with self.DBSession() as session, session.begin():
+            session.add(RegistryImport(file_hash=file_hash, imported_at=datetime.now()))
+
+    @contextmanager
+    def _locked(self):
+        """
+        Serialize the imports and rollbacks of this process and, on Postgres, of
+        all the replicas: the advisory lock is held until the import is
+        recorded, so that a replica waiting for it finds the file already
+        imported and only reloads
+        """
+        # Con SQLite gira una sola replica: basta il lock del processo
+        with self.import_lock, self.database.held_advisory_lock(IMPORT_LOCK_KEY):
+            yield
+
+    def _reload_if_imported(self, file_hash):
+        """
+        After a failed import, reload anyway if another replica imported the
+        same file, since the remote check will not offer it again.
+        Returns:
+            True if the file was imported
+        """
+        try:
+            if self.imported_hash() != file_hash:
+                return False
+        except Exception as e:
+            self.logger.error(f"Error reading the last import: {e}")
+            return False
+        self.logger.info("Excel file imported by another replica, reloading")
+        if file_hash != self.loaded_hash:
+            self.loaded_hash = file_hash
+            self._notify_reload_listeners()
+        return True
+
+    def update_from_excel(self, force=False):
+        """
+        Update the database from the Excel file, writing only the changed rows.
+        Args:
+            force: Import the file even if it was already imported
+        """
         self.logger.info(f"Updating database from Excel file: {self.file_path}")
         if not os.path.exists(self.file_path):
             self.logger.error(f"Excel file not found: {self.file_path}")
             return False
-            
+
+        # The startup import and the periodic check may overlap, and so may the imports of the replicas
+        with self._locked():
+            return self._update_from_excel(force)
+
+    def _update_from_excel(self, force):
+        file_hash = None
         try:
-            xls = pd.ExcelFile(self.file_path)
-            
-            # Read all data frames
-            df_categories = pd.read_excel(xls, 'category')
-            df_cities = pd.read_excel(xls, 'city')
-            df_neighborhoods = pd.read_excel(xls, 'neighborhood')
-            df_stores = pd.read_excel(xls, 'store')
-            
-            # Bulk insert for CriminalCategory
-            categories_to_insert = []
-            for index, row in df_categories.iterrows():
-                cat_id = row['id']
-                cat_title = row['title']
-                category_exists = self.session.query(exists().where(and_(CriminalCategory.id == cat_id, CriminalCategory.title == cat_title))).scalar()
-                if not category_exists:
-                    self.logger.info(f"Adding new category: {cat_title}")
-                    categories_to_insert.append({
-                        'id': row['id'],
-                        'title': row['title'],
-                        'created_at': datetime.now()
-                    })
-            if categories_to_insert:
-                self.session.bulk_insert_mappings(CriminalCategory, categories_to_insert)
-
-            # Bulk insert for City
-            cities_to_insert = []
-            for index, row in df_cities.iterrows():
-                city_id = row['id']
-                city_name = row['name']
-                city_exists = self.session.query(exists().where(and_(City.id == city_id, City.name == city_name))).scalar()
-                if not city_exists:
-                    self.logger.info(f"Adding new city: {city_name}")
-                    cities_to_insert.append({
-                        'id': row['id'],
-                        'name': row['name'],
-                        'created_at': datetime.now()
-                    })
-            if cities_to_insert:
-                self.session.bulk_insert_mappings(City, cities_to_insert)
-
-            # Bulk insert for Neighborhood
-            neighborhoods_to_insert = []
-            for index, row in df_neighborhoods.iterrows():
-                n_id = row['id']
-                n_name = row['name']
-                n_city_id = row['city_id']
-                n_exists = self.session.query(exists().where(and_(Neighborhood.id == n_id, Neighborhood.name == n_name, Neighborhood.city_id == n_city_id))).scalar()
-                if not n_exists:
-                    self.logger.info(f"Adding new neighborhood: {n_name}")
-                    neighborhoods_to_insert.append({
-                        'id': row['id'],
-                        'name': row['name'],
-                        'created_at': datetime.now(),
-                        'city_id': row['city_id']
-                    })
-            if neighborhoods_to_insert:
-                self.session.bulk_insert_mappings(Neighborhood, neighborhoods_to_insert)
-
-            # Bulk update/insert for Store
-            stores_to_upsert = []
-            updated_count = 0
-            for index, row in df_stores.iterrows():
-                if not InputValidator.contains_google_maps_url(row['link']):
-                    continue
-                store = self.session.query(Store).filter_by(id=row['id'], name=row['name']).first()
-                if store:
-                    store.address = row['address']
-                    store.vote = row['vote']
-                    store.maps_link = row['link']
-                    store.full_vote = row['full_vote']
-                    store.comment = row['comment']
-                    store.updated_at = datetime.now()
-                    store.criminal_category_id = row['criminal_category_id']
-                    store.neighborhood_id = row['neighborhood_id']
-                    updated_count += 1
+            start = time.perf_counter()
+            with IMPORT_SECONDS.time(phase='hash'):
+                file_hash = self._file_hash()
+                skip = not force and file_hash == self.imported_hash()
+            if skip:
+                IMPORTS.inc(result='skipped')
+                self.logger.info(f"Excel file already imported, skipped in {time.perf_counter() - start:.3f}s")
+                if file_hash != self.loaded_hash:
+                    # Importato da un'altra replica: cache e catalogo di questo processo sono vecchi
+                    self.loaded_hash = file_hash
+                    self._notify_reload_listeners()
+                return True
+
+            with IMPORT_SECONDS.time(phase='parse'):
+                records, skipped = self._load_records()
+            self.logger.info(f"Excel file parsed in {time.perf_counter() - start:.3f}s")
+
+            with IMPORT_SECONDS.time(phase='write'):
+                if self.staged_importer is not None:
+                    self.staged_importer.import_records(records, skipped)
                 else:
-                    stores_to_upsert.append({
-                        'id': row['id'],
-                        'name': row['name'],
-                        'address': row['address'],
-                        'vote': row['vote'],
-                        'maps_link': row['link'],
-                        'full_vote': row['full_vote'],
-                        'comment': row['comment'],
-                        'created_at': datetime.now(),
-                        'updated_at': datetime.now(),
-                        'criminal_category_id': row['criminal_category_id'],
-                        'neighborhood_id': row['neighborhood_id']
-                    })
-            
-            if updated_count > 0:
-                self.logger.info(f"Updated {updated_count} existing stores")
-                
-            if stores_to_upsert:
-                self.logger.info(f"Adding {len(stores_to_upsert)} new stores")
-                self.session.bulk_insert_mappings(Store, stores_to_upsert)
-
-            self.session.commit()
-            self.logger.info("Database update completed successfully")
+                    self._apply_incremental(records, skipped)
+            # Before recording the file, so that a failure here is retried by the next import
+            self._refresh_leaderboards()
+            self._record_import(file_hash)
+            IMPORT_SECONDS.observe(time.perf_counter() - start, phase='total')
+            IMPORTS.inc(result='imported')
+
+            self.logger.info(f"Database update completed successfully in {time.perf_counter() - start:.3f}s")
+            self.loaded_hash = file_hash
+            self._notify_reload_listeners()
             return True
-            
+
         except Exception as e:
+            IMPORTS.inc(result='failed')
             self.logger.error(f"Error updating database: {e}")
-            if 'session' in locals():
-                self.session.rollback()
-            return False
-        finally:
-            if 'session' in locals():
-                self.session.close()
+            return file_hash is not None and self._reload_if_imported(file_hash)
+
+    def rollback(self, version_id=None):
+        """Publish an archived registry version again (staged mode only)"""
+        if self.staged_importer is None:
+            raise ValueError("Rollback requires IMPORT_MODE=staged")
+        with self._locked():
+            version_id = self.staged_importer.rollback(version_id)
+            self._refresh_leaderboards()
+        self._notify_reload_listeners()
+        return version_id
+
+    def import_on_startup(self):
+        """
+        Import the Excel file before returning only if the database was never
+        populated, otherwise in a background thread while the bot serves the
+        data already in the database.
+        Returns:
+            The background thread, None if the import already ran
+        """
+        if self.imported_hash() is None:
+            self.update_from_excel()
+            return None
+        thread = threading.Thread(target=self.update_from_excel, name='startup-import', daemon=True)
+        thread.start()
+        return thread
 
     def pre_populateDB(self):
         """Initial database population (for backward compatibility)"""
-        return self.update_from_excel()
\ No newline at end of file
+        return self.update_from_excel()
@@ -0,0 +1,158 @@
+from collections import defaultdict
+import heapq
+import itertools
+import math
+
+# Metri per grado di latitudine (raggio medio della Terra)
+METERS_PER_DEGREE = 111195.0
+
+
+def distance(lat1, lon1, lat2, lon2) -> float:
+    """Meters between two points, with the equirectangular approximation: exact enough within a city"""
+    dx = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    dy = lat2 - lat1
+    return math.hypot(dx, dy) * METERS_PER_DEGREE
+
+
+def _located(store) -> bool:
+    latitude = getattr(store, 'latitude', None)
+    longitude = getattr(store, 'longitude', None)
+    return latitude is not None and longitude is not None and -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+class GeoIndex:
+    """
+    Uniform grid over the stores with coordinates. Each cell keeps its stores
+    sorted by vote, once for all categories and once per category, so a query
+    only looks at the cells around the point and the best voted stores first.
+    """
+    def __init__(self, stores, cell_size=500):
+        """
+        Args:
+            stores: Objects with id, vote, latitude, longitude and criminal_category_id, e.g. Store rows
+            cell_size: Side of a cell in meters (north-south)
+        """
+        self.cell_degrees = cell_size / METERS_PER_DEGREE
+        cells = defaultdict(list)
+        self.size = 0
+        for store in stores:
+            if not _located(store):
+                continue
+            self.size += 1
+            key = self._cell(store.latitude, store.longitude)
+            entry = (-store.vote, store.id, store.latitude, store.longitude, store)
+            cells[(None,) + key].append(entry)
+            cells[(store.criminal_category_id,) + key].append(entry)
+        for entries in cells.values():
+            entries.sort(key=lambda entry: entry[:2])
+        self._cells = dict(cells)
+        # Celle estreme occupate: la ricerca non esce da questo rettangolo
+        rows = [key[1] for key in self._cells] or [0]
+        columns = [key[2] for key in self._cells] or [0]
+        self._bounds = (min(rows), max(rows), min(columns), max(columns))
+
+    def __len__(self):
+        return self.size
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def _column_span(self, latitude, meters):
+        """Cells of longitude covering the given meters east and west of the latitude"""
+        scale = max(math.cos(math.radians(min(abs(latitude) + meters / METERS_PER_DEGREE, 89.0))), 1e-6)
+        return math.ceil(meters / (METERS_PER_DEGREE * scale) / self.cell_degrees)
+
+    def _cells_within(self, category_id, latitude, longitude, radius):
+        row, column = self._cell(latitude, longitude)
+        rows = math.ceil(radius / METERS_PER_DEGREE / self.cell_degrees)
+        columns = self._column_span(latitude, radius)
+        min_row, max_row, min_column, max_column = self._bounds
+        for r in range(max(row - rows, min_row), min(row + rows, max_row) + 1):
+            for c in range(max(column - columns, min_column), min(column + columns, max_column) + 1):
+                entries = self._cells.get((category_id, r, c))
+                if entries:
+                    yield entries
+
+    def best_within(self, latitude, longitude, radius, k=10, category_id=None):
+        """
+        The k best voted stores within radius meters, ties broken by distance.
+        Returns:
+            [(meters, store)]
+        """
+        merged = heapq.merge(*self._cells_within(category_id, latitude, longitude, radius), key=lambda entry: entry[:2])
+        found = []
+        for minus_vote, _, store_latitude, store_longitude, store in merged:
+            meters = distance(latitude, longitude, store_latitude, store_longitude)
+            if meters > radius:
+                continue
+            found.append((minus_vote, meters, store))
+            # Gli ex aequo con l'ultimo voto preso restano in gara per la distanza
+            if len(found) >= k and minus_vote > found[k - 1][0]:
+                break
+        found.sort(key=lambda item: item[:2])
+        return [(meters, store) for _, meters, store in found[:k]]
+
+    def nearest(self, latitude, longitude, max_distance, k=10, category_id=None):
+        """
+        The k stores closest to the point within max_distance meters. The bound
+        is required: with stores far apart, the rings between them are empty
+        cells that would all be visited.
+        Returns:
+            [(meters, store)] closest first
+        """
+        if not self.size:
+            return []
+        row, column = self._cell(latitude, longitude)
+        cell_meters = self.cell_degrees * METERS_PER_DEGREE
+        # Un grado di longitudine si accorcia verso i poli: servono più colonne che righe
+        scale = max(math.cos(math.radians(min(abs(latitude) + 1, 89.0))), 1e-6)
+        min_row, max_row, min_column, max_column = self._bounds
+        # Gli anelli che non toccano il rettangolo delle celle occupate sono vuoti
+        row_gap = max(0, min_row - row, row - max_row)
+        column_gap = max(0, min_column - column, column - max_column)
+        ring = max(row_gap, math.floor((column_gap - 1) * scale) + 1 if column_gap else 0)
+        if (ring - 1) * cell_meters > max_distance:
+            return []
+        counter = itertools.count()
+        best = []
+        while True:
+            for r, c in self._ring(row, column, ring, scale):
+                for _, _, store_latitude, store_longitude, store in self._cells.get((category_id, r, c), ()):
+                    meters = distance(latitude, longitude, store_latitude, store_longitude)
+                    if meters > max_distance:
+                        continue
+                    item = (-meters, next(counter), store)
+                    if len(best) < k:
+                        heapq.heappush(best, item)
+                    elif meters < -best[0][0]:
+                        heapq.heapreplace(best, item)
+            # Distanza sicuramente coperta dagli anelli visitati
+            covered = ring * cell_meters
+            if len(best) >= k and -best[0][0] <= covered:
+                break
+            if covered >= max_distance:
+                break
+            columns = math.ceil(ring / scale)
+            if row - ring <= min_row and row + ring >= max_row and column - columns <= min_column and column + columns >= max_column:
+                break
+            ring += 1
+        return [(-minus_meters, store) for minus_meters, _, store in sorted(best, reverse=True)]
+
+    def _ring(self, row, column, ring, scale):
+        """
+        Occupied-area cells at the given ring around (row, column), wider
+        east-west where a degree of longitude is shorter
+        """
+        min_row, max_row, min_column, max_column = self._bounds
+        columns = math.ceil(ring / scale)
+        inner_columns = math.ceil((ring - 1) / scale) if ring else -1
+
+        def clamped(start, stop):
+            return range(max(start, min_column), min(stop, max_column + 1))
+
+        for r in range(max(row - ring, min_row), min(row + ring, max_row) + 1):
+            if abs(r - row) == ring:
+                yield from ((r, c) for c in clamped(column - columns, column + columns + 1))
+            else:
+                yield from ((r, c) for c in clamped(column - columns, column - inner_columns))
+                yield from ((r, c) for c in clamped(column + inner_columns + 1, column + columns + 1))
@@ -0,0 +1,61 @@
+from telebot import types
+from cachetools import TTLCache
+from prefix_index import word_keys
+from result_renderer import ResultRenderer
+from metrics import REGISTRY
+import threading
+
+INLINE_QUERIES = REGISTRY.counter('bot_inline_queries_total', 'Inline queries answered, by cache result', ['result'])
+
+
+class InlineSearch:
+    """
+    Answers of the inline queries. Telegram sends one at every keystroke and
+    many users type the same prefixes, so the answers are kept for a short
+    time in an LRU cache, emptied after each import.
+    """
+    def __init__(self, max_results=20, cache_size=4096, ttl=60):
+        self.max_results = max_results
+        self.version = 0
+        self._cache = TTLCache(maxsize=cache_size, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Drop every cached answer, to be called after each import"""
+        with self._lock:
+            self._cache.clear()
+            self.version += 1
+
+    @staticmethod
+    def article(store, description):
+        return types.InlineQueryResultArticle(
+            id=str(store.id),
+            title=store.name,
+            description=description,
+            input_message_content=types.InputTextMessageContent(
+                ResultRenderer.render_store(store).strip(), parse_mode='Markdown', disable_web_page_preview=True
+            ),
+        )
+
+    def results(self, query, search, describe):
+        """
+        Return the articles answering an inline query.
+        Args:
+            search: Function (query, k) returning the matching stores, best first
+            describe: Function returning the description line of a store
+        """
+        key = ''.join(word_keys(query or '')[:1])
+        with self._lock:
+            version = self.version
+            articles = self._cache.get(key)
+        if articles is not None:
+            INLINE_QUERIES.inc(result='hit')
+            return articles
+
+        INLINE_QUERIES.inc(result='miss')
+        articles = tuple(self.article(store, describe(store)) for store in search(query or '', self.max_results))
+        with self._lock:
+            # Come per le pagine dei risultati: niente cache se nel frattempo è finito un import
+            if version == self.version:
+                self._cache[key] = articles
+        return articles
@@ -2,6 +2,7 @@ import re
 from typing import Optional
 
 class InputValidator:
+    GOOGLE_MAPS_PATTERN = r'https://(?:maps\.app\.goo\.gl/[a-zA-Z0-9]+|g\.co/kgs/[a-zA-Z0-9]+)'
 
     @staticmethod
     def validate_name(city_name: str) -> Optional[str]:
@@ -22,11 +23,11 @@ class InputValidator:
         return city_name
 
     @staticmethod
-    def validate_category_id(category_id: str) -> int:
-        """Validate category ID"""
+    def validate_category_id(category_id: str, valid_ids) -> int:
+        """Validate category ID against the known categories"""
         try:
             cat_id = int(category_id)
-            if cat_id < 1 or cat_id > 10:  
+            if cat_id not in valid_ids:  
                 raise ValueError("Categoria non valida")
             return cat_id
         except ValueError:
@@ -35,5 +36,4 @@ class InputValidator:
     @staticmethod
     def contains_google_maps_url(text: str) -> bool:
         """ Check if the text contains a Google Maps URL """
-        google_maps_pattern = r'https://(maps\.app\.goo\.gl/[a-zA-Z0-9]+|g\.co/kgs/[a-zA-Z0-9]+)'
-        return re.search(google_maps_pattern, text)        
\ No newline at end of file
+        return re.search(InputValidator.GOOGLE_MAPS_PATTERN, text)        
\ No newline at end of file
@@ -0,0 +1,106 @@
+from bot_db_entities import Store, Neighborhood, CityRanking, NeighborhoodStats
+from sqlalchemy import select, insert, delete, func, case
+from collections import defaultdict
+import navigation
+import os
+
+# Locali per classifica, per categoria e città
+TOP_N = 10
+
+# callback_data: "rk:k" categories, "rk:c:<cat>:<page>" cities, "rk:r:<cat>:<city>" ranking
+LEADERBOARD_PREFIX = 'rk'
+CATEGORIES = 'k'
+CITIES = 'c'
+RANKING = 'r'
+ARITY = {CATEGORIES: 0, CITIES: 2, RANKING: 2}
+
+
+def configured_size():
+    """Stores per ranking: LEADERBOARD_SIZE, TOP_N by default"""
+    return int(os.getenv('LEADERBOARD_SIZE', str(TOP_N)))
+
+
+def encode(kind, *args):
+    return navigation.encode(kind, *args, prefix=LEADERBOARD_PREFIX)
+
+
+def decode(data: str):
+    """Split a leaderboard callback_data into (kind, [int args]), raising ValueError if malformed"""
+    return navigation.decode(data, LEADERBOARD_PREFIX, ARITY, "Classifica non valida")
+
+
+def refresh(connection, top_n=TOP_N):
+    """
+    Recompute the rankings and the neighborhood statistics from the store
+    table, with one INSERT ... SELECT each. Readers see the old or the new
+    tables, never a mix, as long as the connection is in a transaction.
+    """
+    ranked = select(
+        Neighborhood.city_id,
+        Store.criminal_category_id,
+        func.row_number().over(
+            partition_by=(Neighborhood.city_id, Store.criminal_category_id),
+            order_by=(Store.vote.desc(), Store.id)
+        ).label('position'),
+        Store.id.label('store_id'),
+        Store.vote,
+    ).join(Neighborhood, Store.neighborhood_id == Neighborhood.id).subquery()
+    connection.execute(delete(CityRanking))
+    connection.execute(insert(CityRanking).from_select(
+        ['city_id', 'criminal_category_id', 'position', 'store_id', 'vote'],
+        select(ranked).where(ranked.c.position <= top_n)
+    ))
+
+    connection.execute(delete(NeighborhoodStats))
+    connection.execute(insert(NeighborhoodStats).from_select(
+        ['neighborhood_id', 'criminal_category_id', 'city_id', 'store_count', 'average_vote', 'full_vote_share'],
+        select(
+            Store.neighborhood_id,
+            Store.criminal_category_id,
+            Neighborhood.city_id,
+            func.count(Store.id),
+            func.avg(Store.vote),
+            func.avg(case((Store.full_vote.is_(True), 1.0), else_=0.0)),
+        ).join(Neighborhood, Store.neighborhood_id == Neighborhood.id)
+        .group_by(Store.neighborhood_id, Store.criminal_category_id, Neighborhood.city_id)
+    ))
+
+
+class Leaderboard:
+    """In-memory copy of the ranking and statistics tables, keyed by (city, category)"""
+    def __init__(self, rankings, stats, stores_by_id, cities_by_id):
+        """
+        Args:
+            rankings: CityRanking rows
+            stats: NeighborhoodStats rows
+            stores_by_id: Store rows keyed by id
+            cities_by_id: City rows keyed by id
+        """
+        ranked = defaultdict(list)
+        for row in sorted(rankings, key=lambda row: row.position):
+            store = stores_by_id.get(row.store_id)
+            if store is not None:
+                ranked[(row.city_id, row.criminal_category_id)].append(store)
+        self._rankings = {key: tuple(stores) for key, stores in ranked.items()}
+
+        grouped = defaultdict(list)
+        for row in stats:
+            grouped[(row.city_id, row.criminal_category_id)].append(row)
+        self._stats = {key: tuple(sorted(rows, key=lambda row: (-row.average_vote, row.neighborhood_id)))
+                       for key, rows in grouped.items()}
+
+        cities = defaultdict(list)
+        for city_id, category_id in self._rankings:
+            if city_id in cities_by_id:
+                cities[category_id].append(cities_by_id[city_id])
+        self._cities = {category_id: sorted(items, key=lambda city: city.name) for category_id, items in cities.items()}
+
+    def ranking(self, city_id, category_id):
+        return self._rankings.get((city_id, category_id), ())
+
+    def neighborhood_stats(self, city_id, category_id):
+        """NeighborhoodStats rows of a city, best average first"""
+        return self._stats.get((city_id, category_id), ())
+
+    def cities(self, category_id):
+        return self._cities.get(category_id, [])
@@ -0,0 +1,261 @@
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import bisect
+import logging
+import sys
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Secondi: da una lookup in memoria a un import completo
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_labels(self.labelnames, key)} {value}' for key, value in values]
+
+
+class Gauge(Metric):
+    """Gauge read from a function at every scrape, returning {label values: value} or a number"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def samples(self):
+        try:
+            values = self.function()
+        except Exception as e:
+            logging.getLogger('Metrics').error(f"Error reading {self.name}: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f'{self.name}{_labels(self.labelnames, key)} {value}' for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [counts per bucket (+Inf last), sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][position] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Metrics of the process, rendered in the Prometheus text format"""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Stesso nome registrato due volte (es. più istanze): si riusa la prima
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function, labelnames=()):
+        """Register a gauge, replacing the function of an existing one"""
+        with self._lock:
+            metric = Gauge(name, documentation, function, labelnames)
+            self._metrics[name] = metric
+            return metric
+
+    def render(self) -> bytes:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.header() + metric.samples()
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def handler(self):
+        """Route for WebhookServer.add_route"""
+        return 200, CONTENT_TYPE, self.render()
+
+
+REGISTRY = Registry()
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread at a fixed interval and counts them
+    in the collapsed format of flame graphs ("a;b;c count"). One sample every
+    few tens of milliseconds costs next to nothing, so it can stay on.
+    """
+    def __init__(self, interval=0.05, max_stacks=5000, max_depth=40):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = _Tally()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def sample(self):
+        own = threading.get_ident()
+        stacks = [self._collapse(frame) for ident, frame in sys._current_frames().items() if ident != own]
+        with self._lock:
+            self.samples += 1
+            for stack in stacks:
+                if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                    self._stacks[stack] += 1
+
+    def start(self):
+        def loop():
+            while not self._stop_event.wait(self.interval):
+                self.sample()
+        thread = threading.Thread(target=loop, name='sampling-profiler', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop_event.set()
+
+    def render(self, reset=False) -> bytes:
+        with self._lock:
+            stacks = self._stacks.most_common()
+            if reset:
+                self._stacks = _Tally()
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks).encode('utf-8')
+
+    def handler(self):
+        """Route for WebhookServer.add_route: returns and clears the stacks sampled so far"""
+        return 200, 'text/plain; charset=utf-8', self.render(reset=True)
+
+
+class MetricsServer:
+    """Local HTTP server for /metrics when the bot runs without the webhook server"""
+    def __init__(self, routes, host='0.0.0.0', port=9100):
+        self.routes = routes
+        self.host = host
+        self.port = port
+        self._httpd = None
+
+    def start(self):
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                route = routes.get(self.path.split('?', 1)[0])
+                status, content_type, body = route() if route else (404, 'text/plain', b'')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name='metrics-server', daemon=True).start()
+        logging.getLogger('MetricsServer').info(f"Serving metrics on {self.host}:{self.port}")
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
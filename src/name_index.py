@@ -0,0 +1,77 @@
+from collections import Counter
+import unicodedata
+import re
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+
+
+def fold_name(name: str) -> str:
+    """Fold case and accents: "Supplì" -> "suppli" """
+    folded = name.casefold()
+    if folded.isascii():
+        return folded
+    decomposed = unicodedata.normalize('NFKD', folded)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def normalize_name(name: str) -> str:
+    """Fold case and accents and drop spaces and punctuation: "San Pier d'Arena" -> "sanpierdarena" """
+    return _NON_ALNUM.sub('', fold_name(name))
+
+
+def trigrams(normalized: str) -> set:
+    padded = f'  {normalized} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """
+    Trigram index over a set of names, ranking candidates by the Jaccard
+    similarity of their trigram sets, like pg_trgm's similarity().
+    """
+    def __init__(self, items, name=lambda item: item.name):
+        """
+        Args:
+            items: Objects to index (e.g. City or Neighborhood rows)
+            name: Function returning the name of an item
+        """
+        self._items = []
+        self._sizes = []
+        self._exact = {}
+        self._postings = {}
+        for item in items:
+            normalized = normalize_name(name(item))
+            if not normalized:
+                continue
+            position = len(self._items)
+            grams = trigrams(normalized)
+            self._items.append(item)
+            self._sizes.append(len(grams))
+            self._exact.setdefault(normalized, position)
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(position)
+
+    def __len__(self):
+        return len(self._items)
+
+    def search(self, query: str, k=5, min_score=0.3):
+        """Return up to k (item, score) pairs, best first"""
+        normalized = normalize_name(query)
+        if not normalized:
+            return []
+        exact = self._exact.get(normalized)
+        if exact is not None:
+            return [(self._items[exact], 1.0)]
+
+        grams = trigrams(normalized)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+
+        scored = []
+        for position, common in shared.items():
+            score = common / (len(grams) + self._sizes[position] - common)
+            if score >= min_score:
+                scored.append((score, position))
+        scored.sort(key=lambda pair: (-pair[0], pair[1]))
+        return [(self._items[position], score) for score, position in scored[:k]]
@@ -0,0 +1,99 @@
+from collections import defaultdict
+
+PAGE_SIZE = 8
+
+# callback_data: "n:k" categories, "n:c:<cat>:<page>" cities,
+# "n:q:<cat>:<city>:<page>" neighborhoods, "n:r:<cat>:<neighborhood>" results
+NAVIGATION_PREFIX = 'n'
+CATEGORIES = 'k'
+CITIES = 'c'
+NEIGHBORHOODS = 'q'
+RESULTS = 'r'
+ARITY = {CATEGORIES: 0, CITIES: 2, NEIGHBORHOODS: 3, RESULTS: 2}
+
+
+def encode(kind, *args, prefix=NAVIGATION_PREFIX):
+    """callback_data "<prefix>:<kind>:<arg>...", or "<kind>:<arg>..." with prefix None"""
+    return ':'.join(([prefix] if prefix else []) + [kind] + [str(arg) for arg in args])
+
+
+def decode(data: str, prefix=NAVIGATION_PREFIX, arity=ARITY, error="Comando di navigazione non valido"):
+    """
+    Split a callback_data made by encode into (kind, [int args]), raising
+    ValueError(error) if malformed.
+    Args:
+        arity: Number of args of each kind
+    """
+    parts = data.split(':')
+    if prefix:
+        if parts[0] != prefix:
+            raise ValueError(error)
+        parts = parts[1:]
+    if not parts or arity.get(parts[0]) != len(parts) - 1:
+        raise ValueError(error)
+    try:
+        return parts[0], [int(part) for part in parts[1:]]
+    except ValueError:
+        raise ValueError(error)
+
+
+def paginate(items, page):
+    """Return the items of a page and whether previous and next pages exist"""
+    pages = max(1, -(-len(items) // PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * PAGE_SIZE
+    return items[start:start + PAGE_SIZE], page, page > 0, page < pages - 1
+
+
+class NavigationTree:
+    """
+    Category -> cities -> neighborhoods drill-down, keeping only the branches
+    that lead to at least one store.
+    """
+    def __init__(self, categories, cities_by_id, neighborhoods_by_id, store_groups):
+        """
+        Args:
+            categories: CriminalCategory rows keyed by id
+            cities_by_id: City rows keyed by id
+            neighborhoods_by_id: Neighborhood rows keyed by id
+            store_groups: Keys (neighborhood_id, category_id) having stores
+        """
+        self.categories = sorted(categories.values(), key=lambda category: category.id)
+        cities = defaultdict(set)
+        neighborhoods = defaultdict(list)
+        for neighborhood_id, category_id in store_groups:
+            neighborhood = neighborhoods_by_id.get(neighborhood_id)
+            if neighborhood is None or neighborhood.city_id not in cities_by_id:
+                continue
+            cities[category_id].add(neighborhood.city_id)
+            neighborhoods[(category_id, neighborhood.city_id)].append(neighborhood)
+
+        self._cities = {
+            category_id: sorted((cities_by_id[city_id] for city_id in city_ids), key=lambda city: city.name.casefold())
+            for category_id, city_ids in cities.items()
+        }
+        self._neighborhoods = {
+            key: sorted(items, key=lambda neighborhood: neighborhood.name.casefold())
+            for key, items in neighborhoods.items()
+        }
+
+    def resolve(self, data: str):
+        """
+        Decode a navigation callback_data against this tree, raising ValueError
+        if it is malformed or names a category or city left without stores
+        """
+        kind, args = decode(data)
+        if kind in (CITIES, NEIGHBORHOODS) and not self.cities(args[0]):
+            raise ValueError("Scelta non più disponibile")
+        if kind == NEIGHBORHOODS and not self.neighborhoods(args[0], args[1]):
+            raise ValueError("Scelta non più disponibile")
+        return kind, args
+
+    def category_ids(self):
+        return {category.id for category in self.categories}
+
+    def cities(self, category_id):
+        return self._cities.get(category_id, [])
+
+    def neighborhoods(self, category_id, city_id):
+        return self._neighborhoods.get((category_id, city_id), [])
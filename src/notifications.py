@@ -0,0 +1,228 @@
+from bot_db_entities import Store, Neighborhood, CriminalCategory, Subscription, NotifiedStore
+from sqlalchemy import select, insert, delete, exists, or_, false
+from itertools import groupby
+from outbound_dispatcher import TokenBucket
+from result_renderer import ResultRenderer, escape_markdown, shorten, MAX_NAME_LENGTH
+from metrics import REGISTRY
+from database import advisory_lock, NOTIFY_LOCK_KEY
+import navigation
+import threading
+import logging
+import time
+
+# callback_data: "sub:<neighborhood>:<category>" and "unsub:<neighborhood>:<category>"
+SUBSCRIBE_PREFIX = 'sub'
+UNSUBSCRIBE_PREFIX = 'unsub'
+_ARITY = {SUBSCRIBE_PREFIX: 2, UNSUBSCRIBE_PREFIX: 2}
+
+NOTIFICATIONS = REGISTRY.counter('bot_notifications_total', 'Notification messages of the subscriptions, by result', ['result'])
+NOTIFY_SECONDS = REGISTRY.histogram('bot_notify_seconds', 'Duration of the phases of a notification round', ['phase'])
+
+# Stores added, re-voted or moved to another neighborhood or category since the last round. Found first,
+# with one pass over the stores, so that the subscriptions are only looked up for them and not scanned whole
+_CHANGED = select(
+    Store.id, Store.name, Store.vote, Store.full_vote, Store.neighborhood_id, Store.criminal_category_id,
+    NotifiedStore.vote.label('old_vote'),
+    NotifiedStore.neighborhood_id.label('old_neighborhood_id'),
+    NotifiedStore.criminal_category_id.label('old_category_id'),
+).outerjoin(NotifiedStore, NotifiedStore.store_id == Store.id).where(
+    or_(
+        NotifiedStore.store_id.is_(None),
+        NotifiedStore.vote != Store.vote,
+        NotifiedStore.neighborhood_id.is_distinct_from(Store.neighborhood_id),
+        NotifiedStore.criminal_category_id.is_distinct_from(Store.criminal_category_id),
+    )
+).subquery('changed_store')
+
+# Every changed store, with the subscriptions of its neighborhood and category if any, grouped by chat.
+# The round remembers exactly the stores of this one statement: a store changed by an import committed
+# after it is left for the next round
+CHANGED_STORES = select(
+    Subscription.chat_id,
+    Neighborhood.name.label('neighborhood'),
+    CriminalCategory.title.label('category'),
+    _CHANGED.c.id.label('store_id'),
+    _CHANGED.c.name,
+    _CHANGED.c.vote,
+    _CHANGED.c.full_vote,
+    _CHANGED.c.neighborhood_id,
+    _CHANGED.c.criminal_category_id,
+    _CHANGED.c.old_vote,
+    _CHANGED.c.old_neighborhood_id,
+    _CHANGED.c.old_category_id,
+).select_from(_CHANGED).outerjoin(
+    Subscription,
+    (Subscription.neighborhood_id == _CHANGED.c.neighborhood_id)
+    & (Subscription.criminal_category_id == _CHANGED.c.criminal_category_id)
+).join(Neighborhood, Neighborhood.id == _CHANGED.c.neighborhood_id).join(
+    CriminalCategory, CriminalCategory.id == _CHANGED.c.criminal_category_id
+).order_by(Subscription.chat_id, Neighborhood.name, CriminalCategory.title, _CHANGED.c.vote.desc(), _CHANGED.c.id)
+
+# Rows of notified_store rewritten per statement
+MARK_BATCH_SIZE = 1000
+
+
+def encode(prefix, neighborhood_id, category_id):
+    return navigation.encode(prefix, neighborhood_id, category_id, prefix=None)
+
+
+def decode(data: str):
+    """Return (neighborhood_id, category_id) of a subscription callback, raising ValueError if malformed"""
+    _, args = navigation.decode(data, None, _ARITY, "Iscrizione non valida")
+    return tuple(args)
+
+
+def mark_notified(connection, stores=None):
+    """
+    Remember the vote, neighborhood and category of the given stores, the
+    base of the next round, and forget the deleted stores. Only these rows
+    are written, not the whole table.
+    Args:
+        stores: Rows with store_id, vote, neighborhood_id and criminal_category_id,
+            every changed store if None
+    """
+    if stores is None:
+        stores = connection.execute(select(
+            _CHANGED.c.id.label('store_id'), _CHANGED.c.vote,
+            _CHANGED.c.neighborhood_id, _CHANGED.c.criminal_category_id
+        )).all()
+    # Un locale seguito da più chat compare una volta per chat
+    rows = list({store.store_id: {
+        'store_id': store.store_id, 'vote': store.vote,
+        'neighborhood_id': store.neighborhood_id, 'criminal_category_id': store.criminal_category_id,
+    } for store in stores}.values())
+    for i in range(0, len(rows), MARK_BATCH_SIZE):
+        batch = rows[i:i + MARK_BATCH_SIZE]
+        connection.execute(delete(NotifiedStore).where(NotifiedStore.store_id.in_([row['store_id'] for row in batch])))
+        connection.execute(insert(NotifiedStore), batch)
+    # Last, so that a store deleted after the match does not leave its row behind
+    connection.execute(delete(NotifiedStore).where(~exists().where(Store.id == NotifiedStore.store_id)))
+
+
+def _lock_round(connection):
+    """
+    Serialize the rounds of all the replicas until the end of the transaction, so that
+    replicas reloading after the same import do not notify the same changes twice
+    """
+    if not advisory_lock(connection, NOTIFY_LOCK_KEY):
+        # Una scrittura vuota prende subito il lock di scrittura di SQLite
+        connection.execute(delete(NotifiedStore).where(false()))
+
+
+class Notifier:
+    """
+    Tells the subscribers of a (neighborhood, category) about the stores
+    added, re-voted or moved there by an import. Each import only wakes a background
+    thread: the thread finds the changes with one query, remembers the
+    votes it has seen and hands one message per chat to the outbox, never
+    more than max_pending at a time and at most rate per second, so that
+    the replies to the users are not stuck behind the notifications.
+    Imports that end while a round is running are served by the next one.
+    """
+    def __init__(self, engine, outbox, import_lock, rate=20, max_pending=60, renderer=None):
+        """
+        Args:
+            engine: Engine of the primary database
+            outbox: OutboundDispatcher sending the messages
+            import_lock: Lock held by the imports of this process, so that a round does not see one half done
+            rate: Notification messages per second
+            max_pending: Messages of the outbox above which the notifications wait
+        """
+        self.logger = logging.getLogger('Notifier')
+        self.engine = engine
+        self.outbox = outbox
+        self.import_lock = import_lock
+        self.rate = rate
+        self.max_pending = max_pending
+        self.renderer = renderer or ResultRenderer()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._idle = threading.Event()
+        self._idle.set()
+
+    def schedule(self):
+        """Ask for a notification round, to be called after each import"""
+        self._idle.clear()
+        self._wake.set()
+
+    def collect(self):
+        """
+        Return the changed stores of every subscriber, as {chat_id: rows}, and
+        remember the votes found in the same transaction.
+        """
+        with self.import_lock, self.engine.begin() as connection:
+            _lock_round(connection)
+            with NOTIFY_SECONDS.time(phase='match'):
+                rows = connection.execute(CHANGED_STORES).all()
+            with NOTIFY_SECONDS.time(phase='mark'):
+                # Solo i voti trovati: un import di un'altra replica può finire tra le due fasi
+                mark_notified(connection, rows)
+        subscribed = [row for row in rows if row.chat_id is not None]
+        return {chat_id: list(chat_rows) for chat_id, chat_rows in groupby(subscribed, key=lambda row: row.chat_id)}
+
+    def render(self, rows):
+        """One message with the changes of all the subscriptions of a chat"""
+        blocks = []
+        for (neighborhood, category), group in groupby(rows, key=lambda row: (row.neighborhood, row.category)):
+            blocks.append(f"*{escape_markdown(category.capitalize())} a {escape_markdown(neighborhood)}*\n")
+            for row in group:
+                moved = (row.old_neighborhood_id, row.old_category_id) != (row.neighborhood_id, row.criminal_category_id)
+                change = 'nuovo' if row.old_vote is None or moved else f'prima {row.old_vote}'
+                blocks.append(f"{escape_markdown(shorten(row.name, MAX_NAME_LENGTH))} - voto {row.vote}{' pieno' if row.full_vote else ''} ({change})\n")
+            blocks[-1] += '\n'
+        pages = self.renderer.split(blocks)
+        text = 'Novità nei quartieri che segui:\n\n' + pages[0]
+        if len(pages) > 1:
+            text += 'E ci sono altre novità: cercale da /start\n'
+        return text + 'Per non ricevere più avvisi clicca /disiscriviti'
+
+    def notify(self):
+        """Run a notification round and return the number of chats notified"""
+        start = time.perf_counter()
+        changes = self.collect()
+        bucket = TokenBucket(self.rate, 1)
+        with NOTIFY_SECONDS.time(phase='send'):
+            for chat_id, rows in changes.items():
+                while not self._stopped:
+                    if self.outbox.pending >= self.max_pending:
+                        time.sleep(0.05)
+                        continue
+                    wait = bucket.take(time.monotonic())
+                    if not wait:
+                        break
+                    time.sleep(wait)
+                if self._stopped:
+                    break
+                sent = self.outbox.send_message(chat_id, self.render(rows), parse_mode='Markdown')
+                NOTIFICATIONS.inc(result='queued' if sent else 'dropped')
+        self.logger.info(f"Notified {len(changes)} chats in {time.perf_counter() - start:.3f}s")
+        return len(changes)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait()
+            self._wake.clear()
+            if self._stopped:
+                break
+            try:
+                self.notify()
+            except Exception as e:
+                self.logger.error(f"Error sending the notifications: {e}")
+            if not self._wake.is_set():
+                self._idle.set()
+
+    def wait_idle(self, timeout=None):
+        """Wait for the scheduled rounds to be handed to the outbox"""
+        return self._idle.wait(timeout)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='notifier', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,304 @@
+from telebot.apihelper import ApiTelegramException, ApiHTTPException
+from telebot.handler_backends import BaseMiddleware
+from cachetools import LRUCache, TTLCache
+from collections import deque
+from metrics import REGISTRY
+import contextvars
+import requests
+import threading
+import logging
+import heapq
+import random
+import time
+
+# Limiti di Telegram: circa 30 messaggi al secondo in totale e uno al secondo per chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+# Lanes of the answers to a button press or an inline query, one per query: the
+# answers are unordered and, not being messages, outside the global and per-chat limits
+CALLBACK_LANE = 'callback'
+INLINE_LANE = 'inline'
+
+# Methods that can be repeated without visible effects, retried even after a timeout
+IDEMPOTENT_METHODS = {'edit_message_text', 'edit_message_reply_markup', 'answer_callback_query', 'answer_inline_query'}
+
+OUTBOUND_REQUESTS = REGISTRY.counter('bot_outbound_requests_total', 'Bot API calls of the dispatcher, by result', ['method', 'result'])
+OUTBOUND_DELAY = REGISTRY.histogram('bot_outbound_delay_seconds', 'Time from hand-off to a successful Bot API call')
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """Consume a token and return 0, or return the seconds until one is available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class _Job:
+    __slots__ = ('method', 'args', 'kwargs', 'queued_at', 'attempts')
+
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+
+class OutboundDispatcher:
+    """
+    Queue of the Bot API calls of the handlers, sent by a pool of workers
+    within a global and a per-chat token bucket. The calls of a chat keep
+    their order, the answers to button presses and inline queries go out at
+    once, each on its own lane; a 429 on a message delays every chat by
+    retry_after, since Telegram's flood control applies to the whole bot, and
+    transient errors are retried with backoff. Each call gets an idempotency key from the update
+    it answers, so a redelivered update does not send its answers twice.
+    """
+    def __init__(self, bot, workers=4, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST,
+                 max_pending=10000, max_retries=5):
+        self.bot = bot
+        self.logger = logging.getLogger('OutboundDispatcher')
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        # Fino a questo istante (monotonic) nessun messaggio parte: Telegram ha risposto 429
+        self.paused_until = 0.0
+        self.pending = 0
+        self._chat_buckets = LRUCache(maxsize=100000)
+        self._queues = {}
+        self._ready = []
+        self._active = set()
+        self._seq = 0
+        # Chiavi delle chiamate già accodate negli ultimi 10 minuti
+        self._seen = TTLCache(maxsize=100000, ttl=600)
+        # Update answered by the current thread or asyncio task, as [key, calls queued so far]
+        self._update = contextvars.ContextVar(f'outbound_update_{id(self)}', default=None)
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        REGISTRY.gauge('bot_outbound_pending', 'Bot API calls waiting in the dispatcher', lambda: self.pending)
+
+    def begin_update(self, update_key):
+        """Set the update answered by the current thread or task, the base of the idempotency keys"""
+        self._update.set([update_key, 0] if update_key is not None else None)
+
+    def _next_key(self, method):
+        update = self._update.get()
+        if update is None:
+            return None
+        update[1] += 1
+        return f'{update[0]}:{method}:{update[1]}'
+
+    def submit(self, lane, method, *args, **kwargs):
+        """
+        Queue a call of a TeleBot method and return at once.
+        Args:
+            lane: Chat id whose order and rate limit apply, None for calls outside any chat,
+                (CALLBACK_LANE, callback_query_id) or (INLINE_LANE, inline_query_id) for calls outside any limit
+        Returns:
+            False if the call was dropped as a duplicate or because the queue is full
+        """
+        key = self._next_key(method)
+        with self._condition:
+            if key is not None and key in self._seen:
+                OUTBOUND_REQUESTS.inc(method=method, result='duplicate')
+                return False
+            if self.pending >= self.max_pending:
+                OUTBOUND_REQUESTS.inc(method=method, result='rejected')
+                self.logger.error(f"Outbound queue full, dropping {method} for {lane}")
+                return False
+            if key is not None:
+                self._seen[key] = True
+            queue = self._queues.get(lane)
+            if queue is None:
+                queue = self._queues[lane] = deque()
+                if lane not in self._active:
+                    self._schedule(lane, time.monotonic())
+            queue.append(_Job(method, args, kwargs))
+            self.pending += 1
+        return True
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(chat_id, 'send_message', chat_id, text, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.submit(message.chat.id, 'reply_to', message, text, **kwargs)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.submit(chat_id, 'edit_message_text', text, chat_id, message_id, **kwargs)
+
+    def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        # Corsia propria per ogni risposta: non aspetta le altre né i messaggi
+        return self.submit((CALLBACK_LANE, callback_query_id), 'answer_callback_query', callback_query_id, *args, **kwargs)
+
+    def answer_inline_query(self, inline_query_id, results, **kwargs):
+        return self.submit((INLINE_LANE, inline_query_id), 'answer_inline_query', inline_query_id, results, **kwargs)
+
+    def _schedule(self, lane, not_before):
+        self._seq += 1
+        heapq.heappush(self._ready, (not_before, self._seq, lane))
+        self._condition.notify()
+
+    @staticmethod
+    def _unlimited(lane):
+        return isinstance(lane, tuple) and lane[0] in (CALLBACK_LANE, INLINE_LANE)
+
+    def _chat_bucket(self, lane):
+        bucket = self._chat_buckets.get(lane)
+        if bucket is None:
+            bucket = self._chat_buckets[lane] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_job(self):
+        """Wait for a lane that is due and within both rate limits, and return (lane, job)"""
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                if not self._ready:
+                    self._condition.wait()
+                    continue
+                not_before, _, lane = self._ready[0]
+                if not_before > now:
+                    self._condition.wait(not_before - now)
+                    continue
+                heapq.heappop(self._ready)
+                if self._unlimited(lane):
+                    self._active.add(lane)
+                    return lane, self._queues[lane][0]
+                if now < self.paused_until:
+                    self._schedule(lane, self.paused_until)
+                    continue
+                wait = self.global_bucket.take(now)
+                if wait == 0 and lane is not None:
+                    wait = self._chat_bucket(lane).take(now)
+                    if wait:
+                        # Il token globale preso non viene usato: si restituisce
+                        self.global_bucket.tokens += 1
+                if wait:
+                    self._schedule(lane, now + wait)
+                    continue
+                self._active.add(lane)
+                return lane, self._queues[lane][0]
+            return None, None
+
+    def _finish(self, lane, job, retry_at=None):
+        with self._condition:
+            self._active.discard(lane)
+            queue = self._queues[lane]
+            if retry_at is None:
+                queue.popleft()
+                self.pending -= 1
+            if queue:
+                self._schedule(lane, retry_at or time.monotonic())
+            else:
+                del self._queues[lane]
+
+    def _pause(self, until):
+        """Hold the calls of every rate-limited lane until the given time"""
+        with self._condition:
+            self.paused_until = max(self.paused_until, until)
+
+    def _retry_delay(self, job, error):
+        """Seconds before retrying a failed call, None if it must not be retried"""
+        if job.attempts > self.max_retries:
+            return None
+        if isinstance(error, ApiTelegramException):
+            if error.error_code == 429:
+                return float(error.result_json.get('parameters', {}).get('retry_after', 1))
+            # 400 e 403 (richiesta errata, bot bloccato) non cambiano riprovando
+            return None if error.error_code < 500 else self._backoff(job)
+        if isinstance(error, ApiHTTPException):
+            return self._backoff(job) if error.result.status_code >= 500 else None
+        if isinstance(error, requests.exceptions.ConnectionError) and not isinstance(error, requests.exceptions.ReadTimeout):
+            return self._backoff(job)
+        if isinstance(error, requests.exceptions.Timeout):
+            # The request may have been delivered: only repeat calls with no visible side effects
+            return self._backoff(job) if job.method in IDEMPOTENT_METHODS else None
+        return None
+
+    @staticmethod
+    def _flood_limited(error):
+        return isinstance(error, ApiTelegramException) and error.error_code == 429
+
+    @staticmethod
+    def _backoff(job):
+        return min(30.0, 0.5 * 2 ** (job.attempts - 1)) * random.uniform(0.8, 1.2)
+
+    def _worker(self):
+        while True:
+            lane, job = self._next_job()
+            if job is None:
+                return
+            job.attempts += 1
+            try:
+                getattr(self.bot, job.method)(*job.args, **job.kwargs)
+            except Exception as e:
+                delay = self._retry_delay(job, e)
+                if delay is not None:
+                    OUTBOUND_REQUESTS.inc(method=job.method, result='retried')
+                    self.logger.warning(f"{job.method} for {lane} failed ({e}), retrying in {delay:.1f}s")
+                    retry_at = time.monotonic() + delay
+                    if self._flood_limited(e) and not self._unlimited(lane):
+                        # Il limite di Telegram vale per tutto il bot, non solo per questa chat
+                        self._pause(retry_at)
+                    self._finish(lane, job, retry_at=retry_at)
+                    continue
+                OUTBOUND_REQUESTS.inc(method=job.method, result='failed')
+                self.logger.error(f"{job.method} for {lane} failed after {job.attempts} attempts: {e}")
+            else:
+                OUTBOUND_REQUESTS.inc(method=job.method, result='sent')
+                OUTBOUND_DELAY.observe(time.monotonic() - job.queued_at)
+            self._finish(lane, job)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'outbound-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        """Stop the workers once the queue is empty or after timeout seconds"""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+
+def update_key(update):
+    """Key of a message or callback query, the same when Telegram delivers it again"""
+    if hasattr(update, 'chat'):
+        return f'm:{update.chat.id}:{update.message_id}'
+    return f'c:{update.id}'
+
+
+class OutboundMiddleware(BaseMiddleware):
+    """Binds the calls queued by a handler to the update it answers"""
+    def __init__(self, dispatcher):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+        self.dispatcher = dispatcher
+
+    def pre_process(self, update, data):
+        self.dispatcher.begin_update(update_key(update))
+
+    def post_process(self, update, data, exception):
+        self.dispatcher.begin_update(None)
@@ -0,0 +1,91 @@
+from bisect import bisect_left
+from itertools import chain
+from name_index import fold_name
+import re
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+
+
+def word_keys(name: str):
+    """Normalized keys of a name, one from each word on: "Da Carbonara" -> ["dacarbonara", "carbonara"]"""
+    words = [word for word in _NON_ALNUM.split(fold_name(name)) if word]
+    return [''.join(words[i:]) for i in range(len(words))]
+
+
+class PrefixIndex:
+    """
+    Sorted array of the normalized keys of some names, each with the ranks
+    of the items it names. A prefix query is a binary search for its range of
+    keys. The best ranks of every range larger than threshold keys are
+    computed once at build time, so short and common prefixes cost the same
+    as rare ones.
+    """
+    def __init__(self, items, names, k=20, threshold=64):
+        """
+        Args:
+            items: Objects to index, best first: the answers keep this order
+            names: Function returning the names of an item (e.g. its own, its neighborhood's, its city's)
+            k: Largest number of answers of a query
+            threshold: Ranges of at most this many keys are merged at query time
+        """
+        self.k = k
+        self.threshold = threshold
+        self._items = list(items)
+        postings = {}
+        # Neighborhood and city names repeat across the stores: split them once
+        keys_of = {}
+        for rank, item in enumerate(self._items):
+            for name in names(item):
+                keys = keys_of.get(name)
+                if keys is None:
+                    keys = keys_of[name] = word_keys(name or '')
+                for key in keys:
+                    ranks = postings.setdefault(key, [])
+                    if not ranks or ranks[-1] != rank:
+                        ranks.append(rank)
+        self._keys = sorted(postings)
+        self._postings = [postings[key] for key in self._keys]
+        # prefix -> best ranks, for the prefixes matching more than threshold keys
+        self._top = {}
+        if self._keys:
+            self._build(0, len(self._keys), 0)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _merge(self, lists):
+        return sorted(set(chain.from_iterable(ranks[:self.k] for ranks in lists)))[:self.k]
+
+    def _build(self, lo, hi, depth):
+        """Return the best ranks of keys[lo:hi], all sharing their first depth characters"""
+        if hi - lo <= self.threshold:
+            return self._merge(self._postings[lo:hi])
+        children = []
+        start = lo
+        while start < hi:
+            key = self._keys[start]
+            if len(key) == depth:
+                # The key equal to the prefix sorts first: it has a child of its own
+                children.append(self._postings[start][:self.k])
+                start += 1
+                continue
+            end = bisect_left(self._keys, key[:depth + 1] + '\x7f', start, hi)
+            children.append(self._build(start, end, depth + 1))
+            start = end
+        top = self._merge(children)
+        self._top[self._keys[lo][:depth]] = top
+        return top
+
+    def search(self, query: str, k=None):
+        """Items having a name with a word starting with the query, best first; the best items for an empty query"""
+        k = min(k or self.k, self.k)
+        prefix = ''.join(word_keys(query)[:1])
+        if not prefix:
+            return self._items[:k]
+        lo = bisect_left(self._keys, prefix)
+        hi = bisect_left(self._keys, prefix + '\x7f', lo)
+        if hi - lo > self.threshold:
+            ranks = self._top[prefix]
+        else:
+            ranks = self._merge(self._postings[lo:hi])
+        return [self._items[rank] for rank in ranks[:k]]
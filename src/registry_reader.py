@@ -0,0 +1,137 @@
+from collections import namedtuple
+import logging
+
+CategoryRecord = namedtuple('CategoryRecord', ['id', 'title'])
+CityRecord = namedtuple('CityRecord', ['id', 'name'])
+NeighborhoodRecord = namedtuple('NeighborhoodRecord', ['id', 'name', 'city_id'])
+StoreRecord = namedtuple('StoreRecord', [
+    'id', 'name', 'address', 'vote', 'maps_link', 'latitude', 'longitude', 'full_vote', 'comment',
+    'criminal_category_id', 'neighborhood_id'
+])
+
+
+def _int(value):
+    return None if value is None else int(value)
+
+
+def _float(value):
+    return None if value is None else float(value)
+
+
+def _str(value):
+    if value is None:
+        return None
+    value = str(value)
+    return value if value.strip() else None
+
+
+def _bool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'vero', 'si', 'sì', '1', 'x')
+    return bool(value)
+
+
+class RegistryFormatError(ValueError):
+    pass
+
+
+class RegistryReader:
+    """
+    Streaming reader for the registry workbook. The file is opened once in
+    read-only mode and every sheet is turned into lightweight records.
+    """
+    # sheet -> (record type, [(record field, column header, converter)])
+    SHEETS = {
+        'category': (CategoryRecord, [
+            ('id', 'id', _int), ('title', 'title', _str),
+        ]),
+        'city': (CityRecord, [
+            ('id', 'id', _int), ('name', 'name', _str),
+        ]),
+        'neighborhood': (NeighborhoodRecord, [
+            ('id', 'id', _int), ('name', 'name', _str), ('city_id', 'city_id', _int),
+        ]),
+        'store': (StoreRecord, [
+            ('id', 'id', _int), ('name', 'name', _str), ('address', 'address', _str),
+            ('vote', 'vote', _float), ('maps_link', 'link', _str),
+            ('latitude', 'latitude', _float), ('longitude', 'longitude', _float), ('full_vote', 'full_vote', _bool),
+            ('comment', 'comment', _str), ('criminal_category_id', 'criminal_category_id', _int),
+            ('neighborhood_id', 'neighborhood_id', _int),
+        ]),
+    }
+    # Columns that older registries may lack, read as None. The bundled sample has no link:
+    # its stores are read, and left out by the import, which needs a Google Maps link
+    OPTIONAL_COLUMNS = {
+        'store': {'link', 'latitude', 'longitude'},
+    }
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.logger = logging.getLogger('RegistryReader')
+        # Ids of the rows skipped as unreadable, keyed by sheet
+        self.unreadable_ids = {sheet: set() for sheet in self.SHEETS}
+
+    def _column_indexes(self, sheet, header):
+        """Map every field of a sheet to its column position, failing on missing required columns"""
+        positions = {str(name).strip(): i for i, name in enumerate(header) if name is not None}
+        _, fields = self.SHEETS[sheet]
+        optional = self.OPTIONAL_COLUMNS.get(sheet, set())
+        missing = [column for _, column, _ in fields if column not in positions and column not in optional]
+        if missing:
+            raise RegistryFormatError(f"Sheet '{sheet}' is missing columns: {', '.join(missing)}")
+        return [(positions.get(column), converter) for _, column, converter in fields]
+
+    @staticmethod
+    def _row_id(row, columns):
+        """The id of a row, None if it cannot be read. The id is the first field of every sheet"""
+        i, converter = columns[0]
+        try:
+            return converter(row[i]) if i is not None and i < len(row) else None
+        except (TypeError, ValueError):
+            return None
+
+    def iter_records(self):
+        """
+        Yield (sheet, record) for every data row, validating all the headers
+        first. A row that cannot be converted is logged and skipped, and its
+        id, if readable, is added to unreadable_ids.
+        """
+        # Imported here so that starting the bot does not pay for it when no import is needed
+        import openpyxl
+        workbook = openpyxl.load_workbook(self.file_path, read_only=True, data_only=True)
+        try:
+            missing = [sheet for sheet in self.SHEETS if sheet not in workbook.sheetnames]
+            if missing:
+                raise RegistryFormatError(f"Missing sheets: {', '.join(missing)}")
+
+            layouts = {}
+            for sheet in self.SHEETS:
+                header = next(workbook[sheet].iter_rows(max_row=1, values_only=True), ())
+                layouts[sheet] = self._column_indexes(sheet, header)
+
+            for sheet, (record_type, _) in self.SHEETS.items():
+                columns = layouts[sheet]
+                for row_number, row in enumerate(workbook[sheet].iter_rows(min_row=2, values_only=True), start=2):
+                    if not row or all(value is None for value in row):
+                        continue
+                    try:
+                        yield sheet, record_type._make(
+                            converter(row[i] if i is not None and i < len(row) else None) for i, converter in columns
+                        )
+                    except (TypeError, ValueError) as e:
+                        # Una riga sbagliata non ferma l'import: chi importa tiene la sua copia nel database
+                        self.logger.warning(f"Sheet '{sheet}' row {row_number} skipped: {e}")
+                        row_id = self._row_id(row, columns)
+                        if row_id is not None:
+                            self.unreadable_ids[sheet].add(row_id)
+        finally:
+            workbook.close()
+
+    def read(self):
+        """Read the whole workbook into a dict of record lists keyed by sheet"""
+        records = {sheet: [] for sheet in self.SHEETS}
+        for sheet, record in self.iter_records():
+            records[sheet].append(record)
+        return records
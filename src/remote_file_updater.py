@@ -2,33 +2,44 @@ import os
 import hashlib
 import requests
 import logging
-import time
 import threading
+import random
+import json
+import time
 from datetime import datetime
+from metrics import REGISTRY
+
+CHECK_SECONDS = REGISTRY.histogram('bot_remote_check_seconds', 'Duration of the remote file checks, by result', ['status'])
 
 class RemoteFileUpdater:
+    CHANGED = 'changed'
+    UNCHANGED = 'unchanged'
+    ERROR = 'error'
+    JITTER = 0.1
+
     def __init__(self):
         """        
         Args:
             remote_url: URL to download the Excel file
             file_path: Path where the file should be stored locally
             check_interval: Time in seconds between update checks
+            max_check_interval: Upper bound of the interval while the file is unchanged or failing
         """
         self.remote_url = os.getenv('REMOTE_FILE_URL')
         self.file_path = os.getenv('FILE_PATH')
         self.check_interval = int(os.getenv('CHECK_INTERVAL'))
+        self.max_check_interval = int(os.getenv('MAX_CHECK_INTERVAL', str(self.check_interval * 8)))
         self.md5_file_path = f"{self.file_path}.md5"
+        self.validators_file_path = f"{self.file_path}.validators"
         self.last_update = None
+        self.last_status = None
+        self._delay = self.check_interval
         self._stop_event = threading.Event()
         self.logger = logging.getLogger('RemoteFileUpdater')
-
-    def _calculate_md5(self, file_path):
-        """Calculate MD5 hash of a file"""
-        hash_md5 = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        # Pooled connection reused by every check
+        self.session = requests.Session()
+        self.md5 = self._load_md5()
+        self.validators = self._load_validators()
 
     def _save_md5(self, md5_hash):
         """Save the MD5 hash to a file"""
@@ -45,47 +56,100 @@ class RemoteFileUpdater:
             self.logger.error(f"Error loading MD5: {e}")
         return None
 
+    def _save_validators(self):
+        """Save the HTTP cache validators next to the MD5 file"""
+        with open(self.validators_file_path, 'w') as f:
+            json.dump(self.validators, f)
+
+    def _load_validators(self):
+        """Load the HTTP cache validators saved by the last download"""
+        try:
+            if os.path.exists(self.validators_file_path):
+                with open(self.validators_file_path, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            self.logger.error(f"Error loading validators: {e}")
+        return {}
+
+    def _conditional_headers(self):
+        # Without the local copy a 304 would leave nothing to import
+        if not os.path.exists(self.file_path):
+            return {}
+        headers = {}
+        if self.validators.get('etag'):
+            headers['If-None-Match'] = self.validators['etag']
+        if self.validators.get('last_modified'):
+            headers['If-Modified-Since'] = self.validators['last_modified']
+        return headers
+
     def download_file(self):
         """Download the file and return True if it's new/different"""
         if not self.remote_url:
             self.logger.error("Remote URL not configured")
+            self.last_status = self.ERROR
             return False
             
         temp_file_path = f"{self.file_path}.tmp"
         
         try:
-            # Download the file to a temporary location
-            self.logger.info(f"Downloading file from {self.remote_url}")
-            response = requests.get(self.remote_url, stream=True, timeout=30)
-            response.raise_for_status()
-            
-            with open(temp_file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
-            new_md5 = self._calculate_md5(temp_file_path)
-            old_md5 = self._load_md5()
-            
-            if new_md5 != old_md5:
+            self.logger.info(f"Checking file at {self.remote_url}")
+            with self.session.get(self.remote_url, headers=self._conditional_headers(), stream=True, timeout=30) as response:
+                if response.status_code == 304:
+                    self.logger.info("File unchanged (304 Not Modified)")
+                    self.last_status = self.UNCHANGED
+                    return False
+                response.raise_for_status()
+
+                # Hash while streaming, so the file is never read back
+                hash_md5 = hashlib.md5()
+                with open(temp_file_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        hash_md5.update(chunk)
+                        f.write(chunk)
+                validators = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                }
+
+            new_md5 = hash_md5.hexdigest()
+            if new_md5 != self.md5:
                 self.logger.info("New file detected")
-                if os.path.exists(self.file_path):
-                    os.remove(self.file_path)
-                os.rename(temp_file_path, self.file_path)
+                os.replace(temp_file_path, self.file_path)
                 self._save_md5(new_md5)
+                self.md5 = new_md5
                 self.last_update = datetime.now()
-                return True
+                self.last_status = self.CHANGED
             else:
                 self.logger.info("File unchanged (same MD5)")
-                if os.path.exists(temp_file_path):
-                    os.remove(temp_file_path)
-                return False
+                os.remove(temp_file_path)
+                self.last_status = self.UNCHANGED
+
+            # Saved only once the local file matches them
+            if validators != self.validators:
+                self.validators = validators
+                self._save_validators()
+            return self.last_status == self.CHANGED
                 
         except Exception as e:
             self.logger.error(f"Error downloading file: {e}")
             if os.path.exists(temp_file_path):
                 os.remove(temp_file_path)
+            self.last_status = self.ERROR
             return False
 
+    def next_delay(self):
+        """
+        Seconds until the next check: the base interval after a change, growing
+        while the remote file is unchanged or failing, with random jitter.
+        """
+        if self.last_status == self.CHANGED:
+            self._delay = self.check_interval
+        elif self.last_status == self.ERROR:
+            self._delay = min(self._delay * 2, self.max_check_interval)
+        else:
+            self._delay = min(self._delay * 1.5, self.max_check_interval)
+        return self._delay * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+
     def stop(self):
         """Stop the update thread"""
         self._stop_event.set()
@@ -100,9 +164,12 @@ class RemoteFileUpdater:
             
         def check_loop():
             while not self._stop_event.is_set():
-                if self.download_file() and callback:
+                start = time.perf_counter()
+                changed = self.download_file()
+                CHECK_SECONDS.observe(time.perf_counter() - start, status=self.last_status)
+                if changed and callback:
                     callback()
-                time.sleep(self.check_interval)
+                self._stop_event.wait(self.next_delay())
         
         thread = threading.Thread(target=check_loop, daemon=True)
         thread.start()
@@ -0,0 +1,127 @@
+from cachetools import LRUCache
+from metrics import REGISTRY
+import navigation
+import threading
+import re
+
+# Telegram rejects messages longer than 4096 UTF-16 code units
+MAX_MESSAGE_LENGTH = 4096
+FOOTER_RESERVE = 120
+
+# Characters of the store fields shown in a listing, before escaping: even escaped,
+# every store fits in a page. Longer links are left out, a cut link would not work
+MAX_NAME_LENGTH = 200
+MAX_ADDRESS_LENGTH = 300
+MAX_COMMENT_LENGTH = 1000
+MAX_LINK_LENGTH = 500
+
+# callback_data of the result pages: "p:<neighborhood>:<category>:<page>"
+RESULT_PAGE_PREFIX = 'p'
+
+_MARKDOWN_SPECIAL = re.compile(r'([_*`\[])')
+
+CACHE_REQUESTS = REGISTRY.counter('bot_result_cache_requests_total', 'Rendered listings requested, by cache result', ['result'])
+
+
+def escape_markdown(text) -> str:
+    """Escape the characters with a meaning in Telegram's legacy Markdown"""
+    return _MARKDOWN_SPECIAL.sub(r'\\\1', str(text))
+
+
+def shorten(text, limit) -> str:
+    """Cut a text to limit characters, ending with an ellipsis; to be escaped afterwards"""
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + '…'
+
+
+def message_length(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+
+def format_distance(meters) -> str:
+    """'350 m' below one kilometer, '1,2 km' above"""
+    if meters < 1000:
+        return f'{round(meters / 10) * 10:.0f} m'
+    kilometers = f'{meters / 1000:.1f}'.rstrip('0').rstrip('.')
+    return f"{kilometers.replace('.', ',')} km"
+
+
+def encode_page(neighborhood_id, category_id, page):
+    return navigation.encode(RESULT_PAGE_PREFIX, neighborhood_id, category_id, page, prefix=None)
+
+
+def decode_page(data: str):
+    """Return (neighborhood_id, category_id, page), raising ValueError if malformed"""
+    _, args = navigation.decode(data, None, {RESULT_PAGE_PREFIX: 3}, "Pagina non valida")
+    return tuple(args)
+
+
+class ResultRenderer:
+    """
+    Renders the store listing of a (neighborhood, category) once, split into
+    pages that fit in a Telegram message, and keeps the pages in an LRU
+    cache until the next import.
+    """
+    def __init__(self, cache_size=1024, max_length=MAX_MESSAGE_LENGTH - FOOTER_RESERVE):
+        self.max_length = max_length
+        self.version = 0
+        self._cache = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Drop every rendered listing, to be called after each import"""
+        with self._lock:
+            self._cache.clear()
+            self.version += 1
+
+    @staticmethod
+    def render_store(store) -> str:
+        # Si accorcia il testo prima dell'escape, mai il Markdown già pronto
+        name = escape_markdown(shorten(store.name, MAX_NAME_LENGTH))
+        address = escape_markdown(shorten(store.address, MAX_ADDRESS_LENGTH))
+        block = f"{name}\nin {address} con voto: {store.vote}{' pieno' if store.full_vote else ''}\n"
+        if store.comment and store.comment.strip() and store.comment != 'NaN':
+            block += f"Commento: {escape_markdown(shorten(store.comment, MAX_COMMENT_LENGTH))}\n"
+        if store.maps_link and store.maps_link.strip() and len(store.maps_link) <= MAX_LINK_LENGTH:
+            block += f"[Apri in Google Maps]({store.maps_link})\n"
+        return block + "\n\n"
+
+    def split(self, blocks):
+        """
+        Group blocks into pages no longer than max_length. Blocks are never cut,
+        which could break their Markdown: render_store keeps every store shorter
+        than a page.
+        """
+        pages = []
+        current = ''
+        for block in blocks:
+            if current and message_length(current) + message_length(block) > self.max_length:
+                pages.append(current)
+                current = ''
+            current += block
+        if current:
+            pages.append(current)
+        return pages
+
+    def pages(self, neighborhood_id, category_id, load_stores):
+        """
+        Return the rendered pages of a listing, an empty tuple if there are no stores.
+        Args:
+            load_stores: Function returning the stores sorted by vote
+        """
+        key = (neighborhood_id, category_id)
+        with self._lock:
+            pages = self._cache.get(key)
+            version = self.version
+        if pages is not None:
+            CACHE_REQUESTS.inc(result='hit')
+            return pages
+
+        CACHE_REQUESTS.inc(result='miss')
+        stores = load_stores(neighborhood_id, category_id)
+        pages = tuple(self.split([self.render_store(store) for store in stores]))
+        with self._lock:
+            # A listing rendered while an import completed may be stale: do not keep it
+            if version == self.version:
+                self._cache[key] = pages
+        return pages
@@ -0,0 +1,183 @@
+from bot_db_entities import Base, City, Neighborhood, Store, SchemaVersion, RegistryImport, ImportRowHash, \
+    CityRanking, NeighborhoodStats, Subscription, NotifiedStore, ConversationState
+from sqlalchemy import select, insert, update, delete, text, inspect
+from sqlalchemy.schema import CreateIndex
+from datetime import datetime
+import staged_import
+import leaderboard
+from database import advisory_lock, MIGRATION_LOCK_KEY
+import logging
+import time
+
+# (version, description, upgrade(connection)) in the order they are applied
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        return upgrade
+    return register
+
+
+def _create_indexes(connection, table):
+    # Expression indexes are not reflected, so checkfirst cannot see them: IF NOT EXISTS can
+    for index in table.indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _create_tables(connection, *models):
+    for model in models:
+        model.__table__.create(connection, checkfirst=True)
+
+
+def _add_columns(connection, table_name, *columns):
+    # Tables created by create_all in this same run already have them
+    if not inspect(connection).has_table(table_name):
+        return
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    for column in columns:
+        if column.name not in existing:
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}'))
+
+
+@migration(1, 'Indexes of the store, city and neighborhood lookups')
+def add_lookup_indexes(connection):
+    for model in (City, Neighborhood, Store):
+        _create_indexes(connection, model.__table__)
+
+
+@migration(2, 'Hash of the last imported registry file')
+def add_registry_import(connection):
+    _create_tables(connection, RegistryImport)
+
+
+@migration(3, 'Coordinates of the stores')
+def add_store_coordinates(connection):
+    columns = (Store.__table__.c.latitude, Store.__table__.c.longitude)
+    # Also the tables of the staged import, copies of the store table
+    for table_name in ('store', 'staging_store', 'archive_store'):
+        _add_columns(connection, table_name, *columns)
+    # Forget the last imported file and the store hashes, so that the next import writes the coordinates
+    connection.execute(delete(RegistryImport))
+    connection.execute(delete(ImportRowHash).where(ImportRowHash.sheet == 'store'))
+
+
+@migration(4, 'Rankings and neighborhood statistics of the leaderboards')
+def add_leaderboards(connection):
+    _create_tables(connection, CityRanking, NeighborhoodStats)
+    _create_indexes(connection, NeighborhoodStats.__table__)
+    # Filled now, the next import might be far away. Plain SQL, as leaderboard.refresh was when this
+    # migration was written: a later change to refresh must not change what this migration did.
+    # The size is the one the imports use, or the rankings would disagree until the next import
+    connection.execute(text('DELETE FROM city_ranking'))
+    connection.execute(text(
+        'INSERT INTO city_ranking (city_id, criminal_category_id, position, store_id, vote) '
+        'SELECT city_id, criminal_category_id, position, store_id, vote FROM ('
+        ' SELECT neighborhood.city_id, store.criminal_category_id,'
+        '  row_number() OVER (PARTITION BY neighborhood.city_id, store.criminal_category_id'
+        '   ORDER BY store.vote DESC, store.id) AS position,'
+        '  store.id AS store_id, store.vote'
+        ' FROM store JOIN neighborhood ON store.neighborhood_id = neighborhood.id'
+        ') AS ranked WHERE position <= :top_n'
+    ), {'top_n': leaderboard.configured_size()})
+    connection.execute(text('DELETE FROM neighborhood_stats'))
+    connection.execute(text(
+        'INSERT INTO neighborhood_stats'
+        ' (neighborhood_id, criminal_category_id, city_id, store_count, average_vote, full_vote_share) '
+        'SELECT store.neighborhood_id, store.criminal_category_id, neighborhood.city_id, count(store.id),'
+        ' avg(store.vote), avg(CASE WHEN store.full_vote THEN 1.0 ELSE 0.0 END) '
+        'FROM store JOIN neighborhood ON store.neighborhood_id = neighborhood.id '
+        'GROUP BY store.neighborhood_id, store.criminal_category_id, neighborhood.city_id'
+    ))
+
+
+@migration(5, 'Subscriptions to the new stores of a neighborhood and category')
+def add_subscriptions(connection):
+    _create_tables(connection, Subscription, NotifiedStore)
+    _create_indexes(connection, Subscription.__table__)
+    # The stores already there are not news. Their place is filled by migration 6
+    connection.execute(text(
+        'INSERT INTO notified_store (store_id, vote) SELECT store.id, store.vote FROM store '
+        'WHERE NOT EXISTS (SELECT 1 FROM notified_store WHERE notified_store.store_id = store.id)'
+    ))
+
+
+@migration(6, 'Neighborhood and category of the notified stores')
+def add_notified_store_place(connection):
+    columns = (NotifiedStore.__table__.c.neighborhood_id, NotifiedStore.__table__.c.criminal_category_id)
+    _add_columns(connection, 'notified_store', *columns)
+    # The stores notified so far are where they were notified
+    connection.execute(update(NotifiedStore).values(
+        neighborhood_id=select(Store.neighborhood_id).where(Store.id == NotifiedStore.store_id).scalar_subquery(),
+        criminal_category_id=select(Store.criminal_category_id).where(Store.id == NotifiedStore.store_id).scalar_subquery(),
+    ))
+
+
+@migration(7, 'Staging and archive tables of the staged import')
+def add_staged_import_tables(connection):
+    # Created before by the first StagedImporter, at the first start in staged mode
+    staged_import.METADATA.create_all(connection, checkfirst=True)
+
+
+@migration(8, 'Conversation state shared by the replicas')
+def add_conversation_state(connection):
+    # Created before by the first SQLSessionStore, at the first start with SESSION_BACKEND=sql
+    _create_tables(connection, ConversationState)
+    _create_indexes(connection, ConversationState.__table__)
+
+
+@migration(9, 'Trigram indexes of the city and neighborhood names')
+def add_name_trigram_indexes(connection):
+    # The suggestions without the catalog use the % operator of pg_trgm, which only Postgres has
+    if connection.dialect.name != 'postgresql':
+        return
+    try:
+        # In a savepoint: without the rights to create the extension the other migrations still apply
+        with connection.begin_nested():
+            connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            for table_name in ('city', 'neighborhood'):
+                connection.execute(text(
+                    f'CREATE INDEX IF NOT EXISTS ix_{table_name}_name_trgm ON {table_name} USING gin (name gin_trgm_ops)'
+                ))
+    except Exception as e:
+        logging.getLogger('SchemaMigrations').warning(f"pg_trgm not available, name suggestions will scan: {e}")
+
+
+def pending(connection):
+    applied = set(connection.scalars(select(SchemaVersion.version)))
+    return [entry for entry in sorted(MIGRATIONS, key=lambda entry: entry[0]) if entry[0] not in applied]
+
+
+def migrate(engine):
+    """
+    Create the missing tables and apply the pending migrations in one transaction.
+    An up-to-date database costs two queries: new tables need a migration too.
+    Returns:
+        The versions applied
+    """
+    logger = logging.getLogger('SchemaMigrations')
+    applied = []
+    with engine.begin() as connection:
+        # Replicas starting together do not apply the same migration twice
+        advisory_lock(connection, MIGRATION_LOCK_KEY)
+        if inspect(connection).has_table(SchemaVersion.__tablename__) and not pending(connection):
+            return applied
+        Base.metadata.create_all(connection, checkfirst=True)
+        for version, description, upgrade in pending(connection):
+            start = time.perf_counter()
+            upgrade(connection)
+            connection.execute(insert(SchemaVersion).values(
+                version=version, description=description, applied_at=datetime.now()
+            ))
+            applied.append(version)
+            logger.info(f"Applied migration {version} ({description}) in {time.perf_counter() - start:.3f}s")
+    return applied
+
+
+if __name__ == '__main__':
+    import os
+    from sqlalchemy import create_engine
+    logging.basicConfig(level=logging.INFO)
+    migrate(create_engine(os.getenv('DATABASE_URL')))
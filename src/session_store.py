@@ -0,0 +1,236 @@
+from bot_db_entities import ConversationState
+from sqlalchemy import select, delete
+from sqlalchemy.orm import sessionmaker
+from collections import OrderedDict
+from abc import ABC, abstractmethod
+from metrics import REGISTRY
+import threading
+import logging
+import json
+import time
+import os
+
+# Short keys used in the serialized state, to keep each chat a few bytes long
+_SHORT_KEYS = {'category_id': 'c', 'city_id': 't', 'neighborhood_id': 'n', 'step': 's'}
+_LONG_KEYS = {short: key for key, short in _SHORT_KEYS.items()}
+
+SESSION_EVICTIONS = REGISTRY.counter('bot_session_evictions_total', 'Conversation states evicted to stay within the size limit')
+SESSION_EXPIRED = REGISTRY.counter('bot_session_expired_total', 'Expired conversation states removed by the sweeper')
+
+
+def encode_state(state: dict) -> str:
+    return json.dumps({_SHORT_KEYS.get(k, k): v for k, v in state.items() if v is not None}, separators=(',', ':'))
+
+
+def decode_state(data: str) -> dict:
+    state = {key: None for key in _SHORT_KEYS}
+    state.update({_LONG_KEYS.get(k, k): v for k, v in json.loads(data).items()})
+    return state
+
+
+class SessionStore(ABC):
+    """
+    Conversation state per chat, with a dict-like interface. Values are
+    copies: a changed state must be stored again with store[chat_id] = state.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.logger = logging.getLogger(type(self).__name__)
+
+    @abstractmethod
+    def load(self, chat_id):
+        """Return the encoded state of a chat or None"""
+
+    @abstractmethod
+    def save(self, chat_id, data):
+        """Store the encoded state of a chat for ttl seconds"""
+
+    @abstractmethod
+    def remove(self, chat_id):
+        """Delete a chat, returning True if it existed"""
+
+    def sweep(self, batch_size=500):
+        """Drop expired states in batches, returning how many were removed"""
+        return 0
+
+    def __getitem__(self, chat_id):
+        data = self.load(chat_id)
+        if data is None:
+            raise KeyError(chat_id)
+        return decode_state(data)
+
+    def __setitem__(self, chat_id, state):
+        self.save(chat_id, encode_state(state))
+
+    def __delitem__(self, chat_id):
+        if not self.remove(chat_id):
+            raise KeyError(chat_id)
+
+    def __contains__(self, chat_id):
+        return self.load(chat_id) is not None
+
+    def get(self, chat_id, default=None):
+        try:
+            return self[chat_id]
+        except KeyError:
+            return default
+
+    def pop(self, chat_id, *default):
+        state = self.get(chat_id)
+        if state is None:
+            if default:
+                return default[0]
+            raise KeyError(chat_id)
+        self.remove(chat_id)
+        return state
+
+    def start_sweeper(self, interval, batch_size=500):
+        """Sweep expired states from a daemon thread every interval seconds"""
+        def sweep_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    removed = self.sweep(batch_size)
+                    SESSION_EXPIRED.inc(removed)
+                    while removed == batch_size:
+                        removed = self.sweep(batch_size)
+                        SESSION_EXPIRED.inc(removed)
+                except Exception as e:
+                    self.logger.error(f"Error sweeping sessions: {e}")
+
+        thread = threading.Thread(target=sweep_loop, name='session-sweeper', daemon=True)
+        thread.start()
+        return thread
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local store bounded to maxsize chats, evicting the least recently written"""
+    def __init__(self, ttl, maxsize):
+        super().__init__(ttl)
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, chat_id):
+        with self._lock:
+            entry = self._states.get(chat_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._states[chat_id]
+                return None
+            return entry[1]
+
+    def save(self, chat_id, data):
+        with self._lock:
+            self._states[chat_id] = (time.monotonic() + self.ttl, data)
+            self._states.move_to_end(chat_id)
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+                self.evictions += 1
+                SESSION_EVICTIONS.inc()
+
+    def remove(self, chat_id):
+        with self._lock:
+            return self._states.pop(chat_id, None) is not None
+
+    def sweep(self, batch_size=500):
+        # Entries are kept in write order, so the expired ones are at the front
+        removed = 0
+        now = time.monotonic()
+        with self._lock:
+            while removed < batch_size and self._states:
+                chat_id, (expires_at, _) = next(iter(self._states.items()))
+                if expires_at > now:
+                    break
+                del self._states[chat_id]
+                removed += 1
+        return removed
+
+
+class SQLSessionStore(SessionStore):
+    """Store shared by every replica, kept in the conversation_state table of the schema migrations"""
+    def __init__(self, ttl, engine):
+        super().__init__(ttl)
+        self.engine = engine
+        self.Session = sessionmaker(bind=engine)
+        self._upsert = self._upsert_statement()
+
+    def _upsert_statement(self):
+        """Return a dialect-native INSERT ... ON CONFLICT on the chat id, if available"""
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            return None
+        stmt = insert(ConversationState.__table__)
+        return stmt.on_conflict_do_update(
+            index_elements=['chat_id'],
+            set_={'state': stmt.excluded.state, 'expires_at': stmt.excluded.expires_at}
+        )
+
+    def load(self, chat_id):
+        with self.Session() as session:
+            return session.scalar(select(ConversationState.state).where(
+                ConversationState.chat_id == chat_id,
+                ConversationState.expires_at > time.time()
+            ))
+
+    def save(self, chat_id, data):
+        values = {'chat_id': chat_id, 'state': data, 'expires_at': time.time() + self.ttl}
+        with self.Session() as session, session.begin():
+            if self._upsert is not None:
+                # One statement: two replicas saving the first state of a chat together do not collide
+                session.execute(self._upsert, values)
+            else:
+                session.merge(ConversationState(**values))
+
+    def remove(self, chat_id):
+        with self.Session() as session, session.begin():
+            return session.execute(delete(ConversationState).where(ConversationState.chat_id == chat_id)).rowcount > 0
+
+    def sweep(self, batch_size=500):
+        with self.Session() as session, session.begin():
+            expired = select(ConversationState.chat_id).where(
+                ConversationState.expires_at <= time.time()
+            ).limit(batch_size).scalar_subquery()
+            return session.execute(delete(ConversationState).where(ConversationState.chat_id.in_(expired))).rowcount
+
+
+class RedisSessionStore(SessionStore):
+    """Store on a Redis-protocol server, which expires the keys by itself"""
+    def __init__(self, ttl, url, prefix='fec:session:'):
+        super().__init__(ttl)
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("SESSION_BACKEND=redis needs the redis package: pip install -r requirements-redis.txt") from e
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def load(self, chat_id):
+        data = self.redis.get(f"{self.prefix}{chat_id}")
+        return data.decode('utf-8') if data is not None else None
+
+    def save(self, chat_id, data):
+        self.redis.set(f"{self.prefix}{chat_id}", data, ex=int(self.ttl))
+
+    def remove(self, chat_id):
+        return self.redis.delete(f"{self.prefix}{chat_id}") > 0
+
+
+def create_session_store(engine):
+    """Build the store selected by SESSION_BACKEND (memory, sql or redis)"""
+    backend = os.getenv('SESSION_BACKEND', 'memory')
+    ttl = int(os.getenv('SESSION_TTL', '60'))
+    if backend == 'sql':
+        store = SQLSessionStore(ttl, engine)
+    elif backend == 'redis':
+        store = RedisSessionStore(ttl, os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+    else:
+        store = MemorySessionStore(ttl, int(os.getenv('SESSION_MAXSIZE', '100000')))
+    store.start_sweeper(int(os.getenv('SESSION_SWEEP_INTERVAL', '30')))
+    return store
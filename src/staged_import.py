@@ -0,0 +1,275 @@
+"""
+Staged registry import. A registry is loaded into staging tables, validated,
+archived as a version and published to the live tables.
+
+Publishing does not swap tables or flip a version pointer: the DAO, the
+catalog and the foreign keys of the subscriptions and rankings all read the
+live tables. It upserts the rows that differ and deletes the missing ones in
+a single transaction instead. Readers at READ COMMITTED or stricter, the
+default of Postgres and SQLite, see either the old registry or the new one.
+A failed publish rolls back whole and the previous version stays live and
+archived, and rollback() republishes any archived version.
+"""
+from bot_db_entities import City, Neighborhood, CriminalCategory, Store, ImportRowHash, RegistryVersion
+from sqlalchemy import MetaData, Table, Column, Integer, select, insert, delete, update, func, true, or_, literal
+from sqlalchemy.orm import sessionmaker
+from datetime import datetime
+from metrics import REGISTRY
+import logging
+import time
+
+# Parents first, so that inserts resolve their foreign keys and deletes go in reverse
+MODELS = (CriminalCategory, City, Neighborhood, Store)
+
+# (child, foreign key column, parent) checked before every publish
+REFERENCES = [
+    (Neighborhood, 'city_id', City),
+    (Store, 'neighborhood_id', Neighborhood),
+    (Store, 'criminal_category_id', CriminalCategory),
+]
+
+
+# Shared with the incremental import of DatabaseUpdater
+IMPORT_TABLE_SECONDS = REGISTRY.histogram(
+    'bot_import_table_seconds', 'Time to stage, write or delete the rows of each table of a registry import', ['table', 'phase']
+)
+IMPORT_ROWS = REGISTRY.counter('bot_import_rows_total', 'Rows written, skipped, refused or deleted by a registry import', ['table', 'action'])
+
+
+class RegistryIntegrityError(ValueError):
+    pass
+
+
+def refuse_orphans(model, rows, known_ids, logger):
+    """
+    Drop the rows of a table whose parent is unknown, logging and counting
+    them: one bad row does not reject the whole registry.
+    Args:
+        rows: Row dicts of the table, filtered in place
+        known_ids: Ids each reference may point to, keyed by parent model
+    Returns:
+        The ids of the refused rows
+    """
+    all_refused = set()
+    for child, column, parent in REFERENCES:
+        if child is not model:
+            continue
+        refused_ids = {row['id'] for row in rows if row[column] not in known_ids[parent]}
+        if not refused_ids:
+            continue
+        all_refused |= refused_ids
+        rows[:] = [row for row in rows if row['id'] not in refused_ids]
+        IMPORT_ROWS.inc(len(refused_ids), table=model.__tablename__, action='refused')
+        logger.warning(f"{model.__tablename__}: {len(refused_ids)} rows refused, unknown {column}: {sorted(refused_ids)}")
+    return all_refused
+
+
+def _copy_columns(table):
+    return [Column(column.name, column.type, primary_key=column.primary_key, autoincrement=False)
+            for column in table.columns]
+
+
+# Copies of the live tables, created by the schema migrations: the registry being
+# validated, and the published versions kept for rollback
+METADATA = MetaData()
+STAGING = {
+    model: Table(f'staging_{model.__tablename__}', METADATA, *_copy_columns(model.__table__))
+    for model in MODELS
+}
+ARCHIVE = {
+    model: Table(f'archive_{model.__tablename__}', METADATA,
+                 Column('version_id', Integer, primary_key=True, autoincrement=False),
+                 *_copy_columns(model.__table__))
+    for model in MODELS
+}
+
+
+class StagedImporter:
+    """
+    Loads a registry into staging tables, validates it and publishes it to the
+    live tables with one short set-based transaction. Rows with an unknown
+    parent are refused, as in the incremental import. Every published registry
+    is archived as a version that can be published again to roll back.
+    The caller serializes the imports and rollbacks of all the replicas,
+    as DatabaseUpdater does with its import lock.
+    """
+    def __init__(self, engine, update_columns, batch_size=1000, versions_kept=3):
+        """
+        Args:
+            update_columns: Columns rewritten on existing rows, keyed by model
+            versions_kept: Number of archived versions kept for rollback
+        """
+        self.logger = logging.getLogger('StagedImporter')
+        # Il publish usa ON CONFLICT, presente solo in questi due dialetti
+        if engine.dialect.name not in ('postgresql', 'sqlite'):
+            raise ValueError(
+                f"Staged import is not supported on {engine.dialect.name}, use IMPORT_MODE=incremental"
+            )
+        self.engine = engine
+        self.update_columns = update_columns
+        self.batch_size = batch_size
+        self.versions_kept = versions_kept
+        self.Session = sessionmaker(bind=engine)
+        self.staging = STAGING
+        self.archive = ARCHIVE
+
+    def _insert_statement(self, table):
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        return dialect_insert(table)
+
+    def _live_rows(self, session, model, ids):
+        """The live rows with the given ids, as row dicts"""
+        ids = list(ids)
+        rows = []
+        for i in range(0, len(ids), self.batch_size):
+            rows.extend(dict(row) for row in session.execute(
+                select(model.__table__).where(model.__table__.c.id.in_(ids[i:i + self.batch_size]))
+            ).mappings())
+        return rows
+
+    def _stage(self, session, records, now, kept_ids):
+        # The live rows missing from the registry are deleted: only the staged parents count
+        known_ids = {}
+        for model in MODELS:
+            with IMPORT_TABLE_SECONDS.time(table=model.__tablename__, phase='stage'):
+                staging = self.staging[model]
+                session.execute(delete(staging))
+                # Le righe saltate dal chiamante restano come sono nel database
+                rows = list(records[model]) + self._live_rows(session, model, kept_ids.get(model, ()))
+                refuse_orphans(model, rows, known_ids, self.logger)
+                known_ids[model] = {row['id'] for row in rows}
+                rows = [dict(row, created_at=now, **({'updated_at': now} if model is Store else {})) for row in rows]
+                for i in range(0, len(rows), self.batch_size):
+                    session.execute(insert(staging), rows[i:i + self.batch_size])
+
+    def _stage_version(self, session, version_id):
+        for model in MODELS:
+            staging, archive = self.staging[model], self.archive[model]
+            columns = [column.name for column in staging.columns]
+            session.execute(delete(staging))
+            session.execute(insert(staging).from_select(
+                columns, select(*[archive.c[name] for name in columns]).where(archive.c.version_id == version_id)
+            ))
+
+    def _validate(self, session):
+        """
+        Check every foreign key of the staged registry with one anti-join per
+        reference. A new registry has its orphans refused while staged: this
+        guards the archived versions staged again by rollback().
+        """
+        errors = []
+        for child, column, parent in REFERENCES:
+            child_table, parent_table = self.staging[child], self.staging[parent]
+            orphans = session.scalar(select(func.count()).select_from(child_table).where(
+                child_table.c[column].not_in(select(parent_table.c.id))
+            ))
+            if orphans:
+                errors.append(f"{orphans} {child.__tablename__} rows with unknown {column}")
+        if errors:
+            raise RegistryIntegrityError("Invalid registry: " + '; '.join(errors))
+
+    def _archive(self, session):
+        store_count = session.scalar(select(func.count()).select_from(self.staging[Store]))
+        version = RegistryVersion(created_at=datetime.now(), store_count=store_count, active=False)
+        session.add(version)
+        session.flush()
+        for model in MODELS:
+            staging, archive = self.staging[model], self.archive[model]
+            columns = [column.name for column in staging.columns]
+            session.execute(insert(archive).from_select(
+                ['version_id'] + columns, select(literal(version.id), *[staging.c[name] for name in columns])
+            ))
+        return version.id
+
+    def _publish(self, session, version_id):
+        """Apply the staged registry to the live tables, touching only the rows that differ"""
+        for model in MODELS:
+            live, staging = model.__table__, self.staging[model]
+            columns = [column.name for column in live.columns]
+            compared = [name for name in self.update_columns[model] if name != 'updated_at']
+            stmt = self._insert_statement(live).from_select(
+                columns, select(*[staging.c[name] for name in columns]).where(true())
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['id'],
+                set_={name: stmt.excluded[name] for name in self.update_columns[model]},
+                where=or_(*[live.c[name].is_distinct_from(stmt.excluded[name]) for name in compared])
+            )
+            with IMPORT_TABLE_SECONDS.time(table=model.__tablename__, phase='write'):
+                written = session.execute(stmt).rowcount
+            self.logger.info(f"{model.__tablename__}: {written} rows inserted or updated")
+
+        for model in reversed(MODELS):
+            live, staging = model.__table__, self.staging[model]
+            with IMPORT_TABLE_SECONDS.time(table=model.__tablename__, phase='delete'):
+                deleted = session.execute(delete(live).where(live.c.id.not_in(select(staging.c.id)))).rowcount
+            if deleted:
+                self.logger.info(f"{model.__tablename__}: {deleted} rows deleted")
+
+        # The row hashes of the incremental import no longer describe the live tables
+        session.execute(delete(ImportRowHash))
+        session.execute(update(RegistryVersion).values(active=RegistryVersion.id == version_id))
+
+    def _prune(self, session):
+        kept = select(RegistryVersion.id).order_by(RegistryVersion.id.desc()).limit(self.versions_kept)
+        old_ids = list(session.scalars(select(RegistryVersion.id).where(
+            RegistryVersion.id.not_in(kept.scalar_subquery()), RegistryVersion.active.is_(False)
+        )))
+        if old_ids:
+            for archive in self.archive.values():
+                session.execute(delete(archive).where(archive.c.version_id.in_(old_ids)))
+            session.execute(delete(RegistryVersion).where(RegistryVersion.id.in_(old_ids)))
+
+    def import_records(self, records, kept_ids=None):
+        """
+        Stage, validate, archive and publish a registry.
+        Args:
+            records: Lists of row dicts keyed by model, without timestamps
+            kept_ids: Ids of the rows left out of the records whose live copy
+                is staged in their place, keyed by model
+        Returns:
+            The id of the published version
+        """
+        start = time.perf_counter()
+        # Staging and archiving never touch the live tables
+        with self.Session() as session, session.begin():
+            self._stage(session, records, datetime.now(), kept_ids or {})
+            self._validate(session)
+            version_id = self._archive(session)
+        staged = time.perf_counter()
+
+        with self.Session() as session, session.begin():
+            self._publish(session, version_id)
+        published = time.perf_counter()
+
+        with self.Session() as session, session.begin():
+            self._prune(session)
+        self.logger.info(
+            f"Version {version_id} staged in {staged - start:.3f}s, published in {published - staged:.3f}s"
+        )
+        return version_id
+
+    def versions(self):
+        with self.Session() as session:
+            return session.query(RegistryVersion).order_by(RegistryVersion.id.desc()).all()
+
+    def rollback(self, version_id=None):
+        """Publish an archived version again, by default the one before the active version"""
+        with self.Session() as session, session.begin():
+            if version_id is None:
+                active_id = session.scalar(select(RegistryVersion.id).where(RegistryVersion.active.is_(True)))
+                version_id = session.scalar(select(func.max(RegistryVersion.id)).where(RegistryVersion.id < (active_id or 0)))
+            if version_id is None or session.get(RegistryVersion, version_id) is None:
+                raise ValueError("No archived version to roll back to")
+            self._stage_version(session, version_id)
+            self._validate(session)
+
+        start = time.perf_counter()
+        with self.Session() as session, session.begin():
+            self._publish(session, version_id)
+        self.logger.info(f"Rolled back to version {version_id} in {time.perf_counter() - start:.3f}s")
+        return version_id
@@ -0,0 +1,177 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from telebot import types
+import hmac
+import json
+import logging
+import queue
+import threading
+
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookServer:
+    """
+    Embedded HTTP server receiving Telegram updates. Every accepted update is
+    pushed onto the bounded queue of one worker thread, chosen by its chat,
+    so the updates of a chat are dispatched one at a time and in order;
+    when the queue is full the request is refused with 503 so that Telegram
+    retries it later.
+    """
+    def __init__(self, dispatch, secret_token=None, host='0.0.0.0', port=80, path='/webhook',
+                 queue_size=1000, workers=8, enqueue_timeout=0.0):
+        """
+        Args:
+            dispatch: Callable receiving a list of telebot Update objects
+            secret_token: Expected X-Telegram-Bot-Api-Secret-Token header, if any
+            queue_size: Maximum number of updates waiting for the workers, split among them
+            workers: Number of threads dispatching updates
+            enqueue_timeout: Seconds to wait for a free queue slot before answering 503
+        """
+        self.logger = logging.getLogger('WebhookServer')
+        self.dispatch = dispatch
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.workers = workers
+        self.enqueue_timeout = enqueue_timeout
+        self.queue_size = queue_size
+        self.queues = [queue.Queue(maxsize=max(1, -(-queue_size // workers))) for _ in range(workers)]
+        self.routes = {'/health': self._health}
+        self._threads = []
+        self._httpd = None
+
+    def add_route(self, path, handler):
+        """Expose a GET endpoint; handler returns (status, content type, body bytes)"""
+        self.routes[path] = handler
+
+    def _health(self):
+        alive = sum(1 for thread in self._threads if thread.is_alive())
+        body = {
+            'status': 'ok' if alive == self.workers else 'degraded',
+            'queue_depth': self.queue_depth(),
+            'queue_size': self.queue_size,
+            'workers_alive': alive,
+        }
+        return (200 if alive else 503), 'application/json', json.dumps(body).encode('utf-8')
+
+    def queue_depth(self):
+        return sum(updates.qsize() for updates in self.queues)
+
+    @staticmethod
+    def _chat_id(update):
+        """Chat of an update, or the user for the updates outside a chat"""
+        for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+            if message is not None:
+                return message.chat.id
+        if update.callback_query is not None:
+            message = update.callback_query.message
+            return message.chat.id if message is not None else update.callback_query.from_user.id
+        for query in (update.inline_query, update.chosen_inline_result, update.shipping_query, update.pre_checkout_query):
+            if query is not None:
+                return query.from_user.id
+        return update.update_id
+
+    def _worker(self, updates):
+        while True:
+            update = updates.get()
+            if update is None:
+                break
+            try:
+                self.dispatch([update])
+            except Exception as e:
+                self.logger.error(f"Error dispatching update {update.update_id}: {e}")
+            finally:
+                updates.task_done()
+
+    def authorized(self, secret_token):
+        """True if the secret token header matches the one given to Telegram"""
+        return self.secret_token is None or hmac.compare_digest(secret_token or '', self.secret_token)
+
+    def enqueue(self, body, secret_token=None):
+        """Parse an update and queue it, returning the HTTP status for the caller"""
+        if not self.authorized(secret_token):
+            return 403
+        try:
+            update = types.Update.de_json(body)
+        except Exception as e:
+            self.logger.warning(f"Invalid update received: {e}")
+            return 400
+        # Sempre lo stesso worker per una chat: i suoi update non si sorpassano
+        updates = self.queues[self._chat_id(update) % self.workers]
+        try:
+            if self.enqueue_timeout:
+                updates.put(update, timeout=self.enqueue_timeout)
+            else:
+                updates.put_nowait(update)
+        except queue.Full:
+            self.logger.warning("Update queue full, rejecting update")
+            return 503
+        return 200
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, content_type='text/plain', body=b''):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if status == 503:
+                    self.send_header('Retry-After', '1')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                route = server.routes.get(self.path.split('?', 1)[0])
+                if route is None:
+                    self._reply(404)
+                    return
+                self._reply(*route())
+
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                secret_token = self.headers.get('X-Telegram-Bot-Api-Secret-Token')
+                # Prima di leggere il corpo: chi non conosce il segreto non occupa il thread
+                if not server.authorized(secret_token):
+                    self._reply(403)
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self._reply(400)
+                    return
+                if length > MAX_BODY_SIZE:
+                    self._reply(413)
+                    return
+                body = self.rfile.read(length).decode('utf-8')
+                self._reply(server.enqueue(body, secret_token))
+
+            def log_message(self, format, *args):
+                server.logger.debug(format % args)
+
+        return Handler
+
+    def start(self):
+        """Start the workers and the HTTP server in background threads"""
+        for i, updates in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(updates,), name=f'webhook-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._httpd = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self._httpd.daemon_threads = True
+        # Con port=0 la porta è scelta dal sistema
+        self.port = self._httpd.server_address[1]
+        threading.Thread(target=self._httpd.serve_forever, name='webhook-http', daemon=True).start()
+        self.logger.info(f"Webhook server listening on {self.host}:{self.port}{self.path}")
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+        for updates in self.queues:
+            updates.put(None)
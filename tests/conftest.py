@@ -0,0 +1,23 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# I moduli del bot sono piatti in src/, i generatori dei file di registro in benchmarks/
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pytest
+from sqlalchemy import create_engine
+
+from synthetic_tables import seed
+from schema_migrations import migrate
+
+
+@pytest.fixture
+def seeded_engine(tmp_path):
+    """Migrated SQLite database with 500 synthetic stores"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'bot.db'}")
+    migrate(engine)
+    seed(engine, 500)
+    yield engine
+    engine.dispose()
@@ -0,0 +1,42 @@
+"""
+Synthetic rows written straight into the registry tables, for the tests and
+the benchmarks that need a filled database without going through an import.
+"""
+import random
+from datetime import datetime
+
+from sqlalchemy import insert, text
+
+from bot_db_entities import City, Neighborhood, CriminalCategory, Store
+
+CITIES = 100
+NEIGHBORHOODS_PER_CITY = 50
+CATEGORIES = 10
+BATCH = 10000
+
+
+def seed(engine, stores, seed=42):
+    """Fill the registry tables with synthetic stores spread over every neighborhood and category"""
+    rng = random.Random(seed)
+    now = datetime.now()
+    neighborhoods = CITIES * NEIGHBORHOODS_PER_CITY
+    with engine.begin() as connection:
+        connection.execute(insert(CriminalCategory), [
+            {'id': i, 'title': f'categoria {i}', 'created_at': now} for i in range(1, CATEGORIES + 1)
+        ])
+        connection.execute(insert(City), [
+            {'id': i, 'name': f'Citta {i}', 'created_at': now} for i in range(1, CITIES + 1)
+        ])
+        connection.execute(insert(Neighborhood), [
+            {'id': i, 'name': f'Quartiere {i}', 'city_id': (i - 1) // NEIGHBORHOODS_PER_CITY + 1, 'created_at': now}
+            for i in range(1, neighborhoods + 1)
+        ])
+        for start in range(1, stores + 1, BATCH):
+            connection.execute(insert(Store), [
+                {'id': i, 'name': f'Locale {i}', 'address': f'Via {i}', 'vote': round(rng.uniform(4, 10), 1),
+                 'maps_link': None, 'full_vote': False, 'comment': None, 'created_at': now,
+                 'criminal_category_id': rng.randint(1, CATEGORIES), 'neighborhood_id': rng.randint(1, neighborhoods)}
+                for i in range(start, min(start + BATCH, stores + 1))
+            ])
+        if engine.dialect.name == 'postgresql':
+            connection.execute(text('ANALYZE'))
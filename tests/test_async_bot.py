@@ -0,0 +1,152 @@
+"""AsyncBOT served through its webhook, answering against the fake Bot API"""
+import asyncio
+import itertools
+import json
+import socket
+import threading
+import time
+import urllib.request
+
+import pytest
+from telebot import apihelper, asyncio_helper
+
+from async_bot import AsyncBOT
+from bot import STEP_NEIGHBORHOOD, CATEGORIES_TEXT
+from fake_bot_api import FakeBotAPI
+from synthetic_registry import generate
+
+CHAT_ID = 5002
+WELCOME = 'Benvenuto nel bot'
+UPDATE_IDS = itertools.count(1)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    api = FakeBotAPI().start()
+    monkeypatch.setattr(apihelper, 'API_URL', api.url + '/bot{0}/{1}')
+    monkeypatch.setattr(asyncio_helper, 'API_URL', asyncio_helper.API_URL)
+    monkeypatch.setenv('TELEGRAM_API_URL', api.url)
+    registry = str(tmp_path / 'registry.xlsx')
+    generate(registry, stores=50, cities=2, neighborhoods_per_city=3, seed=3)
+    monkeypatch.setenv('FILE_PATH', registry)
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setenv('BOT_MODE', 'webhook')
+    port = free_port()
+    monkeypatch.setenv('WEBHOOK_PORT', str(port))
+    monkeypatch.setenv('OUTBOX_GLOBAL_RATE', '1000')
+    monkeypatch.setenv('OUTBOX_CHAT_RATE', '1000')
+    monkeypatch.setenv('CHECK_INTERVAL', '3600')
+    monkeypatch.setenv('DB_EXECUTOR_WORKERS', '2')
+    instance = AsyncBOT('123:test')
+    assert instance.db_updater.update_from_excel()
+
+    servers = []
+    create_webhook_server = instance.create_webhook_server
+
+    def capture(dispatch):
+        servers.append(create_webhook_server(dispatch))
+        return servers[0]
+    monkeypatch.setattr(instance, 'create_webhook_server', capture)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    webhook = asyncio.run_coroutine_threadsafe(instance.run_webhook(), loop)
+    deadline = time.monotonic() + 5
+    while not servers and time.monotonic() < deadline:
+        time.sleep(0.01)
+    instance.webhook_port = port
+    try:
+        yield instance, api
+    finally:
+        webhook.cancel()
+        servers[0].stop()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        instance.outbox.stop()
+        instance.executor.shutdown(wait=True)
+        instance.database.dispose()
+        api.stop()
+
+
+def post(instance, update):
+    request = urllib.request.Request(f'http://127.0.0.1:{instance.webhook_port}/webhook', data=json.dumps(update).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=5) as response:
+        assert response.status == 200
+
+
+def deliver(instance, api, update, expected=1):
+    """POST an update to the webhook and return the replies sent by the time `expected` arrived"""
+    sent = len(api.sent)
+    post(instance, update)
+    # Webhook, loop, pool del database e coda di uscita: le risposte arrivano dopo il 200
+    deadline = time.monotonic() + 5
+    while len(api.sent) - sent < expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    return [(method, reply) for _, method, _, reply in api.sent[sent:]]
+
+
+def message(text, update_id=None):
+    update_id = update_id or next(UPDATE_IDS)
+    body = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': CHAT_ID, 'type': 'private'},
+            'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'Mario'}}
+    if text.startswith('/'):
+        body['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': body}
+
+
+def callback(data):
+    update_id = next(UPDATE_IDS)
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'data': data, 'chat_instance': '1',
+        'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'Mario'},
+        'message': {'message_id': 1, 'date': int(time.time()), 'text': CATEGORIES_TEXT,
+                    'chat': {'id': CHAT_ID, 'type': 'private'}},
+    }}
+
+
+def texts(replies):
+    return [reply for _, reply in replies]
+
+
+def test_pending_step_flow(bot):
+    instance, api = bot
+    assert texts(deliver(instance, api, message('/start')))[0].startswith(WELCOME)
+    deliver(instance, api, message('/quartiere'))
+    assert instance.get_user_step(CHAT_ID) == STEP_NEIGHBORHOOD
+
+    # Il filtro coroutine has_pending_step manda il testo al gestore del passo in sospeso
+    replies = texts(deliver(instance, api, message('Trastevere 42')))
+    assert replies == ['Il nome contiene caratteri non validi Riprova da /quartiere']
+    assert instance.get_user_step(CHAT_ID) is None
+    assert texts(deliver(instance, api, message('Trastevere'), expected=0)) == []
+
+
+def test_repeated_update_is_answered_once(bot):
+    instance, api = bot
+    deliver(instance, api, message('/start'))
+    # Il gestore gira sul pool del database: la chiave dell'update ci arriva solo copiando il contesto
+    update = message('/quartiere')
+    first = texts(deliver(instance, api, update))
+    assert len(first) == 1
+    assert texts(deliver(instance, api, update, expected=0)) == []
+
+
+def test_rendering_handlers(bot):
+    instance, api = bot
+    deliver(instance, api, message('/start'))
+    assert texts(deliver(instance, api, message('/categorie'))) == [CATEGORIES_TEXT]
+
+    category = instance.db_dao.get_categories()[0]
+    answers = api.callback_answers
+    replies = texts(deliver(instance, api, callback(str(category.id))))
+    assert api.callback_answers == answers + 1
+    assert len(replies) == 1 and replies[0].startswith(f'Hai selezionato {instance.category_label(category)}')
@@ -0,0 +1,79 @@
+"""The conversation of BOT, driven in process against the fake Bot API"""
+import itertools
+import time
+
+import pytest
+from telebot import apihelper, types
+
+from fake_bot_api import FakeBotAPI
+from bot import BOT, STEP_NEIGHBORHOOD
+
+CHAT_ID = 5001
+WELCOME = 'Benvenuto nel bot'
+CATEGORIES = 'Scegli la categoria criminale'
+UPDATE_IDS = itertools.count(1)
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    api = FakeBotAPI().start()
+    monkeypatch.setattr(apihelper, 'API_URL', api.url + '/bot{0}/{1}')
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    # Senza thread di TeleBot gli handler girano nel thread del test
+    monkeypatch.setenv('BOT_MODE', 'webhook')
+    monkeypatch.setenv('OUTBOX_GLOBAL_RATE', '1000')
+    monkeypatch.setenv('OUTBOX_CHAT_RATE', '1000')
+    monkeypatch.setenv('CHECK_INTERVAL', '3600')
+    instance = BOT('123:test')
+    try:
+        yield instance, api
+    finally:
+        instance.outbox.stop()
+        instance.database.dispose()
+        api.stop()
+
+
+def send(instance, api, text):
+    """Handle a text message of CHAT_ID and return the replies it got"""
+    update_id = next(UPDATE_IDS)
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+               'chat': {'id': CHAT_ID, 'type': 'private'},
+               'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'Mario'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    sent = len(api.sent)
+    # Un update_id già visto è una ripetizione di Telegram, e non ha risposta
+    instance.bot.process_new_updates([types.Update.de_json({'update_id': update_id, 'message': message})])
+    # Le risposte partono dai worker della coda
+    deadline = time.monotonic() + 5
+    while instance.outbox.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    return [reply for _, _, _, reply in api.sent[sent:]]
+
+
+def test_commands_leave_a_pending_step(bot):
+    instance, api = bot
+    assert send(instance, api, '/start')[0].startswith(WELCOME)
+    send(instance, api, '/quartiere')
+    assert instance.get_user_step(CHAT_ID) == STEP_NEIGHBORHOOD
+
+    replies = send(instance, api, '/start')
+    assert len(replies) == 1 and replies[0].startswith(WELCOME)
+    assert instance.get_user_step(CHAT_ID) is None
+
+    send(instance, api, '/quartiere')
+    replies = send(instance, api, '/categorie')
+    assert len(replies) == 1 and replies[0].startswith(CATEGORIES)
+    assert instance.get_user_step(CHAT_ID) is None
+
+
+def test_invalid_name_does_not_rearm_the_step(bot):
+    instance, api = bot
+    send(instance, api, '/start')
+    send(instance, api, '/quartiere')
+    replies = send(instance, api, 'Trastevere 42')
+    assert replies == ['Il nome contiene caratteri non validi Riprova da /quartiere']
+    assert instance.get_user_step(CHAT_ID) is None
+    # Il testo che segue non è più preso per un quartiere
+    assert send(instance, api, 'Trastevere') == []
@@ -0,0 +1,79 @@
+"""The DAO answers the same with the in-memory catalog and with the SQL queries"""
+import pytest
+
+from catalog import Catalog
+from dao import DAO
+from database import Database
+from database_updater import DatabaseUpdater
+from synthetic_registry import CATEGORIES, city_name, generate, neighborhood_name
+
+CITIES = 3
+NEIGHBORHOODS_PER_CITY = 4
+
+
+def ids(rows):
+    return [row.id for row in rows]
+
+
+@pytest.fixture
+def daos(tmp_path, monkeypatch):
+    registry = str(tmp_path / 'registry.xlsx')
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setenv('FILE_PATH', registry)
+    generate(registry, stores=400, cities=CITIES, neighborhoods_per_city=NEIGHBORHOODS_PER_CITY, seed=3)
+    database = Database()
+    catalog_dao = DAO(database)
+    monkeypatch.setenv('CATALOG_ENABLED', 'false')
+    sql_dao = DAO(database)
+    assert catalog_dao.catalog is not None and sql_dao.catalog is None
+    assert DatabaseUpdater(database).update_from_excel()
+    try:
+        yield catalog_dao, sql_dao
+    finally:
+        database.dispose()
+
+
+def test_lookups_match_the_sql_queries(daos):
+    catalog_dao, sql_dao = daos
+    assert ids(catalog_dao.get_categories()) == ids(sql_dao.get_categories()) == list(range(1, len(CATEGORIES) + 1))
+
+    for city_id in range(1, CITIES + 2):
+        name = city_name(city_id)
+        for typed in (name, name.upper(), f'  {name.title()} '):
+            assert getattr(catalog_dao.find_city(typed), 'id', None) == getattr(sql_dao.find_city(typed), 'id', None)
+        assert getattr(catalog_dao.get_city(city_id), 'name', None) == getattr(sql_dao.get_city(city_id), 'name', None)
+
+    neighborhood_count = CITIES * NEIGHBORHOODS_PER_CITY
+    for neighborhood_id in range(1, neighborhood_count + 2):
+        name = neighborhood_name(neighborhood_id)
+        for city_id in range(1, CITIES + 1):
+            found = catalog_dao.find_neighborhood(name.upper(), city_id)
+            assert getattr(found, 'id', None) == getattr(sql_dao.find_neighborhood(name.upper(), city_id), 'id', None)
+        neighborhood = catalog_dao.get_neighborhood(neighborhood_id)
+        assert getattr(neighborhood, 'city_id', None) == getattr(sql_dao.get_neighborhood(neighborhood_id), 'city_id', None)
+
+        for category_id in range(1, len(CATEGORIES) + 1):
+            stores = catalog_dao.get_stores(neighborhood_id, category_id)
+            assert ids(stores) == ids(sql_dao.get_stores(neighborhood_id, category_id))
+            assert [store.vote for store in stores] == sorted((store.vote for store in stores), reverse=True)
+
+
+def test_rankings_match_the_sql_queries(daos):
+    catalog_dao, sql_dao = daos
+    for category_id in range(1, len(CATEGORIES) + 1):
+        assert ids(catalog_dao.get_ranked_cities(category_id)) == ids(sql_dao.get_ranked_cities(category_id))
+        for city_id in range(1, CITIES + 1):
+            assert ids(catalog_dao.get_ranking(city_id, category_id)) == ids(sql_dao.get_ranking(city_id, category_id))
+            assert [stats.neighborhood_id for stats in catalog_dao.get_neighborhood_stats(city_id, category_id)] == \
+                [stats.neighborhood_id for stats in sql_dao.get_neighborhood_stats(city_id, category_id)]
+
+
+def test_search_by_store_name_matches(daos):
+    catalog_dao, sql_dao = daos
+    # Senza catalogo si cerca solo il nome del locale, che è anche la parola indicizzata dal catalogo
+    for query in ('Locale 12', 'locale 7', 'Locale 399', 'Locale 401'):
+        assert ids(catalog_dao.search_stores(query)) == ids(sql_dao.search_stores(query))
+
+
+def test_fold_ignores_case_and_spaces():
+    assert Catalog.fold('  Citta BC ') == Catalog.fold('citta bc')
@@ -0,0 +1,119 @@
+"""Timing of the statements and sizing of the pools of Database"""
+import threading
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError, TimeoutError
+
+from sqlalchemy.pool import NullPool
+
+from database import Database, TimedQueuePool, POOL_WAIT_SECONDS, IMPORT_LOCK_KEY
+from dao import DAO
+from database_updater import DatabaseUpdater
+from session_store import SQLSessionStore
+from synthetic_registry import generate
+
+
+def test_failed_statement_does_not_leave_its_start_time(tmp_path):
+    database = Database(url=f"sqlite:///{tmp_path / 'bot.db'}")
+    with database.engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text('SELECT * FROM tabella_che_non_esiste'))
+        assert connection.info.get('query_started_at') == []
+        assert connection.execute(text('SELECT 1')).scalar() == 1
+        assert connection.info['query_started_at'] == []
+    database.dispose()
+
+
+@pytest.mark.parametrize('read_url, sizes', [
+    (None, {'primary': 20}),
+    ('postgresql://bot@replica/bot', {'primary': 5, 'replica': 15}),
+])
+def test_bot_and_updater_share_the_pool_budget(read_url, sizes):
+    # Nessuna connessione è aperta: conta solo come sono dimensionati i pool
+    database = Database(url='postgresql://bot@primary/bot', read_url=read_url, pool_budget=20)
+    updater = DatabaseUpdater(database)
+    assert updater.engine is database.engine
+    assert {pool: stats['size'] for pool, stats in database.pool_stats().items()} == sizes
+    assert sum(sizes.values()) == database.pool_budget
+    for engine in {database.engine, database.read_engine}:
+        assert isinstance(engine.pool, TimedQueuePool)
+        # Nessun overflow: oltre il budget si aspetta
+        assert engine.pool.overflow() == -engine.pool.size()
+    # Il lock degli import ha una connessione sua, fuori dal budget dei pool
+    assert isinstance(database.lock_engine.pool, NullPool)
+    assert database.lock_engine.url == database.engine.url
+    database.dispose()
+
+
+def test_advisory_lock_is_a_no_op_without_postgres(tmp_path):
+    database = Database(url=f"sqlite:///{tmp_path / 'bot.db'}")
+    assert database.lock_engine is None
+    with database.held_advisory_lock(IMPORT_LOCK_KEY) as locked:
+        assert locked is False
+    database.dispose()
+
+
+def test_exhausted_pool_waits_and_is_timed(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'bot.db'}", poolclass=TimedQueuePool,
+                           pool_size=1, max_overflow=0, pool_timeout=0.2)
+    waits = POOL_WAIT_SECONDS.count()
+    with engine.connect():
+        with pytest.raises(TimeoutError):
+            engine.connect()
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT 1')).scalar() == 1
+    assert POOL_WAIT_SECONDS.count() == waits + 3
+    engine.dispose()
+
+
+class SQLiteWithPools(Database):
+    """Database sized like on Postgres, with fixed pools and a lock connection outside them, on SQLite files"""
+    def __init__(self, url, pool_budget):
+        super().__init__(url=url, read_url=url + '?replica=1', pool_budget=pool_budget)
+        self.lock_engine = create_engine(url, poolclass=NullPool)
+
+    @staticmethod
+    def _create_engine(url, pool_size):
+        return create_engine(url, poolclass=TimedQueuePool, pool_size=pool_size, max_overflow=0, pool_timeout=1)
+
+
+def test_import_leaves_a_primary_connection_to_the_writes(tmp_path, monkeypatch):
+    registry = str(tmp_path / 'registry.xlsx')
+    monkeypatch.setenv('FILE_PATH', registry)
+    generate(registry, stores=3000, seed=5)
+    database = SQLiteWithPools(f"sqlite:///{tmp_path / 'bot.db'}", pool_budget=8)
+    assert database.pool_stats()['primary']['size'] == 2
+    dao = DAO(database)
+    updater = DatabaseUpdater(database)
+    updater.add_reload_listener(dao.refresh_catalog)
+    store = SQLSessionStore(60, database.engine)
+
+    checked_out = []
+    event.listen(database.engine.pool, 'checkout', lambda *args: checked_out.append(database.engine.pool.checkedout()))
+    done = threading.Event()
+    writes, errors = [], []
+
+    def write():
+        chat_id = 0
+        while not done.is_set():
+            chat_id += 1
+            try:
+                store[chat_id] = {'step': 'city'}
+                writes.append(chat_id)
+            except Exception as e:
+                errors.append(e)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        assert updater.update_from_excel()
+    finally:
+        done.set()
+        writer.join()
+    # L'import tiene il lock e una connessione alla volta: l'altra resta alle scritture
+    assert errors == [] and writes
+    assert max(checked_out) <= 2
+    assert len(dao.search_stores('Locale 2999')) == 1
+    database.dispose()
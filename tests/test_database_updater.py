@@ -0,0 +1,131 @@
+"""The incremental import writes only the changed rows, keeps the foreign keys of the live tables valid and times each table"""
+import logging
+
+import openpyxl
+import pytest
+from sqlalchemy import select
+
+from bot_db_entities import City, Neighborhood, CriminalCategory, Store
+from dao import DAO
+from database import Database
+from database_updater import DatabaseUpdater
+from metrics import REGISTRY
+from synthetic_registry import generate
+
+
+def _store(store_id, neighborhood_id):
+    return {'id': store_id, 'name': f'Locale {store_id}', 'address': 'Via Roma 1', 'vote': 8.0,
+            'maps_link': 'https://maps.app.goo.gl/x', 'latitude': None, 'longitude': None, 'full_vote': False,
+            'comment': None, 'criminal_category_id': 1, 'neighborhood_id': neighborhood_id}
+
+
+def _registry(neighborhoods, stores):
+    return {
+        CriminalCategory: [{'id': 1, 'title': 'pizza'}],
+        City: [{'id': 1, 'name': 'roma'}],
+        Neighborhood: [{'id': n, 'name': f'quartiere {n}', 'city_id': 1} for n in neighborhoods],
+        Store: stores,
+    }
+
+
+def test_removed_parent_still_referenced_is_kept(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    database = Database()
+    DAO(database)
+    updater = DatabaseUpdater(database)
+
+    updater._apply_incremental(_registry([1, 2], [_store(1, 1), _store(2, 2)]))
+    # Il quartiere 2 sparisce dal foglio ma il locale 2 lo usa ancora; il locale 3 punta a un quartiere inesistente
+    updater._apply_incremental(_registry([1], [_store(1, 1), _store(2, 2), _store(3, 9)]))
+
+    with database.Session() as session:
+        assert set(session.scalars(select(Neighborhood.id))) == {1, 2}
+        assert set(session.scalars(select(Store.id))) == {1, 2}
+
+
+def test_tables_are_timed(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    database = Database()
+    DAO(database)
+    DatabaseUpdater(database)._apply_incremental(_registry([1], [_store(1, 1)]))
+    metrics = REGISTRY.render().decode()
+    for table in ('criminal_category', 'city', 'neighborhood', 'store'):
+        assert f'bot_import_table_seconds_count{{table="{table}",phase="write"}}' in metrics
+
+
+def test_modified_sheet_upserts_and_deletes_the_changed_rows(tmp_path, monkeypatch, caplog):
+    registry = str(tmp_path / 'registry.xlsx')
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setenv('FILE_PATH', registry)
+    generate(registry, stores=200, cities=2, neighborhoods_per_city=5, seed=11)
+    database = Database()
+    DAO(database)
+    updater = DatabaseUpdater(database)
+    assert updater.update_from_excel()
+    with database.Session() as session:
+        before = {store.id: (store.vote, store.updated_at) for store in session.scalars(select(Store))}
+
+    workbook = openpyxl.load_workbook(registry)
+    sheet = workbook['store']
+    # Riga 1 intestazione: il locale n è alla riga n + 1
+    sheet.cell(row=6, column=4).value = before[5][0] + 0.5
+    sheet.delete_rows(11)
+    sheet.append([201, 'Locale 201', 'Via Roma 1', 7.5, 'https://maps.app.goo.gl/new', None, None, False, None, 1, 1])
+    workbook['city'].cell(row=3, column=2).value = 'citta nuova'
+    workbook.save(registry)
+
+    with caplog.at_level(logging.INFO):
+        assert updater.update_from_excel()
+    assert 'store: 1 inserted, 1 updated, 198 unchanged' in caplog.text
+    assert 'store: 1 deleted' in caplog.text
+    assert 'city: 0 inserted, 1 updated, 1 unchanged' in caplog.text
+
+    with database.Session() as session:
+        after = {store.id: (store.vote, store.updated_at) for store in session.scalars(select(Store))}
+        assert session.get(City, 2).name == 'citta nuova'
+    assert after.keys() == (before.keys() - {10}) | {201}
+    assert after[5][0] == before[5][0] + 0.5 and after[5][1] > before[5][1]
+    assert after[201][0] == 7.5
+    # Le righe uguali non vengono riscritte
+    assert all(after[store_id] == before[store_id] for store_id in before.keys() - {5, 10})
+
+
+@pytest.mark.parametrize('mode', ['incremental', 'staged'])
+def test_bad_rows_are_skipped_and_their_live_copy_kept(tmp_path, monkeypatch, caplog, mode):
+    registry = str(tmp_path / 'registry.xlsx')
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setenv('FILE_PATH', registry)
+    monkeypatch.setenv('IMPORT_MODE', mode)
+    generate(registry, stores=50, cities=2, neighborhoods_per_city=3, seed=5)
+    database = Database()
+    DAO(database)
+    updater = DatabaseUpdater(database)
+    assert updater.update_from_excel()
+    with database.Session() as session:
+        before = {store.id: (store.name, store.address, store.vote, store.maps_link) for store in session.scalars(select(Store))}
+
+    workbook = openpyxl.load_workbook(registry)
+    sheet = workbook['store']
+    # Riga 1 intestazione: il locale n è alla riga n + 1
+    sheet.cell(row=6, column=4).value = None
+    sheet.cell(row=7, column=3).value = None
+    sheet.cell(row=8, column=5).value = 'https://example.com/locale'
+    sheet.cell(row=9, column=4).value = 'otto'
+    sheet.cell(row=10, column=2).value = 'Locale rinominato'
+    sheet.append([51, 'Locale 51', None, 7.5, 'https://maps.app.goo.gl/new', None, None, False, None, 1, 1])
+    workbook.save(registry)
+
+    with caplog.at_level(logging.WARNING):
+        assert updater.update_from_excel()
+    assert 'store: 1 rows skipped, missing vote: [5]' in caplog.text
+    assert 'store: 2 rows skipped, missing address: [6, 51]' in caplog.text
+    assert 'store: 1 rows skipped, no valid Google Maps link: [7]' in caplog.text
+    assert "Sheet 'store' row 9 skipped" in caplog.text
+
+    with database.Session() as session:
+        after = {store.id: (store.name, store.address, store.vote, store.maps_link) for store in session.scalars(select(Store))}
+    # Le righe sbagliate restano come erano, le altre sono importate
+    assert after.keys() == before.keys()
+    assert all(after[store_id] == before[store_id] for store_id in (5, 6, 7, 8))
+    assert after[9][0] == 'Locale rinominato'
+    assert REGISTRY.render().decode().count('bot_import_rows_total{table="store",action="skipped"}') == 1
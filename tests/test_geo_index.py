@@ -0,0 +1,39 @@
+"""Nearest-store lookups of GeoIndex on stores far apart"""
+import random
+import time
+from collections import namedtuple
+
+from geo_index import GeoIndex, distance
+
+FakeStore = namedtuple('FakeStore', ['id', 'vote', 'latitude', 'longitude', 'criminal_category_id'])
+
+
+def cluster(first_id, count, latitude, longitude, rng):
+    return [FakeStore(first_id + i, round(rng.uniform(4, 10), 1), latitude + rng.uniform(0, 0.05),
+                      longitude + rng.uniform(0, 0.05), rng.randint(1, 3)) for i in range(count)]
+
+
+def scan(stores, latitude, longitude, max_distance, k, category_id=None):
+    found = [(distance(latitude, longitude, s.latitude, s.longitude), s.id) for s in stores
+             if category_id is None or s.criminal_category_id == category_id]
+    return sorted(item for item in found if item[0] <= max_distance)[:k]
+
+
+def test_nearest_on_sparse_stores_stays_within_max_distance():
+    rng = random.Random(5)
+    # Roma, Milano e Palermo: tra i gruppi solo celle vuote
+    stores = cluster(1, 200, 41.88, 12.47, rng) + cluster(1000, 200, 45.45, 9.17, rng) + cluster(2000, 5, 38.11, 13.34, rng)
+    index = GeoIndex(stores)
+
+    points = [(41.9, 12.5), (45.46, 9.19), (38.12, 13.36), (43.5, 11.0), (36.0, 15.0)]
+    start = time.perf_counter()
+    for latitude, longitude in points:
+        for category_id in (None, 2):
+            got = [(round(meters, 6), store.id) for meters, store in index.nearest(latitude, longitude, 20000, 10, category_id)]
+            expected = [(round(meters, 6), store_id) for meters, store_id in scan(stores, latitude, longitude, 20000, 10, category_id)]
+            assert got == expected
+    # Un punto tra le città non visita le celle vuote fino alla più vicina
+    assert time.perf_counter() - start < 0.5
+    assert index.nearest(43.5, 11.0, 20000) == []
+    assert len(index.nearest(38.12, 13.36, 20000, 10)) == 5
+    assert GeoIndex([]).nearest(41.9, 12.5, 20000) == []
@@ -0,0 +1,72 @@
+"""Cache of the inline answers, shared by the queries with the same prefix and dropped on every import"""
+from collections import namedtuple
+
+from inline_search import InlineSearch
+from prefix_index import PrefixIndex
+
+Store = namedtuple('Store', 'id name address vote full_vote maps_link comment')
+
+
+def store(id, name, vote):
+    return Store(id, name, 'Via Roma 1', vote, False, None, None)
+
+
+class Catalog:
+    """Stand-in for the DAO: a PrefixIndex replaced by every import, counting the searches"""
+    def __init__(self, stores):
+        self.searches = 0
+        self.load(stores)
+
+    def load(self, stores):
+        self.index = PrefixIndex(sorted(stores, key=lambda s: -s.vote), lambda s: (s.name,))
+
+    def search(self, query, k):
+        self.searches += 1
+        return self.index.search(query, k)
+
+
+def titles(articles):
+    return [article.title for article in articles]
+
+
+def test_same_prefix_is_answered_from_the_cache():
+    catalog = Catalog([store(1, 'Carbonara', 8), store(2, 'Caffè Roma', 9), store(3, 'Pizza', 7)])
+    search = InlineSearch(max_results=5)
+    assert titles(search.results('caf', catalog.search, str)) == ['Caffè Roma']
+    # Maiuscole, accenti e spazi danno la stessa chiave
+    assert titles(search.results('  CAFFÈ', catalog.search, str)) == ['Caffè Roma']
+    assert titles(search.results('Caf', catalog.search, str)) == ['Caffè Roma']
+    assert catalog.searches == 2
+    assert titles(search.results('ca', catalog.search, str)) == ['Caffè Roma', 'Carbonara']
+    assert titles(search.results('', catalog.search, str))[:1] == ['Caffè Roma']
+
+
+def test_answers_are_truncated_to_max_results():
+    catalog = Catalog([store(i, f'Locale {i}', i) for i in range(1, 30)])
+    search = InlineSearch(max_results=3)
+    assert titles(search.results('locale', catalog.search, str)) == ['Locale 29', 'Locale 28', 'Locale 27']
+
+
+def test_import_drops_the_cached_answers():
+    catalog = Catalog([store(1, 'Carbonara', 8)])
+    search = InlineSearch()
+    assert titles(search.results('carb', catalog.search, str)) == ['Carbonara']
+    catalog.load([store(1, 'Carbonara', 8), store(2, 'Carbone', 9)])
+    search.invalidate()
+    assert titles(search.results('carb', catalog.search, str)) == ['Carbone', 'Carbonara']
+    assert catalog.searches == 2
+
+
+def test_answer_found_during_an_import_is_not_cached():
+    catalog = Catalog([store(1, 'Carbonara', 8)])
+    search = InlineSearch()
+
+    def search_during_import(query, k):
+        found = catalog.search(query, k)
+        # L'import finisce mentre la risposta è calcolata sul vecchio catalogo
+        catalog.load([store(2, 'Carbone', 9)])
+        search.invalidate()
+        return found
+    assert titles(search.results('carb', search_during_import, str)) == ['Carbonara']
+    assert titles(search.results('carb', catalog.search, str)) == ['Carbone']
+    assert catalog.searches == 2
@@ -0,0 +1,65 @@
+"""Rankings and neighborhood statistics recomputed by every import"""
+from collections import defaultdict
+
+from sqlalchemy import select, update
+
+import leaderboard
+from bot_db_entities import Store, Neighborhood, CityRanking, NeighborhoodStats
+
+TOP_N = 2
+
+
+def expected_rankings(connection):
+    """The top TOP_N stores of every (city, category), computed in Python from the store table"""
+    stores = defaultdict(list)
+    for store in connection.execute(select(Store.id, Store.vote, Store.criminal_category_id, Neighborhood.city_id)
+                                    .join(Neighborhood, Store.neighborhood_id == Neighborhood.id)):
+        stores[(store.city_id, store.criminal_category_id)].append((-store.vote, store.id))
+    return {key: [store_id for _, store_id in sorted(items)[:TOP_N]] for key, items in stores.items()}
+
+
+def stored_rankings(connection):
+    rankings = defaultdict(list)
+    for row in connection.execute(select(CityRanking).order_by(CityRanking.position)):
+        rankings[(row.city_id, row.criminal_category_id)].append(row.store_id)
+    return dict(rankings)
+
+
+def test_refresh_follows_the_new_votes(seeded_engine):
+    with seeded_engine.begin() as connection:
+        leaderboard.refresh(connection, TOP_N)
+    with seeded_engine.connect() as connection:
+        expected = expected_rankings(connection)
+        assert stored_rankings(connection) == expected
+        # Una città e categoria con almeno un locale fuori classifica
+        stores = connection.execute(select(Store.id, Store.neighborhood_id, Store.criminal_category_id, Neighborhood.city_id)
+                                    .join(Neighborhood, Store.neighborhood_id == Neighborhood.id)).all()
+        by_key = defaultdict(list)
+        for store in stores:
+            by_key[(store.city_id, store.criminal_category_id)].append(store)
+        key, group = next((key, group) for key, group in sorted(by_key.items()) if len(group) > TOP_N)
+        promoted = next(store for store in group if store.id not in expected[key])
+        demoted = expected[key][0]
+
+    # Un import rivota due locali: uno sale in testa, il primo esce dalla classifica
+    with seeded_engine.begin() as connection:
+        connection.execute(update(Store).where(Store.id == promoted.id).values(vote=10.5))
+        connection.execute(update(Store).where(Store.id == demoted).values(vote=0.5))
+        leaderboard.refresh(connection, TOP_N)
+    with seeded_engine.connect() as connection:
+        rankings = stored_rankings(connection)
+        assert rankings == expected_rankings(connection)
+        assert rankings[key][0] == promoted.id
+        assert demoted not in rankings[key]
+        assert connection.execute(select(CityRanking.vote).where(CityRanking.store_id == promoted.id)).scalars().all() == [10.5]
+
+        stats = connection.execute(select(NeighborhoodStats).where(
+            NeighborhoodStats.neighborhood_id == promoted.neighborhood_id,
+            NeighborhoodStats.criminal_category_id == promoted.criminal_category_id)).one()
+        votes = connection.execute(select(Store.vote, Store.full_vote).where(
+            Store.neighborhood_id == promoted.neighborhood_id,
+            Store.criminal_category_id == promoted.criminal_category_id)).all()
+    assert stats.city_id == key[0]
+    assert stats.store_count == len(votes)
+    assert abs(stats.average_vote - sum(vote for vote, _ in votes) / len(votes)) < 1e-9
+    assert stats.full_vote_share == sum(1 for _, full in votes if full) / len(votes)
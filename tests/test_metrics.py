@@ -0,0 +1,149 @@
+"""The Prometheus text format of the registry, and the handler labels recorded by MetricsMiddleware"""
+import time
+
+import pytest
+from telebot import types
+
+from bot import MetricsMiddleware, handler_label, HANDLER_SECONDS, HANDLER_ERRORS
+from metrics import Registry, CONTENT_TYPE
+
+
+def lines(registry):
+    return registry.render().decode('utf-8').splitlines()
+
+
+def test_counter_lines():
+    registry = Registry()
+    counter = registry.counter('bot_things_total', 'Things done', ['kind'])
+    counter.inc(kind='a')
+    counter.inc(3, kind='a')
+    counter.inc(kind='b')
+    unlabeled = registry.counter('bot_other_total', 'Other things')
+    unlabeled.inc(0.5)
+    assert lines(registry) == [
+        '# HELP bot_things_total Things done',
+        '# TYPE bot_things_total counter',
+        'bot_things_total{kind="a"} 4',
+        'bot_things_total{kind="b"} 1',
+        '# HELP bot_other_total Other things',
+        '# TYPE bot_other_total counter',
+        'bot_other_total 0.5',
+    ]
+    assert registry.render().endswith(b'\n')
+    assert counter.value(kind='a') == 4
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram('bot_work_seconds', 'Work time', ['phase'], buckets=(1, 0.1, 0.5))
+    # Un valore uguale a un limite cade in quel bucket (le = minore o uguale)
+    for value in (0.05, 0.1, 0.3, 2.0):
+        histogram.observe(value, phase='parse')
+    assert lines(registry) == [
+        '# HELP bot_work_seconds Work time',
+        '# TYPE bot_work_seconds histogram',
+        'bot_work_seconds_bucket{phase="parse",le="0.1"} 2',
+        'bot_work_seconds_bucket{phase="parse",le="0.5"} 3',
+        'bot_work_seconds_bucket{phase="parse",le="1"} 3',
+        'bot_work_seconds_bucket{phase="parse",le="+Inf"} 4',
+        'bot_work_seconds_sum{phase="parse"} 2.45',
+        'bot_work_seconds_count{phase="parse"} 4',
+    ]
+    assert histogram.count(phase='parse') == 4
+
+
+def test_histogram_time_observes_once():
+    registry = Registry()
+    histogram = registry.histogram('bot_step_seconds', 'Step time', buckets=(10,))
+    with histogram.time():
+        pass
+    with pytest.raises(RuntimeError), histogram.time():
+        raise RuntimeError
+    rendered = lines(registry)
+    assert rendered[2:4] == ['bot_step_seconds_bucket{le="10"} 2', 'bot_step_seconds_bucket{le="+Inf"} 2']
+    assert rendered[4].startswith('bot_step_seconds_sum ') and float(rendered[4].split()[1]) < 10
+    assert rendered[5] == 'bot_step_seconds_count 2'
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = registry.counter('bot_escaped_total', 'Escaping', ['value'])
+    counter.inc(value='a "quoted" back\\slash\nnewline')
+    assert lines(registry)[2] == 'bot_escaped_total{value="a \\"quoted\\" back\\\\slash\\nnewline"} 1'
+
+
+def test_labels_must_match():
+    registry = Registry()
+    counter = registry.counter('bot_checked_total', 'Checked', ['kind'])
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(kind='a', other='b')
+
+
+def test_gauges_and_registration():
+    registry = Registry()
+    first = registry.counter('bot_same_total', 'Same')
+    assert registry.counter('bot_same_total', 'Same') is first
+    registry.gauge('bot_depth', 'Depth', lambda: 3)
+    registry.gauge('bot_lanes', 'Lanes', lambda: {('a',): 1, ('b',): 2}, ['lane'])
+    registry.gauge('bot_broken', 'Broken', lambda: 1 / 0)
+    assert lines(registry)[2:] == [
+        '# HELP bot_depth Depth', '# TYPE bot_depth gauge', 'bot_depth 3',
+        '# HELP bot_lanes Lanes', '# TYPE bot_lanes gauge', 'bot_lanes{lane="a"} 1', 'bot_lanes{lane="b"} 2',
+        # Un gauge che fallisce non rompe lo scrape
+        '# HELP bot_broken Broken', '# TYPE bot_broken gauge',
+    ]
+    # Registrato di nuovo, il gauge usa la nuova funzione
+    registry.gauge('bot_depth', 'Depth', lambda: 5)
+    assert 'bot_depth 5' in lines(registry)
+    assert registry.handler() == (200, CONTENT_TYPE, registry.render())
+
+
+def message(text=None, location=None):
+    body = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': 7, 'type': 'private'},
+            'from': {'id': 7, 'is_bot': False, 'first_name': 'Mario'}}
+    if location:
+        body['location'] = location
+    else:
+        body['text'] = text
+    return types.Message.de_json(body)
+
+
+def callback(data):
+    return types.CallbackQuery.de_json({'id': '1', 'data': data, 'chat_instance': '1',
+                                        'from': {'id': 7, 'is_bot': False, 'first_name': 'Mario'}})
+
+
+@pytest.mark.parametrize('update, label', [
+    (lambda: message('/start'), '/start'),
+    (lambda: message('/quartiere Monti'), '/quartiere'),
+    (lambda: message('/classifica@fec_bot'), '/classifica'),
+    (lambda: message('/segreto'), 'other'),
+    (lambda: message('Trastevere'), 'text'),
+    (lambda: message(location={'latitude': 41.9, 'longitude': 12.5}), 'location'),
+    (lambda: callback('3'), 'callback:category'),
+    (lambda: callback('city:12'), 'callback:city'),
+    (lambda: callback('nbh:4'), 'callback:nbh'),
+    (lambda: callback('n:c:1:0'), 'callback:nav'),
+    (lambda: callback('p:abc:2'), 'callback:page'),
+    (lambda: callback('rk:1'), 'callback:rank'),
+    (lambda: callback('sub:1:2'), 'callback:sub'),
+    (lambda: callback('unsub:1:2'), 'callback:unsub'),
+    (lambda: types.InlineQuery.de_json({'id': '1', 'query': 'pi', 'offset': '',
+                                        'from': {'id': 7, 'is_bot': False, 'first_name': 'Mario'}}), 'inline'),
+])
+def test_handler_labels(update, label):
+    assert handler_label(update()) == label
+
+
+def test_middleware_records_time_and_errors_by_handler():
+    middleware = MetricsMiddleware(slow_seconds=60)
+    seconds, errors = HANDLER_SECONDS.count(handler='/risultati'), HANDLER_ERRORS.value(handler='/risultati')
+    for exception in (None, RuntimeError('boom')):
+        data = {}
+        middleware.pre_process(message('/risultati'), data)
+        middleware.post_process(message('/risultati'), data, exception)
+    assert HANDLER_SECONDS.count(handler='/risultati') == seconds + 2
+    assert HANDLER_ERRORS.value(handler='/risultati') == errors + 1
+    assert f'bot_handler_errors_total{{handler="/risultati"}} {errors + 1}' in HANDLER_ERRORS.samples()
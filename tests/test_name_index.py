@@ -0,0 +1,117 @@
+"""NameIndex suggestions, and the DAO answering them with and without the catalog"""
+import random
+from collections import namedtuple
+
+import pytest
+
+from dao import DAO
+from database import Database
+from database_updater import DatabaseUpdater
+from name_index import NameIndex, normalize_name, trigrams
+from synthetic_registry import generate
+
+Place = namedtuple('Place', 'id name')
+
+NAMES = ["San Pier d'Arena", 'Trastevere', 'Testaccio', 'Trieste', 'Città Studi', 'Monti', 'Casal Bertone',
+         'Casal Bruciato', 'Casal Boccone', 'Casal Palocco', 'Tor Bella Monaca', 'Tor Pignattara']
+
+
+def places():
+    return [Place(i, name) for i, name in enumerate(NAMES, start=1)]
+
+
+def similarity(a, b):
+    grams_a, grams_b = trigrams(normalize_name(a)), trigrams(normalize_name(b))
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+def scan(items, query, k, min_score):
+    """The NameIndex ranking, computed pair by pair"""
+    exact = [item for item in items if normalize_name(item.name) == normalize_name(query)]
+    if exact:
+        return [(exact[0].id, 1.0)]
+    scored = [(similarity(query, item.name), item.id) for item in items]
+    scored = sorted((pair for pair in scored if pair[0] >= min_score and pair[0] > 0), key=lambda pair: (-pair[0], pair[1]))
+    return [(item_id, score) for score, item_id in scored[:k]]
+
+
+def found(index, query, **kwargs):
+    return [(place.id, score) for place, score in index.search(query, **kwargs)]
+
+
+def test_accents_case_and_punctuation_are_folded():
+    assert normalize_name("San Pier d'Arena") == normalize_name('sanpierdarena') == 'sanpierdarena'
+    assert normalize_name('CITTÀ  studi') == 'cittastudi'
+    index = NameIndex(places())
+    assert found(index, 'Sanpierdarena') == [(1, 1.0)]
+    assert found(index, 'citta studi') == [(5, 1.0)]
+    assert found(index, ' Trastevere! ') == [(2, 1.0)]
+
+
+def test_typos_are_tolerated():
+    index = NameIndex(places())
+    assert found(index, 'Sampierdarena')[0][0] == 1
+    assert found(index, 'trastvere')[0][0] == 2
+    assert found(index, 'Testacio')[0][0] == 3
+    assert found(index, 'tor pignatara')[0][0] == 12
+    assert found(index, 'xyz') == [] and found(index, "'!") == []
+
+
+@pytest.mark.parametrize('query', ['Casal B', 'casal', 'Tor Bela', 'Tre', 'monti trastevere', 'Trasteve'])
+@pytest.mark.parametrize('k', [1, 2, 5])
+@pytest.mark.parametrize('min_score', [0.0, 0.1, 0.3])
+def test_top_k_matches_a_scan(query, k, min_score):
+    index = NameIndex(places())
+    result = found(index, query, k=k, min_score=min_score)
+    expected = scan(places(), query, k, min_score)
+    assert [item_id for item_id, _ in result] == [item_id for item_id, _ in expected]
+    assert [score for _, score in result] == pytest.approx([score for _, score in expected])
+    assert len(result) <= k
+
+
+def test_min_score_cuts_weak_matches():
+    index = NameIndex(places())
+    weak = found(index, 'Tre', k=10, min_score=0.0)
+    assert weak and all(score < 0.3 for _, score in weak)
+    assert found(index, 'Tre', k=10) == []
+    assert found(index, 'Tre', k=10, min_score=weak[0][1]) == weak[:1]
+
+
+def test_random_names_match_a_scan():
+    rng = random.Random(5)
+    syllables = ['ca', 'sa', 'le', 'ro', 'mà', 'ti', 'no', 'pi', 'gna']
+    items = [Place(i, ' '.join(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+                               for _ in range(rng.randint(1, 2)))) for i in range(200)]
+    index = NameIndex(items)
+    for _ in range(50):
+        query = rng.choice(items).name[:rng.randint(3, 10)] + rng.choice(['', 'a', 'x'])
+        assert [place.id for place, _ in index.search(query, k=5)] == [item_id for item_id, _ in scan(items, query, 5, 0.3)]
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    registry = str(tmp_path / 'registry.xlsx')
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setenv('FILE_PATH', registry)
+    generate(registry, stores=50, cities=3, neighborhoods_per_city=4, seed=3)
+    database = Database()
+    DAO(database)
+    assert DatabaseUpdater(database).update_from_excel()
+    yield database
+    database.dispose()
+
+
+def test_dao_suggests_from_the_catalog(database):
+    dao = DAO(database)
+    # 'citta b' e 'quartiere b' sono i nomi sintetici della città 1 e del quartiere 1
+    assert [city.id for city in dao.suggest_cities('Cità B')][:1] == [1]
+    assert [neighborhood.id for neighborhood in dao.suggest_neighborhoods('quartier b', 1)][:1] == [1]
+    assert dao.suggest_neighborhoods('quartier b', 99) == []
+
+
+def test_dao_without_catalog_or_pg_trgm_suggests_nothing(database, monkeypatch):
+    monkeypatch.setenv('CATALOG_ENABLED', 'false')
+    dao = DAO(database)
+    assert dao.catalog is None and not dao.pg_trgm
+    assert dao.suggest_cities('Cità B') == []
+    assert dao.suggest_neighborhoods('quartier b', 1) == []
@@ -0,0 +1,104 @@
+"""callback_data of the drill-down menus, their pages and the tree they point into"""
+from collections import namedtuple
+
+import pytest
+
+import navigation
+from navigation import NavigationTree, encode, decode, paginate, CATEGORIES, CITIES, NEIGHBORHOODS, RESULTS
+
+Category = namedtuple('Category', 'id title')
+City = namedtuple('City', 'id name')
+Neighborhood = namedtuple('Neighborhood', 'id name city_id')
+
+# Il limite di Telegram per il callback_data dei pulsanti
+MAX_CALLBACK_DATA = 64
+MAX_ID = 2 ** 31 - 1
+
+
+@pytest.fixture
+def tree():
+    categories = {1: Category(1, 'pizzerie'), 2: Category(2, 'trattorie')}
+    cities = {10: City(10, 'Roma'), 11: City(11, 'Milano')}
+    neighborhoods = {100: Neighborhood(100, 'Trastevere', 10), 101: Neighborhood(101, 'Monti', 10),
+                     102: Neighborhood(102, 'Brera', 11), 103: Neighborhood(103, 'Orfano', 99)}
+    # Il quartiere 103 ha una città che non esiste più: il suo ramo non compare
+    return NavigationTree(categories, cities, neighborhoods, {(100, 1), (101, 1), (102, 2), (103, 1)})
+
+
+@pytest.mark.parametrize('kind, args', [
+    (CATEGORIES, []), (CITIES, [1, 0]), (NEIGHBORHOODS, [1, 10, 2]), (RESULTS, [1, 100]),
+])
+def test_round_trip(kind, args):
+    assert decode(encode(kind, *args)) == (kind, args)
+
+
+def test_largest_ids_fit_the_callback_data_limit():
+    for kind, arity in navigation.ARITY.items():
+        data = encode(kind, *[MAX_ID] * arity)
+        assert len(data.encode('utf-8')) <= MAX_CALLBACK_DATA, data
+        assert decode(data) == (kind, [MAX_ID] * arity)
+
+
+@pytest.mark.parametrize('data', [
+    '', 'n', 'x:k', 'n:z', 'n:k:1', 'n:c:1', 'n:c:1:2:3', 'n:q:1:2', 'n:r:uno:2', 'n:c:1:', 'rk:c:1:0', '12',
+])
+def test_malformed_data_is_rejected(data):
+    with pytest.raises(ValueError):
+        decode(data)
+
+
+def test_pages_cover_every_item_once():
+    items = list(range(20))
+    seen = []
+    page = 0
+    while True:
+        chunk, page, has_prev, has_next = paginate(items, page)
+        assert len(chunk) <= navigation.PAGE_SIZE
+        assert has_prev == (page > 0)
+        seen += chunk
+        if not has_next:
+            break
+        page += 1
+    assert seen == items
+    # Pagine fuori dai limiti, da un pulsante vecchio, finiscono sulla prima o sull'ultima
+    assert paginate(items, -3)[:2] == (items[:navigation.PAGE_SIZE], 0)
+    assert paginate(items, 99)[1] == page
+    assert paginate([], 5) == ([], 0, False, False)
+
+
+def test_tree_keeps_the_branches_with_stores(tree):
+    assert [city.name for city in tree.cities(1)] == ['Roma']
+    assert [n.name for n in tree.neighborhoods(1, 10)] == ['Monti', 'Trastevere']
+    assert [city.name for city in tree.cities(2)] == ['Milano']
+    assert tree.neighborhoods(2, 10) == []
+
+
+def test_stale_data_is_rejected(tree):
+    assert tree.resolve(encode(CITIES, 1, 0)) == (CITIES, [1, 0])
+    assert tree.resolve(encode(NEIGHBORHOODS, 2, 11, 0)) == (NEIGHBORHOODS, [2, 11, 0])
+    # Categoria o città rimaste senza locali dopo un import
+    with pytest.raises(ValueError):
+        tree.resolve(encode(CITIES, 3, 0))
+    with pytest.raises(ValueError):
+        tree.resolve(encode(NEIGHBORHOODS, 2, 10, 0))
+    with pytest.raises(ValueError):
+        tree.resolve('n:q:2:zz:0')
+
+
+def test_other_menus_share_the_codec():
+    import leaderboard
+    import notifications
+    import result_renderer
+    assert leaderboard.decode(leaderboard.encode(leaderboard.RANKING, 1, 10)) == (leaderboard.RANKING, [1, 10])
+    assert notifications.decode(notifications.encode(notifications.UNSUBSCRIBE_PREFIX, 100, 1)) == (100, 1)
+    assert result_renderer.decode_page(result_renderer.encode_page(100, 1, 2)) == (100, 1, 2)
+    for data in (leaderboard.encode(leaderboard.CITIES, MAX_ID, MAX_ID),
+                 notifications.encode(notifications.UNSUBSCRIBE_PREFIX, MAX_ID, MAX_ID),
+                 result_renderer.encode_page(MAX_ID, MAX_ID, MAX_ID)):
+        assert len(data.encode('utf-8')) <= MAX_CALLBACK_DATA, data
+    # Il prefisso di un menu non è accettato da un altro
+    for decode_other in (leaderboard.decode, notifications.decode, result_renderer.decode_page):
+        with pytest.raises(ValueError):
+            decode_other(encode(CITIES, 1, 0))
+    with pytest.raises(ValueError):
+        notifications.decode('sub:1')
@@ -0,0 +1,128 @@
+"""Notification rounds: what counts as news for a subscription, and what is written to remember it"""
+import threading
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event, select, insert, update, delete, text
+
+import notifications
+from bot_db_entities import Store, Subscription, NotifiedStore, SchemaVersion
+from notifications import Notifier, mark_notified
+from schema_migrations import migrate
+
+
+@pytest.fixture
+def engine(seeded_engine):
+    with seeded_engine.begin() as connection:
+        mark_notified(connection)
+    return seeded_engine
+
+
+def subscribe(engine, chat_id, neighborhood_id, category_id):
+    with engine.begin() as connection:
+        connection.execute(insert(Subscription).values(chat_id=chat_id, neighborhood_id=neighborhood_id,
+                                                       criminal_category_id=category_id, created_at=datetime.now()))
+
+
+def notified_writes(engine):
+    """Rows of notified_store written by the statements run from now on"""
+    written = []
+
+    def count(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().startswith(('INSERT INTO notified_store', 'DELETE FROM notified_store')):
+            written.append(cursor.rowcount)
+    event.listen(engine, 'after_cursor_execute', count)
+    return written
+
+
+def test_moved_revoted_and_new_stores_reach_their_subscribers(engine):
+    notifier = Notifier(engine, None, threading.Lock())
+    subscribe(engine, 1, 7, 3)
+    subscribe(engine, 2, 8, 4)
+    with engine.begin() as connection:
+        connection.execute(update(Store).where(Store.id == 10).values(neighborhood_id=7, criminal_category_id=3))
+        connection.execute(update(Store).where(Store.id == 11).values(neighborhood_id=8, criminal_category_id=4, vote=9.9))
+        connection.execute(insert(Store).values(id=1001, name='Nuovo', address='Via Nuova', vote=7.0, full_vote=True,
+                                                created_at=datetime.now(), neighborhood_id=8, criminal_category_id=4))
+        connection.execute(update(Store).where(Store.id == 12).values(neighborhood_id=8, criminal_category_id=4))
+        connection.execute(delete(Store).where(Store.id == 13))
+    written = notified_writes(engine)
+
+    changes = notifier.collect()
+    assert sorted(changes) == [1, 2]
+    assert [row.name for row in changes[1]] == ['Locale 10']
+    assert sorted(row.name for row in changes[2]) == ['Locale 11', 'Locale 12', 'Nuovo']
+    text_1 = notifier.render(changes[1])
+    assert 'Locale 10 - voto' in text_1 and '(nuovo)' in text_1
+    # Spostati nel quartiere seguito: sono nuovi lì, anche se rivotati
+    assert notifier.render(changes[2]).count('(nuovo)') == 3
+
+    # Solo le righe dei locali cambiati o cancellati, non tutta la tabella:
+    # 3 vecchie righe dei locali cambiati, quella del locale cancellato, 4 nuove
+    assert sum(written) == 3 + 1 + 4
+    with engine.connect() as connection:
+        assert connection.scalar(select(NotifiedStore.neighborhood_id).where(NotifiedStore.store_id == 10)) == 7
+        assert connection.scalar(select(NotifiedStore.store_id).where(NotifiedStore.store_id == 13)) is None
+        assert connection.scalar(select(NotifiedStore.vote).where(NotifiedStore.store_id == 1001)) == 7.0
+    assert notifier.collect() == {}
+
+
+def test_revoted_store_shows_the_old_vote(engine):
+    notifier = Notifier(engine, None, threading.Lock())
+    with engine.connect() as connection:
+        store = connection.execute(select(Store).where(Store.id == 20)).one()
+    subscribe(engine, 1, store.neighborhood_id, store.criminal_category_id)
+    with engine.begin() as connection:
+        connection.execute(update(Store).where(Store.id == 20).values(vote=store.vote + 1))
+    rows = notifier.collect()[1]
+    assert [row.name for row in rows] == ['Locale 20']
+    assert f'(prima {store.vote})' in notifier.render(rows)
+
+
+def test_import_committed_between_match_and_mark_is_left_for_the_next_round(engine, monkeypatch):
+    # Come su Postgres, dove il lock dei round non ferma gli import delle altre repliche
+    monkeypatch.setattr(notifications, '_lock_round', lambda connection: None)
+    notifier = Notifier(engine, None, threading.Lock())
+    with engine.connect() as connection:
+        store = connection.execute(select(Store).where(Store.id == 30)).one()
+    subscribe(engine, 1, store.neighborhood_id, store.criminal_category_id)
+    with engine.begin() as connection:
+        connection.execute(update(Store).where(Store.id == 30).values(vote=store.vote + 1))
+
+    imported = []
+
+    def concurrent_import(connection, cursor, statement, parameters, context, executemany):
+        if not imported and statement.lstrip().startswith('DELETE FROM notified_store'):
+            imported.append(statement)
+            with engine.begin() as other:
+                other.execute(update(Store).where(Store.id == 30).values(vote=store.vote + 2))
+                other.execute(insert(Store).values(id=1002, name='Nuovo', address='Via Nuova', vote=7.0, full_vote=False,
+                                                   created_at=datetime.now(), neighborhood_id=store.neighborhood_id,
+                                                   criminal_category_id=store.criminal_category_id))
+    event.listen(engine, 'before_cursor_execute', concurrent_import)
+    try:
+        first = notifier.collect()
+    finally:
+        event.remove(engine, 'before_cursor_execute', concurrent_import)
+
+    assert imported
+    assert [(row.name, row.vote) for row in first[1]] == [('Locale 30', store.vote + 1)]
+    second = notifier.collect()
+    assert sorted((row.name, row.vote) for row in second[1]) == [('Locale 30', store.vote + 2), ('Nuovo', 7.0)]
+    assert notifier.collect() == {}
+
+
+def test_migration_fills_the_place_of_the_notified_stores(engine):
+    with engine.begin() as connection:
+        connection.execute(text('ALTER TABLE notified_store DROP COLUMN neighborhood_id'))
+        connection.execute(text('ALTER TABLE notified_store DROP COLUMN criminal_category_id'))
+        connection.execute(delete(SchemaVersion).where(SchemaVersion.version == 6))
+    assert migrate(engine) == [6]
+    with engine.connect() as connection:
+        places = connection.execute(select(NotifiedStore.store_id, NotifiedStore.neighborhood_id,
+                                           NotifiedStore.criminal_category_id)).all()
+        stores = connection.execute(select(Store.id, Store.neighborhood_id, Store.criminal_category_id)).all()
+    assert sorted(places) == sorted(stores)
+    # Nessun locale risulta spostato dopo la migrazione
+    subscribe(engine, 1, 1, 1)
+    assert Notifier(engine, None, threading.Lock()).collect() == {}
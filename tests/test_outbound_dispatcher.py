@@ -0,0 +1,133 @@
+"""Answers to button presses bypass the message limits and do not wait for each other, a 429 pauses every chat"""
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+from outbound_dispatcher import OutboundDispatcher
+
+
+class SlowBot:
+    def __init__(self, delay):
+        self.delay = delay
+        self.answered = []
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        time.sleep(self.delay)
+        with self._lock:
+            self.answered.append((time.monotonic(), callback_query_id))
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._lock:
+            self.sent.append((time.monotonic(), chat_id))
+
+
+def wait_empty(dispatcher, timeout=5):
+    deadline = time.monotonic() + timeout
+    while dispatcher.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return dispatcher.pending == 0
+
+
+def test_callback_answers_run_in_parallel_outside_the_global_budget():
+    bot = SlowBot(delay=0.2)
+    dispatcher = OutboundDispatcher(bot, workers=8, global_rate=1, chat_rate=1, chat_burst=1)
+    dispatcher.start()
+    try:
+        start = time.monotonic()
+        for i in range(6):
+            assert dispatcher.answer_callback_query(f'cb{i}')
+        assert wait_empty(dispatcher)
+        # In fila avrebbero impiegato 1.2s, e con un token al secondo più di 5s
+        assert time.monotonic() - start < 0.8
+        assert sorted(callback_id for _, callback_id in bot.answered) == [f'cb{i}' for i in range(6)]
+        # Il secchio globale non è stato toccato: il primo messaggio parte subito
+        assert dispatcher.global_bucket.tokens >= 1
+        start = time.monotonic()
+        assert dispatcher.send_message(1, 'ciao')
+        assert wait_empty(dispatcher)
+        assert bot.sent[0][0] - start < 0.3
+    finally:
+        dispatcher.stop(timeout=0)
+
+
+def test_messages_still_share_the_global_budget():
+    bot = SlowBot(delay=0)
+    dispatcher = OutboundDispatcher(bot, workers=4, global_rate=5, chat_rate=100, chat_burst=100)
+    dispatcher.start()
+    try:
+        start = time.monotonic()
+        for chat_id in range(10):
+            dispatcher.send_message(chat_id, 'ciao')
+        assert wait_empty(dispatcher)
+        # 5 subito, gli altri 5 a 5 al secondo
+        assert time.monotonic() - start > 0.7
+    finally:
+        dispatcher.stop(timeout=0)
+
+
+class RateLimitedBot:
+    """Answers the first inline query with a 429"""
+    def __init__(self):
+        self.calls = []
+
+    def answer_inline_query(self, inline_query_id, results, **kwargs):
+        self.calls.append(time.monotonic())
+        if len(self.calls) == 1:
+            raise ApiTelegramException('answerInlineQuery', None, {
+                'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0.3}})
+
+
+def test_inline_answer_is_retried_after_a_429():
+    bot = RateLimitedBot()
+    dispatcher = OutboundDispatcher(bot, workers=2, global_rate=1, chat_rate=1, chat_burst=1)
+    dispatcher.start()
+    try:
+        start = time.monotonic()
+        assert dispatcher.answer_inline_query('q1', [], cache_time=10)
+        assert wait_empty(dispatcher)
+        assert len(bot.calls) == 2
+        assert bot.calls[1] - start >= 0.3
+        # Fuori dal secchio globale, come le risposte ai pulsanti
+        assert dispatcher.global_bucket.tokens >= 1
+    finally:
+        dispatcher.stop(timeout=0)
+
+
+class FloodedBot(SlowBot):
+    """Answers the first message with a 429, as Telegram does when the whole bot sends too much"""
+    def __init__(self, retry_after):
+        super().__init__(delay=0)
+        self.retry_after = retry_after
+        self.flooded = False
+
+    def send_message(self, chat_id, text, **kwargs):
+        if not self.flooded:
+            self.flooded = True
+            raise ApiTelegramException('sendMessage', None, {
+                'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': self.retry_after}})
+        super().send_message(chat_id, text, **kwargs)
+
+
+def test_a_429_pauses_every_chat_but_not_the_answers():
+    bot = FloodedBot(retry_after=0.4)
+    dispatcher = OutboundDispatcher(bot, workers=4, global_rate=100, chat_rate=100, chat_burst=100)
+    dispatcher.start()
+    try:
+        start = time.monotonic()
+        dispatcher.send_message(1, 'primo')
+        deadline = time.monotonic() + 1
+        while not bot.flooded and time.monotonic() < deadline:
+            time.sleep(0.005)
+        # Altre chat e una risposta a un pulsante, dopo il 429 della chat 1
+        for chat_id in (2, 3):
+            dispatcher.send_message(chat_id, 'ciao')
+        dispatcher.answer_callback_query('cb1')
+        assert wait_empty(dispatcher)
+        assert sorted(chat_id for _, chat_id in bot.sent) == [1, 2, 3]
+        assert all(sent_at - start >= 0.4 for sent_at, _ in bot.sent)
+        assert bot.answered[0][0] - start < 0.3
+    finally:
+        dispatcher.stop(timeout=0)
@@ -0,0 +1,74 @@
+"""PrefixIndex against a linear scan of the same names"""
+import random
+from collections import namedtuple
+
+import pytest
+
+from prefix_index import PrefixIndex, word_keys
+
+Place = namedtuple('Place', 'id name neighborhood')
+
+SYLLABLES = ['ca', 'co', 'pi', 'pa', 'sa', 'ro', 'rò', 'mà', 'ne']
+
+
+def catalog(size=120, seed=3):
+    """Places best first, with few syllables so that many names share a prefix"""
+    rng = random.Random(seed)
+
+    def name():
+        return ' '.join(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+                        for _ in range(rng.randint(1, 3))).title()
+    return [Place(i, name(), name() if rng.random() < 0.5 else None) for i in range(size)]
+
+
+def names(place):
+    return place.name, place.neighborhood
+
+
+def scan(places, query, k):
+    prefix = ''.join(word_keys(query)[:1])
+    if not prefix:
+        return places[:k]
+    found = [place for place in places
+             if any(key.startswith(prefix) for name in names(place) for key in word_keys(name or ''))]
+    return found[:k]
+
+
+@pytest.mark.parametrize('threshold', [1, 4, 64])
+def test_every_prefix_matches_a_linear_scan(threshold):
+    places = catalog()
+    index = PrefixIndex(places, names, k=10, threshold=threshold)
+    prefixes = {key[:length] for key in index._keys for length in range(1, len(key) + 1)}
+    for prefix in sorted(prefixes):
+        assert index.search(prefix) == scan(places, prefix, 10), prefix
+    assert index.search('zz') == []
+
+
+def test_precomputed_ranges_hold_the_best_ranks():
+    places = catalog()
+    index = PrefixIndex(places, names, k=10, threshold=4)
+    assert index._top, "the catalog is too small to precompute any range"
+    for prefix, ranks in index._top.items():
+        assert [places[rank] for rank in ranks] == scan(places, prefix, 10), prefix
+        assert len(ranks) <= 10
+
+
+def test_answers_are_truncated_to_k():
+    places = catalog()
+    index = PrefixIndex(places, names, k=10, threshold=4)
+    assert len(index.search('ca')) == 10
+    assert index.search('ca', k=3) == scan(places, 'ca', 3)
+    # k oltre quello dell'indice non allunga le risposte
+    assert index.search('ca', k=50) == scan(places, 'ca', 10)
+    assert index.search('') == places[:10]
+
+
+def test_case_accents_and_punctuation_are_folded():
+    places = [Place(1, "Caffè dell'Oratorio", 'Trastevere'), Place(2, 'Da ROMOLO', 'San Lorenzo'), Place(3, 'Sora Lella', None)]
+    index = PrefixIndex(places, names)
+    assert index.search('CAFFE') == [places[0]]
+    assert index.search('dell orat') == [places[0]]
+    assert index.search('romolo') == [places[1]]
+    assert index.search('sanlor') == [places[1]]
+    assert index.search('  trastè ') == [places[0]]
+    assert index.search('lella') == [places[2]]
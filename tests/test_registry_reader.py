@@ -0,0 +1,33 @@
+"""The registry workbook read in one pass, starting from the sample bundled with the repository"""
+import os
+
+import openpyxl
+import pytest
+
+from registry_reader import RegistryReader, RegistryFormatError, StoreRecord
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'registry-fec-bot.xlsx')
+
+
+def test_bundled_sample_is_read():
+    records = RegistryReader(SAMPLE).read()
+    assert [category.title for category in records['category']] == ['gelaterie']
+    assert len(records['city']) == 1 and len(records['neighborhood']) == 1
+    assert [store.id for store in records['store']] == [1, 2, 3]
+    store = records['store'][0]
+    assert isinstance(store, StoreRecord)
+    assert (store.name, store.vote, store.full_vote) == ('Buono Cosi', 9.5, True)
+    assert store.latitude == pytest.approx(41.8854888)
+    # Il campione non ha la colonna link
+    assert all(store.maps_link is None for store in records['store'])
+
+
+def test_missing_required_column_is_reported(tmp_path):
+    workbook = openpyxl.load_workbook(SAMPLE)
+    sheet = workbook['store']
+    header = [cell.value for cell in sheet[1]]
+    sheet.delete_cols(header.index('vote') + 1)
+    path = tmp_path / 'registry.xlsx'
+    workbook.save(path)
+    with pytest.raises(RegistryFormatError, match="Sheet 'store' is missing columns: vote"):
+        RegistryReader(str(path)).read()
@@ -0,0 +1,119 @@
+"""Conditional downloads of the registry from an http.server stand-in for the remote host"""
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from remote_file_updater import RemoteFileUpdater
+
+
+class Remote:
+    """The remote file: its content, its ETag and the status forced on the next answers"""
+    def __init__(self):
+        self.content = b'registro v1'
+        self.etag = '"v1"'
+        self.fail_status = None
+        self.requests = []
+
+    def start(self):
+        remote = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                remote.requests.append(self.headers.get('If-None-Match'))
+                if remote.fail_status:
+                    self.send_response(remote.fail_status)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if self.headers.get('If-None-Match') == remote.etag:
+                    self.send_response(304)
+                    self.send_header('ETag', remote.etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', remote.etag)
+                self.send_header('Content-Length', str(len(remote.content)))
+                self.end_headers()
+                self.wfile.write(remote.content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/registry.xlsx'
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def remote():
+    remote = Remote().start()
+    yield remote
+    remote.stop()
+
+
+@pytest.fixture
+def updater(remote, tmp_path, monkeypatch):
+    monkeypatch.setenv('REMOTE_FILE_URL', remote.url)
+    monkeypatch.setenv('FILE_PATH', str(tmp_path / 'registry.xlsx'))
+    monkeypatch.setenv('CHECK_INTERVAL', '10')
+    monkeypatch.setenv('MAX_CHECK_INTERVAL', '60')
+    # Senza jitter i ritardi sono esatti
+    monkeypatch.setattr(RemoteFileUpdater, 'JITTER', 0)
+    return RemoteFileUpdater()
+
+
+def test_download_then_not_modified(remote, updater, tmp_path):
+    assert updater.download_file()
+    assert updater.last_status == RemoteFileUpdater.CHANGED
+    assert (tmp_path / 'registry.xlsx').read_bytes() == b'registro v1'
+    assert updater.next_delay() == 10
+
+    assert not updater.download_file()
+    assert updater.last_status == RemoteFileUpdater.UNCHANGED
+    assert remote.requests == [None, '"v1"']
+    assert updater.next_delay() == 15
+
+    # I validatori sopravvivono al riavvio
+    assert RemoteFileUpdater().validators['etag'] == '"v1"'
+
+
+def test_changed_etag_downloads_the_new_file(remote, updater, tmp_path):
+    assert updater.download_file()
+    remote.content, remote.etag = b'registro v2', '"v2"'
+    assert updater.download_file()
+    assert updater.last_status == RemoteFileUpdater.CHANGED
+    assert (tmp_path / 'registry.xlsx').read_bytes() == b'registro v2'
+    assert remote.requests == [None, '"v1"']
+    assert updater.validators['etag'] == '"v2"'
+
+    # ETag nuovo ma stesso contenuto: nessun import
+    remote.etag = '"v2-bis"'
+    assert not updater.download_file()
+    assert updater.last_status == RemoteFileUpdater.UNCHANGED
+    assert updater.validators['etag'] == '"v2-bis"'
+
+
+def test_server_errors_back_off_until_the_file_is_back(remote, updater, tmp_path):
+    assert updater.download_file()
+    assert updater.next_delay() == 10
+    remote.fail_status = 503
+    delays = []
+    for _ in range(4):
+        assert not updater.download_file()
+        assert updater.last_status == RemoteFileUpdater.ERROR
+        delays.append(updater.next_delay())
+    assert delays == [20, 40, 60, 60]
+    # Il file locale resta quello buono, senza residui del download fallito
+    assert (tmp_path / 'registry.xlsx').read_bytes() == b'registro v1'
+    assert not (tmp_path / 'registry.xlsx.tmp').exists()
+
+    remote.fail_status = None
+    remote.content, remote.etag = b'registro v2', '"v2"'
+    assert updater.download_file()
+    assert updater.next_delay() == 10
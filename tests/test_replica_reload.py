@@ -0,0 +1,80 @@
+"""Two bot processes sharing one database: the one that skips an import already done by the other reloads anyway"""
+from sqlalchemy.exc import IntegrityError
+
+from dao import DAO
+from database import Database
+from database_updater import DatabaseUpdater
+from synthetic_registry import generate
+
+
+def replica():
+    database = Database()
+    dao = DAO(database)
+    updater = DatabaseUpdater(database)
+    updater.add_reload_listener(dao.refresh_catalog)
+    return dao, updater
+
+
+def test_skipped_import_reloads_the_other_replica(tmp_path, monkeypatch):
+    registry = str(tmp_path / 'registry.xlsx')
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setenv('FILE_PATH', registry)
+
+    generate(registry, stores=300, seed=7)
+    dao_a, updater_a = replica()
+    dao_b, updater_b = replica()
+    assert updater_a.update_from_excel()
+    assert updater_b.update_from_excel()
+    assert [store.name for store in dao_b.search_stores('Locale 299')] == ['Locale 299']
+
+    # Stesso seed: i primi 300 locali restano uguali, se ne aggiungono 50
+    generate(registry, stores=350, seed=7)
+    assert updater_a.update_from_excel()
+    assert dao_b.search_stores('Locale 340') == []
+    reloads = []
+    updater_b.add_reload_listener(lambda: reloads.append(True))
+    assert updater_b.update_from_excel()
+    assert [store.name for store in dao_b.search_stores('Locale 340')] == ['Locale 340']
+    assert reloads == [True]
+
+    # Nessun file nuovo: nessun altro reload
+    assert updater_b.update_from_excel()
+    assert reloads == [True]
+
+
+def test_import_lost_to_the_other_replica_reloads(tmp_path, monkeypatch):
+    registry = str(tmp_path / 'registry.xlsx')
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setenv('FILE_PATH', registry)
+
+    generate(registry, stores=300, seed=7)
+    dao_a, updater_a = replica()
+    dao_b, updater_b = replica()
+    assert updater_a.update_from_excel()
+    assert updater_b.update_from_excel()
+
+    generate(registry, stores=350, seed=7)
+    apply_incremental = updater_b._apply_incremental
+
+    def collide(records, skipped):
+        # L'altra replica scrive e registra lo stesso file mentre questa importa
+        assert updater_a.update_from_excel()
+        raise IntegrityError('INSERT INTO import_row_hash', {}, Exception('UNIQUE constraint failed'))
+    monkeypatch.setattr(updater_b, '_apply_incremental', collide)
+    reloads = []
+    updater_b.add_reload_listener(lambda: reloads.append(True))
+    assert updater_b.update_from_excel()
+    assert reloads == [True]
+    assert [store.name for store in dao_b.search_stores('Locale 340')] == ['Locale 340']
+
+    # Un errore su un file che nessuno ha importato resta un errore
+    generate(registry, stores=360, seed=7)
+
+    def fail(records, skipped):
+        raise IntegrityError('INSERT INTO store', {}, Exception('FOREIGN KEY constraint failed'))
+    monkeypatch.setattr(updater_b, '_apply_incremental', fail)
+    assert not updater_b.update_from_excel()
+    assert reloads == [True]
+    monkeypatch.setattr(updater_b, '_apply_incremental', apply_incremental)
+    assert updater_b.update_from_excel()
+    assert reloads == [True, True]
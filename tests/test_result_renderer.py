@@ -0,0 +1,41 @@
+"""Listings with stores too long for a page"""
+from types import SimpleNamespace
+
+from result_renderer import ResultRenderer, MAX_MESSAGE_LENGTH, FOOTER_RESERVE, message_length
+
+
+def store(i, comment=None, name=None, maps_link='https://maps.app.goo.gl/abc'):
+    return SimpleNamespace(name=name or f'Locale {i}', address=f'Via {i}', vote=8.5, full_vote=False,
+                           comment=comment, maps_link=maps_link)
+
+
+def markdown_balanced(text):
+    """True if every * and _ not escaped is closed and the link brackets are intact"""
+    unescaped = text.replace('\\\\', '').replace('\\*', '').replace('\\_', '').replace('\\[', '').replace('\\`', '')
+    return unescaped.count('*') % 2 == 0 and unescaped.count('_') % 2 == 0 and unescaped.count('[') == unescaped.count('](')
+
+
+def test_oversized_comment_is_cut_before_escaping():
+    renderer = ResultRenderer()
+    # Ogni carattere speciale raddoppia con l'escape: tagliare il Markdown lo spezzerebbe
+    comment = 'un posto *criminale* con [la] porchetta_migliore ' * 400
+    pages = renderer.split([renderer.render_store(store(1, comment=comment)), renderer.render_store(store(2))])
+
+    assert all(message_length(page) <= MAX_MESSAGE_LENGTH - FOOTER_RESERVE for page in pages)
+    first = pages[0].split('Locale 2')[0]
+    assert first.startswith('Locale 1\n')
+    assert '…\n' in first
+    # Il link del locale con il commento lungo resta intero
+    assert first.count('[Apri in Google Maps](https://maps.app.goo.gl/abc)') == 1
+    assert markdown_balanced(first)
+    assert not first.split('Commento: ', 1)[1].split('…')[0].endswith('\\')
+    assert 'Locale 2' in ''.join(pages)
+
+
+def test_every_field_oversized_still_fits_a_page():
+    renderer = ResultRenderer()
+    block = renderer.render_store(store(1, name='_' * 5000, comment='*' * 10000, maps_link='https://x.it/' + 'a' * 5000))
+    assert message_length(block) <= renderer.max_length
+    assert 'Google Maps' not in block
+    assert markdown_balanced(block)
+    assert renderer.split([block]) == [block]
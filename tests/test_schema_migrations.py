@@ -0,0 +1,107 @@
+"""The schema migrations on a database created by the first version of the bot"""
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, Float, Boolean, Text, ForeignKey, \
+    create_engine, insert, select, inspect, func
+
+import leaderboard
+from bot_db_entities import Store, SchemaVersion, CityRanking, NeighborhoodStats, NotifiedStore
+from schema_migrations import migrate, MIGRATIONS
+
+# The tables as the first version of the bot created them, with create_all and no index
+BASELINE = MetaData()
+Table('city', BASELINE,
+      Column('id', Integer, primary_key=True), Column('name', String, nullable=False),
+      Column('created_at', DateTime, nullable=False))
+Table('neighborhood', BASELINE,
+      Column('id', Integer, primary_key=True), Column('name', String, nullable=False),
+      Column('created_at', DateTime, nullable=False),
+      Column('city_id', Integer, ForeignKey('city.id'), nullable=False))
+Table('criminal_category', BASELINE,
+      Column('id', Integer, primary_key=True), Column('title', String, nullable=False),
+      Column('created_at', DateTime, nullable=False))
+Table('store', BASELINE,
+      Column('id', Integer, primary_key=True), Column('name', String, nullable=False),
+      Column('address', String, nullable=False), Column('vote', Float, nullable=False),
+      Column('maps_link', String), Column('full_vote', Boolean), Column('comment', Text),
+      Column('created_at', DateTime, nullable=False), Column('updated_at', DateTime),
+      Column('criminal_category_id', Integer, ForeignKey('criminal_category.id'), nullable=False),
+      Column('neighborhood_id', Integer, ForeignKey('neighborhood.id'), nullable=False))
+
+
+def baseline_engine(path):
+    engine = create_engine(f"sqlite:///{path}")
+    BASELINE.create_all(engine)
+    now = datetime.now()
+    tables = BASELINE.tables
+    with engine.begin() as connection:
+        connection.execute(insert(tables['criminal_category']), [{'id': 1, 'title': 'pizzerie', 'created_at': now}])
+        connection.execute(insert(tables['city']), [{'id': 1, 'name': 'Roma', 'created_at': now}])
+        connection.execute(insert(tables['neighborhood']), [
+            {'id': 1, 'name': 'Trastevere', 'city_id': 1, 'created_at': now},
+            {'id': 2, 'name': 'Monti', 'city_id': 1, 'created_at': now},
+        ])
+        connection.execute(insert(tables['store']), [
+            {'id': i, 'name': f'Locale {i}', 'address': f'Via {i}', 'vote': float(i), 'full_vote': i % 2 == 0,
+             'created_at': now, 'criminal_category_id': 1, 'neighborhood_id': 1 + i % 2}
+            for i in range(1, 13)
+        ])
+    return engine
+
+
+def test_baseline_database_is_upgraded(tmp_path):
+    engine = baseline_engine(tmp_path / 'bot.db')
+    assert migrate(engine) == sorted(version for version, _, _ in MIGRATIONS)
+
+    tables = set(inspect(engine).get_table_names())
+    assert {'schema_version', 'registry_import', 'city_ranking', 'neighborhood_stats', 'subscription',
+            'notified_store', 'conversation_state', 'staging_store', 'archive_store'} <= tables
+    assert {'latitude', 'longitude'} <= {column['name'] for column in inspect(engine).get_columns('store')}
+    assert 'ix_store_neighborhood_category_vote' in {index['name'] for index in inspect(engine).get_indexes('store')}
+    with engine.connect() as connection:
+        assert connection.scalar(select(func.count()).select_from(Store)) == 12
+        # Le classifiche sono pronte prima del primo import: i 10 migliori di Roma
+        assert connection.execute(select(CityRanking.store_id).order_by(CityRanking.position)).scalars().all() == \
+            list(range(12, 2, -1))
+        stats = {row.neighborhood_id: row for row in connection.execute(select(NeighborhoodStats))}
+        assert stats[1].store_count == 6 and stats[1].full_vote_share == 1.0
+        assert stats[2].average_vote == sum(range(1, 13, 2)) / 6 and stats[2].full_vote_share == 0.0
+        # I locali già presenti non sono novità, ciascuno dov'era
+        assert sorted(connection.execute(select(NotifiedStore.store_id, NotifiedStore.vote, NotifiedStore.neighborhood_id))) == \
+            [(i, float(i), 1 + i % 2) for i in range(1, 13)]
+        migrated = (connection.execute(select(CityRanking)).all(), connection.execute(select(NeighborhoodStats)).all())
+    # Finché refresh non cambia, la migrazione ne dà lo stesso risultato
+    with engine.begin() as connection:
+        leaderboard.refresh(connection)
+        assert (connection.execute(select(CityRanking)).all(), connection.execute(select(NeighborhoodStats)).all()) == migrated
+    engine.dispose()
+
+
+def test_rankings_use_the_configured_size(tmp_path, monkeypatch):
+    monkeypatch.setenv('LEADERBOARD_SIZE', '4')
+    engine = baseline_engine(tmp_path / 'bot.db')
+    migrate(engine)
+    with engine.connect() as connection:
+        assert connection.execute(select(CityRanking.store_id).order_by(CityRanking.position)).scalars().all() == \
+            [12, 11, 10, 9]
+    engine.dispose()
+
+
+def test_second_run_applies_nothing(tmp_path):
+    engine = baseline_engine(tmp_path / 'bot.db')
+    migrate(engine)
+    with engine.connect() as connection:
+        versions = connection.execute(select(SchemaVersion.version, SchemaVersion.applied_at)).all()
+        rankings = connection.execute(select(CityRanking)).all()
+    assert migrate(engine) == []
+    with engine.connect() as connection:
+        assert connection.execute(select(SchemaVersion.version, SchemaVersion.applied_at)).all() == versions
+        assert connection.execute(select(CityRanking)).all() == rankings
+    engine.dispose()
+
+
+def test_empty_database_is_created_at_the_last_version(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'bot.db'}")
+    assert migrate(engine) == sorted(version for version, _, _ in MIGRATIONS)
+    assert migrate(engine) == []
+    engine.dispose()
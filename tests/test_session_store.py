@@ -0,0 +1,111 @@
+"""The session stores, and the SQL one on the table created by the schema migrations"""
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from schema_migrations import migrate
+from session_store import SessionStore, MemorySessionStore, SQLSessionStore, encode_state, decode_state
+
+
+def test_sql_store_uses_the_migrated_table(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'bot.db'}")
+    store = SQLSessionStore(60, engine)
+    assert inspect(engine).get_table_names() == []
+    assert 8 in migrate(engine)
+    store[42] = {'step': 'city'}
+    assert store[42]['step'] == 'city'
+
+
+def test_base_store_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore(60)
+    store = MemorySessionStore(60, 10)
+    store[42] = {'step': 'city'}
+    assert store[42]['step'] == 'city'
+
+
+@pytest.fixture
+def sql_store(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'bot.db'}")
+    migrate(engine)
+    yield SQLSessionStore(60, engine)
+    engine.dispose()
+
+
+@pytest.fixture(params=['memory', 'sql'])
+def store(request):
+    if request.param == 'memory':
+        yield MemorySessionStore(60, 1000)
+        return
+    yield request.getfixturevalue('sql_store')
+
+
+def test_compact_encoding_round_trips():
+    state = {'category_id': 3, 'city_id': 12, 'neighborhood_id': None, 'step': 'neighborhood'}
+    data = encode_state(state)
+    # Chiavi corte e niente valori vuoti
+    assert data == '{"c":3,"t":12,"s":"neighborhood"}'
+    assert decode_state(data) == state
+    assert decode_state(encode_state({})) == {'category_id': None, 'city_id': None, 'neighborhood_id': None, 'step': None}
+    assert decode_state(encode_state({'step': 'city', 'page': 2}))['page'] == 2
+
+
+def test_states_expire_after_the_ttl(store):
+    store[1] = {'step': 'city'}
+    store.ttl = 0.05
+    store[2] = {'step': 'city'}
+    time.sleep(0.1)
+    assert 1 in store and store[1]['step'] == 'city'
+    assert 2 not in store and store.get(2) is None
+    with pytest.raises(KeyError):
+        store[2]
+    # Un nuovo salvataggio rinnova la scadenza
+    store.ttl = 60
+    store[2] = {'step': 'neighborhood'}
+    assert store[2]['step'] == 'neighborhood'
+
+
+def test_sweep_removes_expired_states_in_batches(store):
+    store.ttl = 0.05
+    for chat_id in range(10):
+        store[chat_id] = {'step': 'city'}
+    store.ttl = 60
+    store[100] = {'step': 'city'}
+    time.sleep(0.1)
+    assert [store.sweep(batch_size=4) for _ in range(4)] == [4, 4, 2, 0]
+    assert 100 in store
+
+
+def test_memory_store_evicts_the_least_recently_written():
+    store = MemorySessionStore(60, maxsize=3)
+    for chat_id in (1, 2, 3):
+        store[chat_id] = {'step': 'city'}
+    # Riscritto, il primo diventa il più recente
+    store[1] = {'step': 'neighborhood'}
+    store[4] = {'step': 'city'}
+    assert 2 not in store
+    assert all(chat_id in store for chat_id in (1, 3, 4))
+    assert store.evictions == 1 and len(store._states) == 3
+
+
+def test_sql_store_saves_concurrent_first_states(sql_store):
+    errors = []
+    barrier = threading.Barrier(4)
+
+    def save(worker):
+        barrier.wait()
+        for chat_id in range(30):
+            try:
+                sql_store[chat_id] = {'step': 'city', 'category_id': worker}
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert all(sql_store[chat_id]['category_id'] in range(4) for chat_id in range(30))
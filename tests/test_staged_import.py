@@ -0,0 +1,106 @@
+"""The staged import on the tables created by the schema migrations, refusing the orphan rows"""
+import pytest
+from sqlalchemy import create_engine, create_mock_engine, inspect, select
+
+import staged_import
+from bot_db_entities import City, Neighborhood, CriminalCategory, Store
+from dao import DAO
+from database import Database
+from database_updater import DatabaseUpdater
+from schema_migrations import migrate
+from synthetic_registry import generate
+
+STAGED_TABLES = {table.name for table in staged_import.METADATA.sorted_tables}
+
+
+def test_importer_does_not_create_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'bot.db'}")
+    staged_import.StagedImporter(engine, DatabaseUpdater.UPDATE_COLUMNS)
+    assert inspect(engine).get_table_names() == []
+    assert 7 in migrate(engine)
+    assert STAGED_TABLES <= set(inspect(engine).get_table_names())
+
+
+def test_unsupported_dialect_is_rejected():
+    with pytest.raises(ValueError, match='IMPORT_MODE=incremental'):
+        staged_import.StagedImporter(create_mock_engine('mysql://', None), DatabaseUpdater.UPDATE_COLUMNS)
+
+
+def test_staged_import_and_rollback(tmp_path, monkeypatch):
+    registry = str(tmp_path / 'registry.xlsx')
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setenv('FILE_PATH', registry)
+    monkeypatch.setenv('IMPORT_MODE', 'staged')
+    database = Database()
+    dao = DAO(database)
+    updater = DatabaseUpdater(database)
+    updater.add_reload_listener(dao.refresh_catalog)
+
+    generate(registry, stores=100, seed=3)
+    assert updater.update_from_excel()
+    generate(registry, stores=120, seed=3)
+    assert updater.update_from_excel()
+    assert [store.name for store in dao.search_stores('Locale 110')] == ['Locale 110']
+    assert len(updater.staged_importer.versions()) == 2
+
+    updater.rollback()
+    assert dao.search_stores('Locale 110') == []
+    assert [store.name for store in dao.search_stores('Locale 99')] == ['Locale 99']
+
+
+def _store(store_id, neighborhood_id, category_id=1):
+    return {'id': store_id, 'name': f'Locale {store_id}', 'address': 'Via Roma 1', 'vote': 8.0,
+            'maps_link': 'https://maps.app.goo.gl/x', 'latitude': None, 'longitude': None, 'full_vote': False,
+            'comment': None, 'criminal_category_id': category_id, 'neighborhood_id': neighborhood_id}
+
+
+def _registry(neighborhoods, stores):
+    return {
+        CriminalCategory: [{'id': 1, 'title': 'pizza'}],
+        City: [{'id': 1, 'name': 'roma'}],
+        Neighborhood: neighborhoods,
+        Store: stores,
+    }
+
+
+@pytest.fixture
+def importer(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'bot.db'}")
+    migrate(engine)
+    yield staged_import.StagedImporter(engine, DatabaseUpdater.UPDATE_COLUMNS)
+    engine.dispose()
+
+
+def live_ids(importer, model):
+    with importer.Session() as session:
+        return set(session.scalars(select(model.id)))
+
+
+def test_orphan_rows_are_refused_not_the_registry(importer):
+    neighborhoods = [{'id': 1, 'name': 'monti', 'city_id': 1}, {'id': 2, 'name': 'prati', 'city_id': 9}]
+    # Il quartiere 2 punta a una città che non c'è: sono rifiutati lui e i suoi locali
+    stores = [_store(1, 1), _store(2, 2), _store(3, 1, category_id=7), _store(4, 1)]
+    version_id = importer.import_records(_registry(neighborhoods, stores))
+    assert live_ids(importer, Neighborhood) == {1}
+    assert live_ids(importer, Store) == {1, 4}
+    assert [version.id for version in importer.versions() if version.active] == [version_id]
+
+
+def test_failed_publish_keeps_the_live_version(importer, monkeypatch):
+    neighborhoods = [{'id': 1, 'name': 'monti', 'city_id': 1}]
+    first = importer.import_records(_registry(neighborhoods, [_store(1, 1), _store(2, 1)]))
+    publish = importer._publish
+
+    def fail(session, version_id):
+        publish(session, version_id)
+        raise RuntimeError('connection lost')
+    monkeypatch.setattr(importer, '_publish', fail)
+    with pytest.raises(RuntimeError):
+        importer.import_records(_registry(neighborhoods, [_store(1, 1), _store(3, 1)]))
+
+    # Il publish è una transazione sola: nessuna riga della nuova versione è visibile
+    assert live_ids(importer, Store) == {1, 2}
+    assert [version.id for version in importer.versions() if version.active] == [first]
+    monkeypatch.setattr(importer, '_publish', publish)
+    assert importer.rollback(first) == first
+    assert live_ids(importer, Store) == {1, 2}
@@ -0,0 +1,164 @@
+"""The webhook server, alone and in front of the whole bot, fed with recorded updates"""
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from fake_bot_api import FakeBotAPI
+from synthetic_registry import generate
+from webhook_server import WebhookServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bot.py')
+WELCOME = 'Benvenuto nel bot'
+CATEGORIES = 'Scegli la categoria criminale'
+
+
+def recorded_updates():
+    with open(os.path.join(FIXTURES, 'webhook_updates.json')) as file:
+        return json.load(file)
+
+
+def post(port, update, path='/webhook', secret=None):
+    request = urllib.request.Request(f'http://127.0.0.1:{port}{path}', data=json.dumps(update).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    if secret is not None:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_updates_of_a_chat_are_dispatched_in_order():
+    handled = []
+    lock = threading.Lock()
+    rng = random.Random(1)
+
+    def dispatch(updates):
+        # Tempi diversi per ogni update: con una coda condivisa quelli di una chat si sorpasserebbero
+        time.sleep(rng.uniform(0, 0.02))
+        with lock:
+            handled.append((updates[0].message.chat.id, updates[0].update_id, threading.current_thread().name))
+
+    server = WebhookServer(dispatch, secret_token='segreto', host='127.0.0.1', port=0, workers=4)
+    server.start()
+    try:
+        sent = []
+        for round_ in range(10):
+            for update in recorded_updates():
+                update = dict(update, update_id=update['update_id'] + round_ * 100)
+                assert post(server.port, update, secret='segreto') == 200
+                sent.append((update['message']['chat']['id'], update['update_id']))
+        deadline = time.monotonic() + 10
+        while len(handled) < len(sent) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert sorted((chat_id, update_id) for chat_id, update_id, _ in handled) == sorted(sent)
+        for chat_id in {chat_id for chat_id, _ in sent}:
+            assert [update_id for chat, update_id, _ in handled if chat == chat_id] == \
+                   [update_id for chat, update_id in sent if chat == chat_id]
+            assert len({worker for chat, _, worker in handled if chat == chat_id}) == 1
+        assert server.queue_depth() == 0
+    finally:
+        server.stop()
+
+
+def test_rejected_requests():
+    server = WebhookServer(lambda updates: None, secret_token='segreto', host='127.0.0.1', port=0, workers=2)
+    server.start()
+    try:
+        update = recorded_updates()[0]
+        assert post(server.port, update) == 403
+        assert post(server.port, update, secret='sbagliato') == 403
+        assert post(server.port, update, path='/altro', secret='segreto') == 404
+        for length in ('abc', '-1'):
+            connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+            connection.putrequest('POST', '/webhook')
+            connection.putheader('Content-Length', length)
+            connection.putheader('X-Telegram-Bot-Api-Secret-Token', 'segreto')
+            connection.endheaders()
+            assert connection.getresponse().status == 400
+            connection.close()
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/health', timeout=5) as response:
+            assert json.load(response)['workers_alive'] == 2
+    finally:
+        server.stop()
+
+
+@pytest.fixture(params=['sync', 'async'])
+def webhook_bot(request, tmp_path):
+    api = FakeBotAPI().start()
+    registry = str(tmp_path / 'registry.xlsx')
+    generate(registry, stores=200)
+    remote = str(tmp_path / 'remote.xlsx')
+    shutil.copy(registry, remote)
+    api.serve_file(remote)
+    port = free_port()
+    env = dict(os.environ, BOT_TOKEN='123:test', TELEGRAM_API_URL=api.url, BOT_MODE='webhook', BOT_RUNTIME=request.param,
+               WEBHOOK_PORT=str(port), WEBHOOK_SECRET='segreto', WEBHOOK_WORKERS='4',
+               DATABASE_URL=f"sqlite:///{tmp_path / 'bot.db'}", FILE_PATH=registry,
+               REMOTE_FILE_URL=f'{api.url}/registry.xlsx', CHECK_INTERVAL='3600',
+               OUTBOX_GLOBAL_RATE='1000', OUTBOX_CHAT_RATE='1000')
+    env.pop('WEBHOOK_URL', None)
+    log = open(tmp_path / 'bot.log', 'w')
+    process = subprocess.Popen([sys.executable, BOT_PATH], env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1):
+                    break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    pytest.fail(f"The bot did not start: {(tmp_path / 'bot.log').read_text()}")
+                time.sleep(0.1)
+        yield api, port
+    finally:
+        process.terminate()
+        process.wait(10)
+        log.close()
+        api.stop()
+
+
+def test_bot_answers_recorded_updates_posted_to_the_webhook(webhook_bot):
+    api, port = webhook_bot
+    updates = recorded_updates()
+    for update in updates:
+        assert post(port, update, secret='segreto') == 200
+    # Telegram ripete un update se la risposta si perde: il bot non risponde due volte
+    assert post(port, updates[0], secret='segreto') == 200
+
+    deadline = time.monotonic() + 20
+    while len(api.sent) < len(updates) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.3)
+
+    expected = {}
+    for update in updates:
+        text = WELCOME if update['message']['text'] == '/start' else CATEGORIES
+        expected.setdefault(update['message']['chat']['id'], []).append(text)
+    replies = {}
+    for _, _, chat_id, text in api.sent:
+        replies.setdefault(chat_id, []).append(text)
+    assert set(replies) == set(expected)
+    for chat_id, texts in expected.items():
+        assert [reply[:len(text)] for reply, text in zip(replies[chat_id], texts)] == texts
+        assert len(replies[chat_id]) == len(texts)